@@ -15,7 +15,7 @@ import {
 import type { GenerateResponse, Account, AccountPreview, Goal, ScheduledPost, SystemConfig, ImageGroup, ImageCategory } from './types'
 import { IMAGE_CATEGORY_MAP, IMAGE_CATEGORIES } from './types'
 import {
-  generateContent, uploadNote, getAccounts, previewAccount, createAccount, deleteAccount,
+  generateContentStream, uploadNote, getAccounts, previewAccount, createAccount, deleteAccount,
   getGoals, createGoal, deleteGoal, updateGoal, planGoal, getGoalPosts, runPostNow, updateAccountCookie,
   checkAccountCookie, getSystemConfig, updateSystemConfig,
   getImageGroups, uploadImageGroup, deleteImageGroup, retryGroupVision,
@@ -70,6 +70,8 @@ const RATIOS = [
 
 const STATUS_MAP: Record<string, { color: string; text: string }> = {
   pending: { color: 'blue', text: '待发布' },
+  preparing: { color: 'cyan', text: '预渲染中' },
+  prepared: { color: 'geekblue', text: '已预渲染' },
   running: { color: 'orange', text: '发布中' },
   done:    { color: 'green', text: '已发布' },
   failed:  { color: 'red',   text: '失败' },
@@ -141,12 +143,38 @@ export default function App() {
   async function onGenerate(values: Record<string, unknown>) {
     setGenerating(true); setResult(null)
     try {
-      const res = await generateContent({
+      const count = values.image_count as number
+      let scrolled = false
+      // 标题、正文、每张图片到达即渲染，不必等全部生成完成
+      const res = await generateContentStream({
         topic: values.topic as string, style: values.style as string,
-        aspect_ratio: values.aspect_ratio as string, image_count: values.image_count as number,
+        aspect_ratio: values.aspect_ratio as string, image_count: count,
+      }, e => {
+        setResult(prev => {
+          const cur = prev ?? {
+            content: { title: '', body: '', hashtags: [], image_prompts: [] },
+            images: Array.from({ length: count }, () => ({})),
+          }
+          switch (e.event) {
+            case 'title': case 'body': case 'hashtags':
+              return { ...cur, content: { ...cur.content, [e.event]: e.data } }
+            case 'content':
+              return { ...cur, content: e.data }
+            case 'image': {
+              const images = [...cur.images]
+              images[e.data.index] = { url: e.data.url, b64_json: e.data.b64_json }
+              return { ...cur, images }
+            }
+            default:
+              return prev
+          }
+        })
+        if (!scrolled) {
+          scrolled = true
+          setTimeout(() => resultRef.current?.scrollIntoView({ behavior: 'smooth', block: 'start' }), 100)
+        }
       })
       setResult(res)
-      setTimeout(() => resultRef.current?.scrollIntoView({ behavior: 'smooth', block: 'start' }), 100)
     } catch (e: unknown) { msgApi.error((e as Error).message) }
     finally { setGenerating(false) }
   }
@@ -442,14 +470,14 @@ export default function App() {
               </Form>
             </Card>
 
-            {generating && (
+            {generating && !result && (
               <Card className="fade-in" style={{ borderRadius: 16, border: 'none', textAlign: 'center', padding: '40px 0' }}>
                 <Spin indicator={<LoadingOutlined style={{ fontSize: 36, color: '#ff2442' }} spin />} />
                 <div style={{ marginTop: 16, color: '#ff2442', fontWeight: 500 }}>AI 正在创作中，请稍候...</div>
               </Card>
             )}
 
-            {result && !generating && (
+            {result && (
               <div ref={resultRef} className="fade-in-up" style={{ animationDelay: '.1s' }}>
                 <Card style={{ borderRadius: 16, boxShadow: '0 4px 24px rgba(0,0,0,.06)', border: 'none' }}
                   styles={{ body: { padding: 28 } }}>
@@ -486,7 +514,7 @@ export default function App() {
                   </Image.PreviewGroup>
                   <Divider style={{ margin: '24px 0' }} />
                   <div style={{ textAlign: 'center' }}>
-                    <Button size="large" onClick={openPublish} className="publish-float" icon={<RocketOutlined />}
+                    <Button size="large" onClick={openPublish} className="publish-float" disabled={generating} icon={<RocketOutlined />}
                       style={{ ...primaryBtnStyle, color: '#fff', height: 48, padding: '0 40px', fontSize: 16, fontWeight: 600, borderRadius: 24 }}>
                       发布到小红书
                     </Button>
@@ -844,7 +872,7 @@ export default function App() {
             { title: '笔记ID', dataIndex: 'note_id', width: 110, render: (v: string) => v || '-' },
             {
               title: '操作', width: 100, render: (_: unknown, record: ScheduledPost) =>
-                (record.status === 'pending' || record.status === 'failed') ? (
+                (record.status === 'pending' || record.status === 'prepared' || record.status === 'failed') ? (
                   <Button size="small" type="primary" icon={<RocketOutlined />}
                     loading={runningPostIds.has(record.id)}
                     onClick={() => onRunPostNow(record.id)}
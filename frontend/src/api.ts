@@ -1,6 +1,6 @@
 import type {
-  GenerateRequest, GenerateResponse, Account, AccountPreview, UploadRequest, UploadResponse,
-  Goal, ScheduledPost, PlanResult, SystemConfig, ImageGroup, ImageCategory,
+  GenerateRequest, GenerateResponse, GenerateEvent, Account, AccountPreview, UploadRequest, UploadResponse,
+  Goal, ScheduledPost, PostPage, PlanResult, SystemConfig, ImageGroup, ImageCategory,
 } from './types'
 
 const BASE = '/api'
@@ -16,6 +16,36 @@ const post = <T>(url: string, body: unknown) =>
   req<T>(url, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(body) })
 
 export const generateContent = (r: GenerateRequest) => post<GenerateResponse>('/generate', r)
+
+// 流式生成：逐行解析 NDJSON 事件并回调，返回最终的完整结果
+export async function generateContentStream(
+  r: GenerateRequest, onEvent: (e: GenerateEvent) => void,
+): Promise<GenerateResponse> {
+  const res = await fetch(BASE + '/generate/stream', {
+    method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(r),
+  })
+  if (!res.ok || !res.body) throw new Error(`请求失败 ${res.status}`)
+  const reader = res.body.getReader()
+  const decoder = new TextDecoder()
+  let buf = ''
+  let final: GenerateResponse | null = null
+  for (;;) {
+    const { done, value } = await reader.read()
+    buf += decoder.decode(value, { stream: !done })
+    const lines = buf.split('\n')
+    buf = done ? '' : lines.pop() ?? ''
+    for (const line of lines) {
+      if (!line.trim()) continue
+      const e = JSON.parse(line) as GenerateEvent
+      if (e.event === 'error') throw new Error(e.data.detail || '生成失败')
+      if (e.event === 'done') final = e.data
+      onEvent(e)
+    }
+    if (done) break
+  }
+  if (!final) throw new Error('生成中断')
+  return final
+}
 export const uploadNote = (r: UploadRequest) => post<UploadResponse>('/upload', r)
 
 export const getAccounts = () => req<Account[]>('/accounts')
@@ -35,8 +65,24 @@ export const updateGoal = (id: number, body: Omit<Goal, 'id' | 'active' | 'creat
 export const planGoal = (goal_id: number) =>
   req<PlanResult>(`/goals/${goal_id}/plan`, { method: 'POST' })
 
-export const getGoalPosts = (goal_id: number) => req<ScheduledPost[]>(`/goals/${goal_id}/posts`)
-export const getAllPosts = () => req<ScheduledPost[]>('/posts')
+const POST_PAGE_SIZE = 200
+
+// 排期列表按 next_cursor 逐页读取（每页 POST_PAGE_SIZE 条），不再一次性请求全部
+async function getPostPages(path: string): Promise<ScheduledPost[]> {
+  const posts: ScheduledPost[] = []
+  let cursor: string | null = null
+  do {
+    const params = new URLSearchParams({ limit: String(POST_PAGE_SIZE) })
+    if (cursor) params.set('cursor', cursor)
+    const page: PostPage = await req<PostPage>(`${path}?${params}`)
+    posts.push(...page.items)
+    cursor = page.next_cursor
+  } while (cursor)
+  return posts
+}
+
+export const getGoalPosts = (goal_id: number) => getPostPages(`/goals/${goal_id}/posts`)
+export const getAllPosts = () => getPostPages('/posts')
 export const runPostNow = (id: number) => req(`/posts/${id}/run`, { method: 'POST' })
 
 export const updateAccountCookie = (id: string, cookie: string) =>
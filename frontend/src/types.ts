@@ -22,6 +22,16 @@ export interface GenerateResponse {
   images: GeneratedImage[]
 }
 
+// /api/generate/stream 的 NDJSON 事件
+export type GenerateEvent =
+  | { event: 'title' | 'body'; data: string }
+  | { event: 'hashtags'; data: string[] }
+  | { event: 'content'; data: XHSContent }
+  | { event: 'prompts'; data: { prompts: string[]; styles: string[] } }
+  | { event: 'image'; data: GeneratedImage & { index: number } }
+  | { event: 'done'; data: GenerateResponse }
+  | { event: 'error'; data: { detail: string } }
+
 export interface Account {
   id: string
   name: string
@@ -75,13 +85,20 @@ export interface ScheduledPost {
   aspect_ratio: string
   image_count: number
   scheduled_at: string
-  status: 'pending' | 'running' | 'done' | 'failed'
+  status: 'pending' | 'preparing' | 'prepared' | 'running' | 'done' | 'failed'
   result_title?: string
   note_id?: string
   error?: string
   created_at: string
 }
 
+// 传 limit 时排期列表接口返回的分页对象
+export interface PostPage {
+  items: ScheduledPost[]
+  next_cursor: string | null
+  total: number
+}
+
 export interface PlanResult {
   analysis: string
   posts: ScheduledPost[]
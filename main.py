@@ -1,4 +1,6 @@
 import uvicorn
+import argparse
+import asyncio
 import logging
 import os
 from logging.handlers import TimedRotatingFileHandler
@@ -10,8 +12,10 @@ from fastapi.responses import FileResponse
 from starlette.middleware.base import BaseHTTPMiddleware
 from src.xhs_agent.api.router import router
 from src.xhs_agent.middleware import log_requests
-from src.xhs_agent.db import init_db
+from src.xhs_agent.db import init_db, close_db
+from src.xhs_agent.services.llm_client import close_llm_client
 from src.xhs_agent.services.scheduler_service import (
+    acquire_scheduler_lock,
     start_scheduler,
     reload_pending_jobs,
 )
@@ -58,9 +62,14 @@ setup_logging()
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_db()
-    start_scheduler()
-    await reload_pending_jobs()
+    # XHS_ROLE=api：只提供 HTTP 服务，排期由独立 worker 进程（xhs-agent worker）执行；
+    # 多 worker 部署时只有抢到调度器锁的进程启动调度器
+    if os.getenv("XHS_ROLE") != "api" and acquire_scheduler_lock():
+        start_scheduler()
+        await reload_pending_jobs()
     yield
+    await close_llm_client()
+    await close_db()
 
 
 app = FastAPI(
@@ -82,8 +91,70 @@ async def index():
 
 
 def main():
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    parser = argparse.ArgumentParser(prog="xhs-agent", description="小红书内容自动生成 Agent")
+    parser.add_argument(
+        "mode",
+        nargs="?",
+        default="dev",
+        choices=["dev", "serve", "api", "worker", "vacuum"],
+        help=(
+            "dev: API + 调度器（单进程热重载，默认）；serve: 生产模式 API + 调度器；"
+            "api: 生产模式仅 HTTP 服务；worker: 仅调度器与执行引擎；"
+            "vacuum: 维护命令，完整 VACUUM 数据库（需先停止服务）"
+        ),
+    )
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    # 以下参数仅用于 serve / api 生产模式
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv("XHS_WORKERS", "2")),
+        help="HTTP 进程数（默认 2，环境变量 XHS_WORKERS）",
+    )
+    parser.add_argument(
+        "--keep-alive", type=int, default=int(os.getenv("XHS_KEEP_ALIVE", "30")),
+        help="HTTP keep-alive 超时秒数（默认 30，环境变量 XHS_KEEP_ALIVE）",
+    )
+    parser.add_argument(
+        "--backlog", type=int, default=int(os.getenv("XHS_BACKLOG", "4096")),
+        help="监听队列长度（默认 4096，环境变量 XHS_BACKLOG）",
+    )
+    args = parser.parse_args()
+
+    if args.mode == "worker":
+        from src.xhs_agent.worker import run_worker
+
+        asyncio.run(run_worker())
+        return
+    if args.mode == "vacuum":
+        from src.xhs_agent.services.archive_service import vacuum_db
+
+        async def _vacuum():
+            await init_db()
+            try:
+                await vacuum_db()
+            finally:
+                await close_db()
+
+        asyncio.run(_vacuum())
+        return
+    if args.mode == "dev":
+        uvicorn.run("main:app", host=args.host, port=args.port, reload=True)
+        return
 
+    if args.mode == "api":
+        # 通过环境变量传递角色，uvicorn 子进程重新导入 main 时同样生效
+        os.environ["XHS_ROLE"] = "api"
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=max(args.workers, 1),
+        loop="uvloop",
+        http="httptools",
+        timeout_keep_alive=args.keep_alive,
+        backlog=args.backlog,
+        access_log=False,
+    )
 
 if __name__ == "__main__":
     main()
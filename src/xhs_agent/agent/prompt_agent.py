@@ -10,12 +10,29 @@
     → prompt_agent.build_image_prompts()   ← 本模块
       → LLM 选模板 + 填充细节
     → image_service.generate_images()
+
+本地模板选择（prompt_local_selector=1）：
+  主题/标题/话题明确指向某个模板时，本地打分选模板，scene_detail 取自文本阶段的 image_prompts，
+  不调用 LLM；置信度不足时仍交给 LLM
+
+融合模式（llm_fused_prompts=1）：
+  prompt_agent.build_content_and_prompts()
+    → 一次 LLM 调用同时生成笔记内容与模板选择，失败时回退为上面的两次调用
 """
 
 import json
 import logging
-import httpx
+import math
+import re
+import time
 from ..config import get_setting
+from ..services.llm_client import chat_json
+from ..services.text_service import (
+    SYSTEM_PROMPT,
+    build_user_prompt,
+    generate_xhs_content,
+    parse_content,
+)
 from ..api.schemas import XHSContent
 
 logger = logging.getLogger("xhs_agent")
@@ -109,6 +126,128 @@ PROMPT_TEMPLATES: dict[str, dict] = {
     },
 }
 
+# ─────────────────────────────────────────────
+# 本地模板选择器
+# 对每个模板的 name + description 预先建立关键词与字符 bigram 索引（bigram 按 IDF 加权），
+# 主题/标题/话题/参考图标注明确指向某个模板时直接选用，不调用 LLM
+# ─────────────────────────────────────────────
+# 置信条件：最高分至少命中一个完整关键词，且明显高于同风格的次高分
+_LOCAL_MIN_SCORE = 1.0
+_LOCAL_MIN_MARGIN = 1.5
+# 关键词命中权重；bigram 重叠按 IDF 归一化后乘以该权重
+_NGRAM_WEIGHT = 0.5
+# 从 image_prompts 提取 scene_detail 时去掉的风格描述片段
+_STYLE_WORDS = (
+    "误拍", "快照", "风格", "角度", "倾斜", "偏移", "过曝", "抖动", "模糊", "噪点",
+    "滤镜", "后期", "质感", "构图", "水印", "文字", "光线", "自然光",
+)
+_SPLIT_RE = re.compile(r"[，,。；;、\s]+")
+
+
+def _bigrams(text: str) -> set[str]:
+    text = re.sub(r"[^\u4e00-\u9fff0-9a-zA-Z]", "", text)
+    return {text[i : i + 2] for i in range(len(text) - 1)}
+
+
+def _build_template_index() -> dict[str, dict]:
+    index: dict[str, dict] = {}
+    for key, tpl in PROMPT_TEMPLATES.items():
+        # "适合A、B、C，强调D" → 关键词 A / B / C + 模板名
+        desc = tpl["description"].split("，")[0].removeprefix("适合")
+        keywords = [k for k in desc.split("、") if k] + [tpl["name"]]
+        index[key] = {
+            "keywords": keywords,
+            "grams": _bigrams(tpl["name"] + tpl["description"]),
+        }
+    df: dict[str, int] = {}
+    for entry in index.values():
+        for g in entry["grams"]:
+            df[g] = df.get(g, 0) + 1
+    n = len(index)
+    # 出现在所有模板中的 bigram（如"适合""强调"）IDF 为 0，不参与打分
+    idf = {g: math.log(n / c) for g, c in df.items()}
+    top = max(idf.values()) or 1.0
+    for entry in index.values():
+        entry["idf"] = {g: idf[g] / top for g in entry["grams"]}
+    return index
+
+
+_TEMPLATE_INDEX = _build_template_index()
+
+# 本地选择统计：命中次数、走 LLM 次数、LLM 选模板耗时的滑动平均（估算节省的时间）
+_selector_stats = {"local": 0, "llm": 0, "llm_seconds": 0.0}
+
+
+def score_templates(text: str, style: str) -> list[tuple[str, float]]:
+    """按与 text 的匹配度为 style 风格的模板打分，按分数降序返回 [(template_key, score)]"""
+    grams = _bigrams(text)
+    scores = []
+    for key, entry in _TEMPLATE_INDEX.items():
+        if PROMPT_TEMPLATES[key]["style"] != style:
+            continue
+        score = sum(1.0 for kw in entry["keywords"] if kw in text)
+        score += _NGRAM_WEIGHT * sum(w for g, w in entry["idf"].items() if g in grams)
+        scores.append((key, round(score, 3)))
+    scores.sort(key=lambda x: x[1], reverse=True)
+    return scores
+
+
+def _scene_from_prompt(prompt: str, template: str) -> str:
+    """从文本阶段的粗略 image_prompt 中去掉风格描述，只保留场景内容作为 scene_detail"""
+    parts = [
+        p for p in _SPLIT_RE.split(prompt)
+        if p and p not in template and not any(w in p for w in _STYLE_WORDS)
+    ]
+    return "，".join(parts)[:60]
+
+
+def _select_locally(
+    topic: str,
+    content: XHSContent,
+    unified_style: str,
+    image_count: int,
+    ref_images: list[dict] | None,
+) -> list[str] | None:
+    """本地选模板并填充提示词，置信度不足时返回 None（交给 LLM）"""
+    text = " ".join(
+        [topic, content.title, *content.hashtags]
+        + [img.get("annotation", "") for img in ref_images or []]
+    )
+    ranked = score_templates(text, unified_style)
+    if not ranked:
+        return None
+    top, second = ranked[0][1], ranked[1][1] if len(ranked) > 1 else 0.0
+    if top < _LOCAL_MIN_SCORE or top < second * _LOCAL_MIN_MARGIN:
+        logger.debug(f"[PromptAgent] 本地模板选择置信度不足: {ranked}")
+        return None
+    # 最高分须领先第二名 _LOCAL_MIN_MARGIN 倍，所以只会选中一个模板，所有图片共用
+    chosen = ranked[0][0]
+    tpl = PROMPT_TEMPLATES[chosen]["template"]
+    prompts = []
+    for i in range(image_count):
+        raw = content.image_prompts[i] if i < len(content.image_prompts) else ""
+        detail = _scene_from_prompt(raw, tpl) or "，".join(dict.fromkeys([topic, content.title]))
+        prompts.append(tpl.replace("{scene_detail}", detail))
+    logger.debug(f"[PromptAgent] 本地模板选择: {ranked}，使用 {chosen}")
+    return prompts
+
+
+def _log_selector_decision(local: bool) -> None:
+    total = _selector_stats["local"] + _selector_stats["llm"]
+    rate = _selector_stats["local"] / total if total else 0
+    if local:
+        saved = _selector_stats["llm_seconds"]
+        logger.info(
+            f"[PromptAgent] 本地模板选择命中，跳过 LLM"
+            + (f"（约节省 {saved:.1f}s）" if saved else "")
+            + f"，本地决策率 {rate:.0%}（{_selector_stats['local']}/{total}）"
+        )
+    else:
+        logger.info(
+            f"[PromptAgent] 本地模板选择置信度不足，交给 LLM，本地决策率 {rate:.0%}（{_selector_stats['local']}/{total}）"
+        )
+
+
 # ─────────────────────────────────────────────
 # Agent System Prompt
 # ─────────────────────────────────────────────
@@ -142,18 +281,34 @@ _AGENT_SYSTEM_PROMPT = """你是一位专业的图片提示词工程师，专门
 """
 
 
+def _require_selections(parsed: dict) -> dict:
+    if not isinstance(parsed.get("selections"), list):
+        raise ValueError("输出缺少 selections 列表")
+    return parsed
+
+
 async def build_image_prompts(
     topic: str,
     style: str,
     content: XHSContent,
     image_count: int,
     ref_images: list[dict] | None = None,
+    fresh: bool = False,
 ) -> tuple[list[str], list[str]]:
     # 取整篇笔记的统一风格（image_styles 列表中只有一个值）
     unified_style = content.image_styles[0] if content.image_styles else "photo"
     if unified_style not in ("photo", "poster"):
         unified_style = "photo"
 
+    if (await get_setting("prompt_local_selector") or "0") != "0":
+        local_prompts = _select_locally(
+            topic, content, unified_style, image_count, ref_images
+        )
+        _selector_stats["local" if local_prompts else "llm"] += 1
+        _log_selector_decision(bool(local_prompts))
+        if local_prompts:
+            return local_prompts, [unified_style] * image_count
+
     # 只加载与统一风格匹配的模板
     filtered_templates = {
         k: {
@@ -197,38 +352,25 @@ async def build_image_prompts(
         f"[PromptAgent] 可用模板数={len(filtered_templates)}，模板keys={list(filtered_templates.keys())}"
     )
 
-    base_url = await get_setting("siliconflow_base_url")
-    api_key = await get_setting("siliconflow_api_key")
-    model = await get_setting("text_model")
-
     logger.debug(f"[PromptAgent] system_prompt:\n{system_prompt}")
     logger.debug(f"[PromptAgent] user_prompt:\n{user_prompt}")
 
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.post(
-            f"{base_url}/chat/completions",
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "model": model,
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt},
-                ],
-                "temperature": 0.7,
-                "max_tokens": 2048,
-                "response_format": {"type": "json_object"},
-            },
-        )
-        response.raise_for_status()
-
-    data = response.json()
-    raw_content = data["choices"][0]["message"]["content"]
-    logger.debug(f"[PromptAgent] LLM 原始响应: {raw_content}")
+    t0 = time.monotonic()
+    parsed = await chat_json(
+        [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ],
+        site="prompt_select",
+        validate=_require_selections,
+        temperature=0.7,
+        max_tokens=2048,
+        fresh=fresh,
+    )
+    elapsed = time.monotonic() - t0
+    prev = _selector_stats["llm_seconds"]
+    _selector_stats["llm_seconds"] = elapsed if not prev else prev + 0.2 * (elapsed - prev)
 
-    parsed = json.loads(raw_content)
     selections = parsed.get("selections", [])
 
     prompts: list[str] = []
@@ -261,3 +403,134 @@ async def build_image_prompts(
         f"[PromptAgent] 完成，共生成 {len(prompts)} 条提示词，统一风格={unified_style!r}"
     )
     return prompts, styles
+
+
+# ─────────────────────────────────────────────
+# 融合模式：内容生成 + 模板选择一次完成
+# ─────────────────────────────────────────────
+_FUSED_SYSTEM_ADDENDUM = """
+【第三步：为每张图片选择模板并填充场景细节】
+确定 image_style 后，从下列模板中选择 style 与 image_style 相同的模板，每张图片选择不同的模板（模板不够时可重复），
+并为每张图片写出替换模板中 {scene_detail} 的具体场景描述（30-50字，全部中文，严禁出现英文单词、字母、拼音）。
+
+可用模板列表（JSON格式）：
+{templates_json}
+
+在输出的 JSON 中额外包含 selections 字段，数量与图片数量相同：
+"selections": [
+  {"template_key": "模板key", "scene_detail": "具体场景描述"},
+  ...
+]
+"""
+
+
+def _fill_selections(
+    selections: list, unified_style: str, image_count: int
+) -> list[str]:
+    """校验融合输出的模板选择并在本地填充模板，任一项不合法时抛出 ValueError"""
+    if len(selections) < image_count:
+        raise ValueError(f"selections 数量不足: {len(selections)}/{image_count}")
+    prompts = []
+    for i, sel in enumerate(selections[:image_count]):
+        key = sel.get("template_key", "") if isinstance(sel, dict) else ""
+        detail = (sel.get("scene_detail") or "").strip() if isinstance(sel, dict) else ""
+        tpl = PROMPT_TEMPLATES.get(key)
+        if not tpl or tpl["style"] != unified_style:
+            raise ValueError(f"图片{i + 1} 模板 {key!r} 不存在或与风格 {unified_style!r} 不符")
+        if not detail:
+            raise ValueError(f"图片{i + 1} 缺少 scene_detail")
+        prompts.append(tpl["template"].replace("{scene_detail}", detail))
+    return prompts
+
+
+async def _fused_generate(
+    topic: str,
+    style: str,
+    image_count: int,
+    ref_images: list[dict] | None,
+    fresh: bool = False,
+) -> tuple[XHSContent, list[str], list[str]]:
+    templates_json = json.dumps(
+        {
+            k: {
+                "name": v["name"],
+                "description": v["description"],
+                "style": v["style"],
+                "template": v["template"],
+            }
+            for k, v in PROMPT_TEMPLATES.items()
+        },
+        ensure_ascii=False,
+        indent=2,
+    )
+    system_prompt = SYSTEM_PROMPT + _FUSED_SYSTEM_ADDENDUM.replace(
+        "{templates_json}", templates_json
+    )
+    user_prompt = build_user_prompt(topic, style, image_count, ref_images)
+
+    logger.debug(f"[PromptAgent] 融合模式 user_prompt:\n{user_prompt}")
+
+    def validate(parsed: dict) -> tuple[XHSContent, list[str]]:
+        content = parse_content(parsed)
+        unified_style = content.image_styles[0]
+        return content, _fill_selections(
+            parsed.get("selections") or [], unified_style, image_count
+        )
+
+    # 结构不合格时先追问修正一次，仍失败再由调用方回退为两次调用
+    content, prompts = await chat_json(
+        [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ],
+        site="fused",
+        validate=validate,
+        temperature=0.8,
+        max_tokens=3072,
+        timeout=90.0,
+        fresh=fresh,
+    )
+    return content, prompts, content.image_styles[:1] * image_count
+
+
+async def build_content_and_prompts(
+    topic: str,
+    style: str,
+    image_count: int,
+    ref_images: list[dict] | None = None,
+    fresh: bool = False,
+) -> tuple[XHSContent, list[str], list[str]]:
+    """生成笔记内容与最终图片提示词，返回 (content, prompts, styles)。
+
+    llm_fused_prompts=1 时用一次 LLM 调用完成（内容 + 模板选择），输出按两步调用相同的
+    结构校验，失败时回退为 generate_xhs_content + build_image_prompts 两次调用。
+    fresh=True 时所有 LLM 调用跳过响应缓存。
+    """
+    if (await get_setting("llm_fused_prompts") or "0") != "0":
+        try:
+            content, prompts, styles = await _fused_generate(
+                topic, style, image_count, ref_images, fresh=fresh
+            )
+            logger.info(
+                f"[PromptAgent] 融合模式完成，一次调用生成内容与 {len(prompts)} 条提示词，统一风格={styles[0]!r}"
+            )
+            return content, prompts, styles
+        except Exception as e:
+            logger.warning(f"[PromptAgent] 融合模式失败，回退为两次调用: {e}")
+
+    content = await generate_xhs_content(
+        topic,
+        style,
+        image_count,
+        ref_annotations=ref_images if ref_images else None,
+        fresh=fresh,
+    )
+    prompts, styles = await build_image_prompts(
+        topic=topic,
+        style=style,
+        content=content,
+        image_count=image_count,
+        ref_images=ref_images,
+        fresh=fresh,
+    )
+    return content, prompts, styles
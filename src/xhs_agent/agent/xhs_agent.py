@@ -1,8 +1,10 @@
+import asyncio
 import logging
-from ..services.text_service import generate_xhs_content
+from typing import AsyncIterator
 from ..services.image_service import generate_images
-from ..api.schemas import GenerateRequest, GenerateResponse
-from .prompt_agent import build_image_prompts
+from ..services.text_service import stream_xhs_content
+from ..api.schemas import GenerateRequest, GenerateResponse, GeneratedImage
+from .prompt_agent import build_content_and_prompts, build_image_prompts
 
 logger = logging.getLogger("xhs_agent")
 
@@ -12,11 +14,13 @@ async def run(request: GenerateRequest) -> GenerateResponse:
         f"开始生成内容，主题={request.topic!r}，风格={request.style!r}，图片数={request.image_count}"
     )
 
-    # 1. 生成图文内容（含风格决策 image_styles）
-    content = await generate_xhs_content(
+    # 1-2. 生成图文内容（含风格决策 image_styles），PromptAgent 选模板 + 填充细节生成高质量提示词
+    # （llm_fused_prompts=1 时一次 LLM 调用完成两步）；每次手动生成都要新内容，跳过 LLM 响应缓存
+    content, prompts, styles = await build_content_and_prompts(
         topic=request.topic,
         style=request.style,
         image_count=request.image_count,
+        fresh=True,
     )
     logger.info(
         f"文本生成完成，标题={content.title!r}，统一风格决策={content.image_styles}"
@@ -24,14 +28,6 @@ async def run(request: GenerateRequest) -> GenerateResponse:
     logger.debug(
         f"文本内容详情: body长度={len(content.body)}字，hashtags={content.hashtags}，原始image_prompts={content.image_prompts}"
     )
-
-    # 2. PromptAgent：根据笔记内容选模板 + 填充细节，生成高质量提示词
-    prompts, styles = await build_image_prompts(
-        topic=request.topic,
-        style=request.style,
-        content=content,
-        image_count=request.image_count,
-    )
     logger.debug(f"PromptAgent 输出: prompts={prompts}，styles={styles}")
 
     # 3. 并发生成图片
@@ -43,3 +39,70 @@ async def run(request: GenerateRequest) -> GenerateResponse:
     )
 
     return GenerateResponse(content=content, images=images)
+
+
+# 流式生成时逐字段推送的顶层字段
+_STREAM_FIELDS = ("title", "body", "hashtags")
+
+
+async def run_stream(request: GenerateRequest) -> AsyncIterator[dict]:
+    """与 run 相同的生成流程，但逐步产出进度事件 {"event": ..., "data": ...}：
+
+      - title / body / hashtags：LLM 流式输出中该字段完整时立即推送
+      - content：完整笔记内容（XHSContent）
+      - prompts：最终图片提示词与风格
+      - image：每张图片生成完成时推送 {index, url, b64_json}
+      - done：完整 GenerateResponse；出错时为 error {detail}
+
+    流式模式下内容与提示词分两步生成（不走 llm_fused_prompts），以便标题先于正文返回。
+    客户端断开时生成任务随之取消。
+    """
+    logger.info(
+        f"开始流式生成内容，主题={request.topic!r}，风格={request.style!r}，图片数={request.image_count}"
+    )
+    queue: asyncio.Queue[dict | None] = asyncio.Queue()
+
+    def emit(event: str, data) -> None:
+        queue.put_nowait({"event": event, "data": data})
+
+    def on_field(key: str, value) -> None:
+        if key in _STREAM_FIELDS:
+            emit(key, value)
+
+    def on_image(index: int, image: GeneratedImage) -> None:
+        emit("image", {"index": index, **image.model_dump()})
+
+    async def pipeline() -> None:
+        try:
+            content = await stream_xhs_content(
+                request.topic, request.style, request.image_count, on_field=on_field
+            )
+            emit("content", content.model_dump())
+            # 与 run 相同，手动生成跳过 LLM 响应缓存（流式文本本身不缓存）
+            prompts, styles = await build_image_prompts(
+                request.topic, request.style, content, request.image_count, fresh=True
+            )
+            emit("prompts", {"prompts": prompts, "styles": styles})
+            images = await generate_images(
+                prompts,
+                aspect_ratio=request.aspect_ratio,
+                styles=styles,
+                on_image=on_image,
+            )
+            logger.info(
+                f"流式生成完成，标题={content.title!r}，"
+                f"图片成功={sum(1 for img in images if img.url or img.b64_json)}/{len(images)}张"
+            )
+            emit("done", GenerateResponse(content=content, images=images).model_dump())
+        except Exception as e:
+            logger.error(f"流式生成失败: {e}")
+            emit("error", {"detail": str(e)})
+        finally:
+            queue.put_nowait(None)
+
+    task = asyncio.create_task(pipeline())
+    try:
+        while (item := await queue.get()) is not None:
+            yield item
+    finally:
+        task.cancel()
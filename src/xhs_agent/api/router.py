@@ -3,18 +3,24 @@ import json
 import logging
 import os
 from datetime import datetime
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form
-from fastapi.responses import Response
-from pydantic import BaseModel
+from typing import Literal
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Query, Header
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from pydantic import BaseModel, ValidationError
 import httpx
 from ..api.schemas import GenerateRequest, GenerateResponse
-from ..agent.xhs_agent import run
+from ..agent.xhs_agent import run, run_stream
 from ..services.upload_service import download_image_to_tmp, upload_image_note
 from ..services import account_service
 from ..services import goal_service
+from ..services import job_service
 from ..services import account_image_service
 from ..services.manager_service import plan_operation, calc_scheduled_time
-from ..services.scheduler_service import schedule_post, scheduler
+from ..services.scheduler_service import (
+    schedule_posts,
+    unschedule_posts,
+    scheduler,
+)
 
 logger = logging.getLogger("xhs_agent")
 router = APIRouter(prefix="/api", tags=["xhs"])
@@ -45,6 +51,21 @@ async def generate(request: GenerateRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post("/generate/stream")
+async def generate_stream(request: GenerateRequest):
+    """流式生成：以 NDJSON（每行一个 {"event", "data"}）逐步返回标题、正文、提示词与每张图片"""
+
+    async def lines():
+        async for event in run_stream(request):
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(
+        lines(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.post("/upload", response_model=UploadResponse)
 async def upload(request: UploadRequest):
     cookie = request.cookie
@@ -82,6 +103,90 @@ async def upload(request: UploadRequest):
                 pass
 
 
+# ── 异步任务 ──────────────────────────────────────────
+_JOB_POLL_SECONDS = 1.0
+_JOB_KEEPALIVE_SECONDS = 15
+
+
+class JobCreate(BaseModel):
+    kind: Literal["generate", "upload"]
+    params: dict
+
+
+@router.post("/jobs", status_code=202)
+async def create_job(
+    body: JobCreate,
+    response: Response,
+    idempotency_key: str | None = Header(default=None),
+):
+    """创建异步生成 / 上传任务，立即返回任务（status=queued）。
+
+    params 与 /api/generate、/api/upload 的请求体相同；Idempotency-Key 相同的重复提交
+    返回已有任务（HTTP 200），参数不同时返回 409。
+    """
+    model = GenerateRequest if body.kind == "generate" else UploadRequest
+    try:
+        params = model(**body.params).model_dump()
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if body.kind == "upload" and (params.get("cookie") or not params.get("account_id")):
+        # 任务参数会写入 jobs 表并保留到清理期，不接受明文 cookie
+        raise HTTPException(status_code=422, detail="异步上传任务需要提供 account_id，不接受 cookie")
+    try:
+        job, created = await job_service.create_job(body.kind, params, idempotency_key)
+    except job_service.IdempotencyConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if not created:
+        response.status_code = 200
+    elif scheduler.running:
+        # 本进程运行调度器时直接提交执行引擎；API-only 进程由 worker 轮询领取
+        await job_service.submit_job(job["id"], body.kind, params)
+    return job
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: int):
+    """查询任务状态、进度（progress）与结果（result）"""
+    job = await job_service.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job
+
+
+@router.get("/jobs/{job_id}/events")
+async def job_events(job_id: int):
+    """以 SSE 推送任务进度：状态或进度变化时发送 progress 事件，结束时发送 done / failed 事件后关闭"""
+    if not await job_service.get_job(job_id):
+        raise HTTPException(status_code=404, detail="任务不存在")
+
+    async def events():
+        last = None
+        idle = 0.0
+        while True:
+            job = await job_service.get_job(job_id)
+            if job is None:
+                return
+            # updated_at 只精确到秒，同一秒内的多次进度更新靠 progress 内容区分
+            snapshot = (job["status"], json.dumps(job["progress"], sort_keys=True))
+            if snapshot != last:
+                last, idle = snapshot, 0.0
+                event = job["status"] if job["status"] in ("done", "failed") else "progress"
+                yield f"event: {event}\ndata: {json.dumps(job, ensure_ascii=False)}\n\n"
+                if event != "progress":
+                    return
+            elif idle >= _JOB_KEEPALIVE_SECONDS:
+                idle = 0.0
+                yield ": keepalive\n\n"
+            await asyncio.sleep(_JOB_POLL_SECONDS)
+            idle += _JOB_POLL_SECONDS
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # ── 账号管理 ──────────────────────────────────────────
 class AccountCreate(BaseModel):
     name: str = ""
@@ -231,7 +336,7 @@ async def delete_goal(goal_id: int):
     # 取消调度器中该目标下所有 pending job
     posts = await goal_service.list_scheduled_posts(goal_id)
     for p in posts:
-        if p["status"] == "pending":
+        if p["status"] in ("pending", "prepared"):
             job_id = f"post_{p['id']}"
             if scheduler.get_job(job_id):
                 scheduler.remove_job(job_id)
@@ -284,8 +389,11 @@ def _get_plan_lock(goal_id: int) -> _asyncio.Lock:
 
 
 @router.post("/goals/{goal_id}/plan")
-async def plan_goal(goal_id: int):
-    """让总管 AI 分析目标（使用目标绑定的账号），生成并保存7天发布计划"""
+async def plan_goal(goal_id: int, fresh: bool = Query(default=False)):
+    """让总管 AI 分析目标（使用目标绑定的账号），生成并保存7天发布计划。
+
+    fresh=true 时跳过 LLM 响应缓存，强制重新规划。
+    """
     lock = _get_plan_lock(goal_id)
     if lock.locked():
         raise HTTPException(status_code=429, detail="规划进行中，请勿重复提交")
@@ -313,66 +421,190 @@ async def plan_goal(goal_id: int):
                 cookie,
                 user_id=xhs_user_id,
                 account_id=account_id,
+                fresh=fresh,
             )
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"AI 规划失败: {e}")
 
-        # 清除旧的 pending 排期（取消调度器中对应 job）
-        old_posts = await goal_service.list_scheduled_posts(goal_id)
-        for p in old_posts:
-            if p["status"] == "pending":
-                job_id = f"post_{p['id']}"
-                if scheduler.get_job(job_id):
-                    scheduler.remove_job(job_id)
-        deleted = await goal_service.delete_pending_posts(goal_id)
-        if deleted:
-            logger.info(f"已清除目标 #{goal_id} 的 {deleted} 条旧 pending 排期")
-
-        created_posts = []
+        items = []
         for item in plan.get("weekly_plan", []):
-            scheduled_at = calc_scheduled_time(
-                item["day_offset"], item["hour"], item["minute"]
-            )
             ref_images_raw = item.get("ref_images", [])
-            ref_image_ids = json.dumps(
-                [
-                    r["group_id"]
-                    for r in ref_images_raw
-                    if isinstance(r, dict) and "group_id" in r
-                ]
-            )
-            post = await goal_service.create_scheduled_post(
-                goal_id=goal_id,
-                account_id=account_id,
-                topic=item["topic"],
-                style=item.get("style", goal["style"]),
-                aspect_ratio=item.get("aspect_ratio", "3:4"),
-                image_count=item.get("image_count", 1),
-                scheduled_at=scheduled_at,
-                ref_image_ids=ref_image_ids,
+            items.append(
+                {
+                    "account_id": account_id,
+                    "topic": item["topic"],
+                    "style": item.get("style", goal["style"]),
+                    "aspect_ratio": item.get("aspect_ratio", "3:4"),
+                    "image_count": item.get("image_count", 1),
+                    "scheduled_at": calc_scheduled_time(
+                        item["day_offset"], item["hour"], item["minute"]
+                    ),
+                    "ref_image_ids": json.dumps(
+                        [
+                            r["group_id"]
+                            for r in ref_images_raw
+                            if isinstance(r, dict) and "group_id" in r
+                        ]
+                    ),
+                }
             )
-            run_time = datetime.strptime(scheduled_at, "%Y-%m-%d %H:%M")
-            schedule_post(post["id"], run_time)
-            created_posts.append(post)
+
+        # 旧的未发布排期（pending / prepared / preparing）删除与新排期插入在同一事务内完成，随后批量替换调度 job
+        removed_ids, created_posts = await goal_service.replace_pending_plan(
+            goal_id, items
+        )
+        unschedule_posts(removed_ids)
+        if removed_ids:
+            logger.info(f"已清除目标 #{goal_id} 的 {len(removed_ids)} 条旧的未发布排期")
+        schedule_posts(
+            [
+                (p["id"], datetime.strptime(p["scheduled_at"], "%Y-%m-%d %H:%M"))
+                for p in created_posts
+            ]
+        )
 
         return {"analysis": plan.get("analysis", ""), "posts": created_posts}
 
 
 @router.get("/goals/{goal_id}/posts")
-async def get_goal_posts(goal_id: int):
-    return await goal_service.list_scheduled_posts(goal_id)
+async def get_goal_posts(
+    goal_id: int,
+    status: str | None = None,
+    since: str | None = None,
+    until: str | None = None,
+    cursor: str | None = None,
+    limit: int | None = Query(None, ge=1, le=500),
+    fields: Literal["list", "full"] = "list",
+):
+    return await _query_posts(
+        goal_id=goal_id,
+        status=status,
+        since=since,
+        until=until,
+        cursor=cursor,
+        limit=limit,
+        fields=fields,
+    )
 
 
 @router.get("/posts")
-async def get_all_posts():
-    return await goal_service.list_scheduled_posts()
+async def get_all_posts(
+    goal_id: int | None = None,
+    account_id: str | None = None,
+    status: str | None = None,
+    since: str | None = None,
+    until: str | None = None,
+    cursor: str | None = None,
+    limit: int | None = Query(None, ge=1, le=500),
+    fields: Literal["list", "full"] = "list",
+):
+    return await _query_posts(
+        goal_id=goal_id,
+        account_id=account_id,
+        status=status,
+        since=since,
+        until=until,
+        cursor=cursor,
+        limit=limit,
+        fields=fields,
+    )
+
+
+async def _query_posts(
+    goal_id: int | None = None,
+    account_id: str | None = None,
+    status: str | None = None,
+    since: str | None = None,
+    until: str | None = None,
+    cursor: str | None = None,
+    limit: int | None = None,
+    fields: str = "list",
+):
+    """排期列表查询：传 limit 时返回分页对象，否则返回完整列表（兼容旧前端）。
+    fields=full 时才返回 result_body / result_images 大字段。"""
+    statuses = [s.strip() for s in status.split(",") if s.strip()] if status else None
+    try:
+        page = await goal_service.query_scheduled_posts(
+            goal_id=goal_id,
+            account_id=account_id,
+            statuses=statuses,
+            since=since,
+            until=until,
+            cursor=cursor,
+            limit=limit,
+            full=fields == "full",
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return page if limit is not None else page["items"]
+
+
+@router.post("/posts/archive")
+async def archive_posts(days: int | None = Query(None, ge=1)):
+    """立即归档超过保留期的 done/failed 排期并压缩数据库（默认使用 post_retention_days）"""
+    from ..services.archive_service import archive_finished_posts
+
+    return await archive_finished_posts(days)
+
+
+@router.get("/posts/archive/{post_id}")
+async def get_archived_post(post_id: int):
+    from ..services.archive_service import get_archived_post as _get_archived
+
+    post = await _get_archived(post_id)
+    if not post:
+        raise HTTPException(status_code=404, detail="归档排期不存在")
+    return post
+
+
+@router.get("/posts/{post_id}/stages")
+async def get_post_stages(post_id: int):
+    """查看排期各流水线阶段的完成情况与输出"""
+    if not await goal_service.get_scheduled_post(post_id):
+        raise HTTPException(status_code=404, detail="排期不存在")
+    return await goal_service.list_post_stages(post_id)
+
+
+@router.post("/posts/{post_id}/images/{index}/regenerate")
+async def regenerate_post_image(post_id: int, index: int):
+    """重新生成排期的第 index 张图片（从 1 开始），其余图片保留。
+
+    pending/prepared 排期立即提交预渲染补生成；failed 排期在下次执行时补生成。
+    """
+    from ..services.execution_service import submit_prepare
+
+    post = await goal_service.get_scheduled_post(post_id)
+    if not post:
+        raise HTTPException(status_code=404, detail="排期不存在")
+    if post["status"] not in ("pending", "prepared", "failed"):
+        raise HTTPException(
+            status_code=400, detail=f"当前状态 {post['status']} 不可重新生成图片"
+        )
+    try:
+        images = await goal_service.reset_post_image(post_id, index - 1)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if images is None:
+        raise HTTPException(status_code=409, detail="排期状态已变化，请刷新后重试")
+    queued = False
+    if post["status"] != "failed" and scheduler.running:
+        queued = await submit_prepare(post_id)
+    return {"ok": True, "post_id": post_id, "index": index, "queued": queued}
 
 
 @router.post("/posts/{post_id}/run")
-async def run_post_now(post_id: int):
-    """立即执行一条排期任务（不管 scheduled_at）"""
+async def run_post_now(
+    post_id: int,
+    force: list[Literal["content", "prompts", "images", "download"]] = Query(
+        default=[]
+    ),
+):
+    """立即执行一条排期任务（不管 scheduled_at）。
+
+    默认从第一个未完成的阶段继续；force 指定的阶段及其下游阶段强制重新生成。
+    """
     from ..db import get_db as _get_db
-    from ..services.goal_service import execute_scheduled_post
+    from ..services.execution_service import submit_post
 
     async with _get_db() as db:
         async with db.execute(
@@ -381,18 +613,57 @@ async def run_post_now(post_id: int):
             row = await cur.fetchone()
     if not row:
         raise HTTPException(status_code=404, detail="排期不存在")
-    if row["status"] not in ("pending", "failed"):
+    if row["status"] not in ("pending", "prepared", "failed"):
         raise HTTPException(
             status_code=400, detail=f"当前状态 {row['status']} 不可立即执行"
         )
-    async with _get_db() as db:
-        await db.execute(
-            "UPDATE scheduled_posts SET status='pending', error=NULL WHERE id=?",
-            (post_id,),
-        )
-        await db.commit()
-    asyncio.create_task(execute_scheduled_post(post_id))
-    return {"ok": True, "post_id": post_id}
+    reset = await goal_service.request_post_run(post_id, force)
+    if reset is None:
+        raise HTTPException(status_code=409, detail="排期状态已变化，请刷新后重试")
+    # 本进程运行调度器时直接提交执行引擎；API-only 进程由 worker 轮询领取
+    if scheduler.running:
+        await submit_post(post_id)
+    return {"ok": True, "post_id": post_id, "reset_stages": reset}
+
+
+@router.get("/metrics/execution")
+async def execution_metrics():
+    """执行引擎指标：队列深度、运行中任务、排队等待时间、各上游并发占用"""
+    from ..services.execution_service import engine
+
+    return engine.get_metrics()
+
+
+@router.get("/metrics/images")
+async def image_metrics():
+    """图片调度器指标：各模型通道的并发/RPM 占用、按优先级的排队数、排队等待时间、
+    各模型与尺寸的请求耗时直方图、对冲请求次数、各服务商健康度、结果缓存命中率"""
+    from ..services.image_service import image_cache, image_router, image_scheduler
+
+    return {
+        **image_scheduler.get_metrics(),
+        "providers": image_router.get_metrics(),
+        "cache": image_cache.get_metrics(),
+    }
+
+
+@router.get("/metrics/llm")
+async def llm_metrics():
+    """LLM 调用指标：按调用点统计的次数、失败、重试、结构化输出修正次数、token 用量与耗时"""
+    from ..services.llm_client import get_metrics
+
+    return get_metrics()
+
+
+@router.get("/images/{name}")
+async def get_stored_image(name: str):
+    """本地图片存储（图片服务返回的 b64 解码后按内容哈希保存），内容不变可长期缓存"""
+    from ..services.image_service import stored_image_path
+
+    path = stored_image_path(f"/api/images/{name}")
+    if path is None or not path.exists():
+        raise HTTPException(status_code=404, detail="图片不存在")
+    return FileResponse(path, headers={"Cache-Control": "public, max-age=31536000, immutable"})
 
 
 @router.get("/proxy/image")
@@ -459,6 +730,7 @@ _CONFIG_KEYS = [
     "image_api_key",
     "image_api_base_url",
     "image_model",
+    "image_providers",
     "wxpusher_app_token",
     "wxpusher_uids",
     "cos_secret_id",
@@ -466,6 +738,26 @@ _CONFIG_KEYS = [
     "cos_region",
     "cos_bucket",
     "cos_path_prefix",
+    "post_retention_days",
+    "catchup_window_minutes",
+    "image_retry_attempts",
+    "poster_concurrency",
+    "prerender_lead_minutes",
+    "max_concurrent_posts",
+    "llm_concurrency",
+    "llm_fused_prompts",
+    "llm_retry_attempts",
+    "llm_cache_ttl",
+    "llm_cache_max_mb",
+    "prompt_local_selector",
+    "image_concurrency",
+    "image_rpm",
+    "image_model_limits",
+    "image_request_timeout",
+    "image_hedge",
+    "image_batch",
+    "image_cache_ttl_seconds",
+    "xhs_concurrency",
 ]
 
 _CONFIG_DEFAULTS = {
@@ -476,6 +768,7 @@ _CONFIG_DEFAULTS = {
     "image_api_key": "",
     "image_api_base_url": "",
     "image_model": "doubao-seedream-4-5-251128",
+    "image_providers": "[]",
     "wxpusher_app_token": "",
     "wxpusher_uids": "",
     "cos_secret_id": "",
@@ -483,6 +776,26 @@ _CONFIG_DEFAULTS = {
     "cos_region": "ap-guangzhou",
     "cos_bucket": "",
     "cos_path_prefix": "ref_images",
+    "post_retention_days": "30",
+    "catchup_window_minutes": "30",
+    "image_retry_attempts": "2",
+    "poster_concurrency": "3",
+    "prerender_lead_minutes": "30",
+    "max_concurrent_posts": "3",
+    "llm_concurrency": "4",
+    "llm_fused_prompts": "0",
+    "llm_retry_attempts": "3",
+    "llm_cache_ttl": "{}",
+    "llm_cache_max_mb": "64",
+    "prompt_local_selector": "1",
+    "image_concurrency": "4",
+    "image_rpm": "0",
+    "image_model_limits": "{}",
+    "image_request_timeout": "360",
+    "image_hedge": "1",
+    "image_batch": "1",
+    "image_cache_ttl_seconds": "600",
+    "xhs_concurrency": "1",
 }
 
 
@@ -502,6 +815,7 @@ class ConfigUpdate(BaseModel):
     image_api_key: str = ""
     image_api_base_url: str = ""
     image_model: str = "doubao-seedream-4-5-251128"
+    image_providers: str = "[]"
     wxpusher_app_token: str = ""
     wxpusher_uids: str = ""
     cos_secret_id: str = ""
@@ -509,10 +823,32 @@ class ConfigUpdate(BaseModel):
     cos_region: str = "ap-guangzhou"
     cos_bucket: str = ""
     cos_path_prefix: str = "ref_images"
+    post_retention_days: str = "30"
+    catchup_window_minutes: str = "30"
+    image_retry_attempts: str = "2"
+    poster_concurrency: str = "3"
+    prerender_lead_minutes: str = "30"
+    max_concurrent_posts: str = "3"
+    llm_concurrency: str = "4"
+    llm_fused_prompts: str = "0"
+    llm_retry_attempts: str = "3"
+    llm_cache_ttl: str = "{}"
+    llm_cache_max_mb: str = "64"
+    prompt_local_selector: str = "1"
+    image_concurrency: str = "4"
+    image_rpm: str = "0"
+    image_model_limits: str = "{}"
+    image_request_timeout: str = "360"
+    image_hedge: str = "1"
+    image_batch: str = "1"
+    image_cache_ttl_seconds: str = "600"
+    xhs_concurrency: str = "1"
 
 
 @router.put("/config")
 async def update_system_config(body: ConfigUpdate):
-    for key in _CONFIG_KEYS:
-        await _set_config(key, getattr(body, key, ""))
+    # 只写入请求中显式传入的字段，未传字段保持原值（与接口文档一致）：前端配置表单只提交
+    # 部分配置项，post_retention_days 等仅在服务端配置的项不能被 ConfigUpdate 默认值覆盖
+    for key, value in body.model_dump(exclude_unset=True).items():
+        await _set_config(key, value)
     return {"ok": True}
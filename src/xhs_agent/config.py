@@ -8,6 +8,7 @@ _DEFAULTS = {
     "image_api_key": "请在系统配置中填写",
     "image_api_base_url": "请在系统配置中填写",
     "image_model": "doubao-seedream-4-5-251128",
+    "image_providers": "[]",
     "wxpusher_app_token": "",
     "wxpusher_uids": "",
     "cos_secret_id": "",
@@ -15,6 +16,26 @@ _DEFAULTS = {
     "cos_region": "ap-guangzhou",
     "cos_bucket": "",
     "cos_path_prefix": "ref_images",
+    "post_retention_days": "30",
+    "catchup_window_minutes": "30",
+    "image_retry_attempts": "2",
+    "poster_concurrency": "3",
+    "prerender_lead_minutes": "30",
+    "max_concurrent_posts": "3",
+    "llm_concurrency": "4",
+    "llm_fused_prompts": "0",
+    "llm_retry_attempts": "3",
+    "llm_cache_ttl": "{}",
+    "llm_cache_max_mb": "64",
+    "prompt_local_selector": "1",
+    "image_concurrency": "4",
+    "image_rpm": "0",
+    "image_model_limits": "{}",
+    "image_request_timeout": "360",
+    "image_hedge": "1",
+    "image_batch": "1",
+    "image_cache_ttl_seconds": "600",
+    "xhs_concurrency": "1",
 }
 
 
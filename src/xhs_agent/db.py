@@ -1,4 +1,5 @@
 import aiosqlite
+import os
 import re
 import logging
 import pathlib
@@ -6,12 +7,33 @@ from contextlib import asynccontextmanager
 
 DB_PATH = pathlib.Path(__file__).parent.parent.parent / "data" / "xhs_agent.db"
 
+# 存储后端：未设置时使用本地 SQLite；设置为 postgresql://... 时使用 PostgreSQL（多节点部署）
+DB_URL = os.getenv("XHS_DB_URL", "")
+DB_POOL_SIZE = int(os.getenv("XHS_DB_POOL_SIZE", "10"))
+
 logger = logging.getLogger("xhs_agent")
 
 
+def is_postgres() -> bool:
+    return DB_URL.startswith(("postgres://", "postgresql://"))
+
+
 @asynccontextmanager
 async def get_db():
     """用法：async with get_db() as db:"""
+    if is_postgres():
+        from .db_pg import PgConnection, get_pool
+
+        pool = await get_pool(DB_URL, DB_POOL_SIZE)
+        async with pool.acquire() as conn:
+            db = PgConnection(conn, _ID_TABLES)
+            try:
+                yield db
+            finally:
+                # 与 aiosqlite 一致：未 commit 的写入在连接归还时回滚
+                await db.rollback()
+        return
+
     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
     async with aiosqlite.connect(DB_PATH) as db:
         db.row_factory = aiosqlite.Row
@@ -19,6 +41,13 @@ async def get_db():
         yield db
 
 
+async def close_db() -> None:
+    if is_postgres():
+        from .db_pg import close_pool
+
+        await close_pool()
+
+
 _SCHEMA_SQL = """
 CREATE TABLE IF NOT EXISTS accounts (
     id           TEXT PRIMARY KEY,
@@ -59,6 +88,10 @@ CREATE TABLE IF NOT EXISTS scheduled_posts (
     result_images TEXT,
     note_id       TEXT,
     error         TEXT,
+    lease_owner   TEXT,
+    lease_until   TEXT,
+    run_requested INTEGER NOT NULL DEFAULT 0,
+    result_hashtags TEXT,
     created_at    TEXT NOT NULL,
     FOREIGN KEY (goal_id) REFERENCES operation_goals(id),
     FOREIGN KEY (account_id) REFERENCES accounts(id)
@@ -94,6 +127,72 @@ CREATE TABLE IF NOT EXISTS account_images (
     FOREIGN KEY (account_id) REFERENCES accounts(id),
     FOREIGN KEY (group_id) REFERENCES image_groups(id)
 );
+
+CREATE TABLE IF NOT EXISTS scheduled_posts_archive (
+    id              INTEGER PRIMARY KEY,
+    goal_id         INTEGER NOT NULL,
+    account_id      TEXT NOT NULL,
+    topic           TEXT NOT NULL,
+    style           TEXT NOT NULL,
+    aspect_ratio    TEXT NOT NULL DEFAULT '3:4',
+    image_count     INTEGER NOT NULL DEFAULT 1,
+    scheduled_at    TEXT NOT NULL,
+    ref_image_ids   TEXT NOT NULL DEFAULT '[]',
+    status          TEXT NOT NULL,
+    result_title    TEXT,
+    result_hashtags TEXT,
+    result_body_z   BLOB,
+    result_images_z BLOB,
+    note_id         TEXT,
+    error_z         BLOB,
+    created_at      TEXT NOT NULL,
+    archived_at     TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS post_stages (
+    post_id     INTEGER NOT NULL,
+    stage       TEXT NOT NULL,
+    output      TEXT NOT NULL,
+    updated_at  TEXT NOT NULL,
+    PRIMARY KEY (post_id, stage)
+);
+
+CREATE TABLE IF NOT EXISTS llm_cache (
+    key         TEXT PRIMARY KEY,
+    site        TEXT NOT NULL,
+    response    TEXT NOT NULL,
+    size        INTEGER NOT NULL,
+    created_at  TEXT NOT NULL,
+    expires_at  TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind            TEXT NOT NULL,
+    idempotency_key TEXT,
+    params          TEXT NOT NULL,
+    status          TEXT NOT NULL DEFAULT 'queued',
+    progress        TEXT NOT NULL DEFAULT '{}',
+    result          TEXT,
+    error           TEXT,
+    lease_owner     TEXT,
+    lease_until     TEXT,
+    created_at      TEXT NOT NULL,
+    updated_at      TEXT NOT NULL
+);
+"""
+
+# 索引在自动迁移补齐字段之后创建，避免旧库缺列时建索引失败
+_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS idx_posts_schedule ON scheduled_posts (scheduled_at, id);
+CREATE INDEX IF NOT EXISTS idx_posts_goal ON scheduled_posts (goal_id, scheduled_at, id);
+CREATE INDEX IF NOT EXISTS idx_posts_account ON scheduled_posts (account_id, scheduled_at, id);
+CREATE INDEX IF NOT EXISTS idx_posts_status ON scheduled_posts (status, scheduled_at, id);
+CREATE INDEX IF NOT EXISTS idx_posts_lease ON scheduled_posts (status, lease_until);
+CREATE INDEX IF NOT EXISTS idx_posts_archive_goal ON scheduled_posts_archive (goal_id, scheduled_at);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_idempotency ON jobs (idempotency_key);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, updated_at);
+CREATE INDEX IF NOT EXISTS idx_llm_cache_expires ON llm_cache (expires_at);
 """
 
 _COL_RE = re.compile(
@@ -127,15 +226,32 @@ def _parse_expected_columns(schema_sql: str) -> dict[str, list[tuple[str, str]]]
     return tables
 
 
-async def _auto_migrate(db: aiosqlite.Connection) -> None:
-    """对比 schema 定义与实际表结构，自动补充缺失的列。"""
+_ID_TABLES = {
+    table
+    for table, cols in _parse_expected_columns(_SCHEMA_SQL).items()
+    if any(name == "id" for name, _ in cols)
+}
+
+
+async def _table_columns(db, table_name: str) -> set[str]:
+    if is_postgres():
+        return await db.table_columns(table_name)
+    async with db.execute(f"PRAGMA table_info({table_name})") as cur:
+        rows = await cur.fetchall()
+    return {row[1] for row in rows}
+
+
+async def _auto_migrate(db) -> None:
+    """对比 schema 定义与实际表结构，自动补充缺失的列（SQLite / PostgreSQL 通用）。"""
     expected = _parse_expected_columns(_SCHEMA_SQL)
     for table_name, columns in expected.items():
-        async with db.execute(f"PRAGMA table_info({table_name})") as cur:
-            rows = await cur.fetchall()
-        existing_cols = {row[1] for row in rows}
+        existing_cols = await _table_columns(db, table_name)
         for col_name, col_def in columns:
             if col_name not in existing_cols:
+                if is_postgres():
+                    from .db_pg import translate_column_type
+
+                    col_def = translate_column_type(col_def)
                 alter_sql = f"ALTER TABLE {table_name} ADD COLUMN {col_name} {col_def}"
                 try:
                     await db.execute(alter_sql)
@@ -145,9 +261,23 @@ async def _auto_migrate(db: aiosqlite.Connection) -> None:
 
 
 async def init_db() -> None:
+    if is_postgres():
+        from .db_pg import translate_schema
+
+        async with get_db() as db:
+            await db.executescript(translate_schema(_SCHEMA_SQL))
+            await _auto_migrate(db)
+            await db.commit()
+            await db.executescript(_INDEX_SQL)
+        logger.info("[DB] 使用 PostgreSQL 存储后端")
+        return
+
     async with get_db() as db:
+        # 仅对新建数据库生效；旧库需执行一次 xhs-agent vacuum（archive_service.vacuum_db）转换
+        await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
         await db.executescript(_SCHEMA_SQL)
         await _auto_migrate(db)
+        await db.executescript(_INDEX_SQL)
         await db.commit()
 
 
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import zlib
+from datetime import datetime, timedelta
+
+from ..db import get_db, is_postgres
+from ..config import get_setting
+from .goal_service import delete_post_stages
+from .image_service import prune_stored_images
+from .job_service import delete_finished_jobs
+
+logger = logging.getLogger("xhs_agent")
+
+_ARCHIVE_STATUSES = ("done", "failed")
+_BATCH_SIZE = 200
+
+
+def _compress(text: str | None) -> bytes | None:
+    if text is None:
+        return None
+    return zlib.compress(text.encode("utf-8"), 6)
+
+
+def _decompress(blob: bytes | None) -> str | None:
+    if blob is None:
+        return None
+    return zlib.decompress(blob).decode("utf-8")
+
+
+def _to_archive_row(row: dict, archived_at: str) -> tuple:
+    return (
+        row["id"],
+        row["goal_id"],
+        row["account_id"],
+        row["topic"],
+        row["style"],
+        row["aspect_ratio"],
+        row["image_count"],
+        row["scheduled_at"],
+        row["ref_image_ids"],
+        row["status"],
+        row["result_title"],
+        row["result_hashtags"],
+        _compress(row["result_body"]),
+        _compress(row["result_images"]),
+        row["note_id"],
+        _compress(row["error"]),
+        row["created_at"],
+        archived_at,
+    )
+
+
+async def archive_finished_posts(retention_days: int | None = None) -> dict:
+    """将超过保留期的 done/failed 排期移入 scheduled_posts_archive。
+
+    result_body / result_images / error 以 zlib 压缩后存为 BLOB；分批搬迁，
+    每批独立提交，避免长时间持有写锁。完成后执行 WAL checkpoint 与增量 VACUUM。
+    """
+    if retention_days is None:
+        retention_days = int(await get_setting("post_retention_days") or 0)
+    if retention_days <= 0:
+        logger.debug("[Archive] 保留天数 <= 0，跳过归档")
+        return {"archived": 0, "retention_days": retention_days}
+
+    cutoff = (datetime.now() - timedelta(days=retention_days)).strftime(
+        "%Y-%m-%d %H:%M"
+    )
+    archived_at = datetime.now().strftime("%Y-%m-%d %H:%M")
+    placeholders = ",".join("?" for _ in _ARCHIVE_STATUSES)
+    total = 0
+
+    while True:
+        async with get_db() as db:
+            async with db.execute(
+                f"SELECT * FROM scheduled_posts WHERE status IN ({placeholders}) "
+                f"AND scheduled_at < ? ORDER BY scheduled_at, id LIMIT ?",
+                (*_ARCHIVE_STATUSES, cutoff, _BATCH_SIZE),
+            ) as cur:
+                rows = [dict(r) for r in await cur.fetchall()]
+            if not rows:
+                break
+
+            # result_images 可能含完整 b64 图片，压缩放到线程里避免阻塞事件循环
+            archive_rows = await asyncio.to_thread(
+                lambda: [_to_archive_row(r, archived_at) for r in rows]
+            )
+            await db.executemany(
+                """INSERT INTO scheduled_posts_archive
+                   (id, goal_id, account_id, topic, style, aspect_ratio, image_count, scheduled_at,
+                    ref_image_ids, status, result_title, result_hashtags, result_body_z,
+                    result_images_z, note_id, error_z, created_at, archived_at)
+                   VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+                   ON CONFLICT (id) DO NOTHING""",
+                archive_rows,
+            )
+            await db.executemany(
+                "DELETE FROM scheduled_posts WHERE id = ?", [(r["id"],) for r in rows]
+            )
+            await db.commit()
+        # 阶段检查点与图片缓存随归档清理
+        await delete_post_stages([r["id"] for r in rows])
+        total += len(rows)
+        if len(rows) < _BATCH_SIZE:
+            break
+
+    # 本地图片存储按内容哈希共享，超过保留期未再写入的文件一并清理
+    pruned = await asyncio.to_thread(prune_stored_images, retention_days)
+    jobs = await delete_finished_jobs(retention_days)
+    logger.info(
+        f"[Archive] 归档 {total} 条排期（保留 {retention_days} 天，截止 {cutoff}），"
+        f"清理本地图片 {pruned} 张、已结束的异步任务 {jobs} 个"
+    )
+    await compact_db()
+    return {"archived": total, "retention_days": retention_days}
+
+
+async def compact_db() -> None:
+    """WAL checkpoint + 增量 VACUUM，回收归档后释放的页面。
+
+    只做增量回收，不在定时任务中执行完整 VACUUM（会长时间持有写锁、阻塞排期发布）；
+    旧库需在维护窗口执行一次 vacuum_db（xhs-agent vacuum）切换为增量模式。
+    """
+    if is_postgres():
+        async with get_db() as db:
+            await db.executescript("VACUUM (ANALYZE) scheduled_posts")
+        logger.info("[Archive] PostgreSQL VACUUM ANALYZE scheduled_posts 完成")
+        return
+    async with get_db() as db:
+        async with db.execute("PRAGMA auto_vacuum") as cur:
+            mode = (await cur.fetchone())[0]
+        if mode != 2:
+            logger.warning(
+                "[Archive] 数据库未开启 auto_vacuum=INCREMENTAL，归档释放的空间不会回收；"
+                "请在维护窗口停止服务后执行一次 xhs-agent vacuum"
+            )
+        else:
+            # 每次 step 释放一页，需要取完结果才会执行完整
+            async with db.execute("PRAGMA incremental_vacuum") as cur:
+                await cur.fetchall()
+        async with db.execute("PRAGMA wal_checkpoint(TRUNCATE)") as cur:
+            busy, log_pages, checkpointed = await cur.fetchone()
+    logger.info(
+        f"[Archive] WAL checkpoint 完成: busy={busy}, log={log_pages}, checkpointed={checkpointed}"
+    )
+
+
+async def vacuum_db() -> None:
+    """维护命令：完整 VACUUM。SQLite 旧库同时切换为 auto_vacuum=INCREMENTAL（切换需一次完整 VACUUM
+    才生效）；执行期间持有写锁，应在停止服务后运行。"""
+    if is_postgres():
+        async with get_db() as db:
+            await db.executescript("VACUUM (ANALYZE)")
+        logger.info("[Archive] PostgreSQL VACUUM ANALYZE 完成")
+        return
+    async with get_db() as db:
+        await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await db.execute("VACUUM")
+        async with db.execute("PRAGMA wal_checkpoint(TRUNCATE)") as cur:
+            await cur.fetchall()
+    logger.info("[Archive] 完整 VACUUM 完成，auto_vacuum=INCREMENTAL")
+
+
+async def get_archived_post(post_id: int) -> dict | None:
+    """读取归档排期（自动解压大字段）"""
+    async with get_db() as db:
+        async with db.execute(
+            "SELECT * FROM scheduled_posts_archive WHERE id = ?", (post_id,)
+        ) as cur:
+            row = await cur.fetchone()
+    if not row:
+        return None
+    post = dict(row)
+    post["result_body"] = _decompress(post.pop("result_body_z"))
+    post["result_images"] = _decompress(post.pop("result_images_z"))
+    post["error"] = _decompress(post.pop("error_z"))
+    return post
@@ -0,0 +1,242 @@
+"""
+排期执行引擎
+
+调度器到点后不再直接调用 execute_scheduled_post，而是把任务提交到本引擎：
+  - 全局并发上限（max_concurrent_posts）
+  - 同一账号的任务严格串行，互不重叠
+  - 等待中的任务按 scheduled_at 优先执行（越早越先）
+  - 对 LLM / 小红书上游分别限流（upstream_slot）；图片请求由 image_service.image_scheduler 调度
+  - 导出队列深度、等待时间等指标（get_metrics）
+"""
+
+import asyncio
+import bisect
+import itertools
+import logging
+import time
+from datetime import datetime
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from ..config import get_setting
+
+logger = logging.getLogger("xhs_agent")
+
+_UPSTREAM_SETTINGS = {
+    "llm": "llm_concurrency",
+    "xhs": "xhs_concurrency",
+}
+
+_WAIT_SAMPLES = 200
+
+
+@dataclass(order=True)
+class _Job:
+    sort_key: float
+    seq: int
+    key: str = field(compare=False)
+    account_id: str = field(compare=False)
+    run: Callable[[], Awaitable[None]] = field(compare=False)
+    enqueued_at: float = field(compare=False, default_factory=time.monotonic)
+
+
+class _Upstream:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.sem = asyncio.Semaphore(limit)
+        self.in_use = 0
+        self.waiting = 0
+
+
+class ExecutionEngine:
+    def __init__(self):
+        self._pending: list[_Job] = []
+        self._keys: set[str] = set()
+        self._busy_accounts: set[str] = set()
+        self._cond: asyncio.Condition | None = None
+        self._workers: list[asyncio.Task] = []
+        self._seq = itertools.count()
+        self._upstreams: dict[str, _Upstream] = {}
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self._waits: list[float] = []
+
+    async def _ensure_started(self) -> None:
+        if self._cond is not None:
+            return
+        self._cond = asyncio.Condition()
+        size = max(int(await get_setting("max_concurrent_posts") or 1), 1)
+        self._workers = [
+            asyncio.create_task(self._worker(i)) for i in range(size)
+        ]
+        logger.info(f"[Engine] 执行引擎已启动，并发上限={size}")
+
+    async def submit(
+        self,
+        key: str,
+        account_id: str,
+        run: Callable[[], Awaitable[None]],
+        sort_key: float | None = None,
+    ) -> bool:
+        """提交任务。key 相同的任务在排队/执行中时忽略重复提交，返回是否入队。"""
+        await self._ensure_started()
+        async with self._cond:
+            if key in self._keys:
+                logger.info(f"[Engine] 任务 {key} 已在队列中，忽略重复提交")
+                return False
+            job = _Job(
+                sort_key=sort_key if sort_key is not None else time.time(),
+                seq=next(self._seq),
+                key=key,
+                account_id=account_id,
+                run=run,
+            )
+            bisect.insort(self._pending, job)
+            self._keys.add(key)
+            self._cond.notify_all()
+        logger.info(
+            f"[Engine] 任务 {key} 入队 (account={account_id}), 队列深度={len(self._pending)}"
+        )
+        return True
+
+    def _pick(self) -> _Job | None:
+        for i, job in enumerate(self._pending):
+            if job.account_id not in self._busy_accounts:
+                return self._pending.pop(i)
+        return None
+
+    async def _worker(self, idx: int) -> None:
+        while True:
+            async with self._cond:
+                job = self._pick()
+                while job is None:
+                    await self._cond.wait()
+                    job = self._pick()
+                self._busy_accounts.add(job.account_id)
+                self._running += 1
+
+            wait = time.monotonic() - job.enqueued_at
+            self._waits.append(wait)
+            if len(self._waits) > _WAIT_SAMPLES:
+                self._waits.pop(0)
+            logger.info(f"[Engine] worker#{idx} 开始 {job.key}，排队等待 {wait:.1f}s")
+            try:
+                await job.run()
+                self._completed += 1
+            except Exception as e:
+                self._failed += 1
+                logger.error(f"[Engine] 任务 {job.key} 异常: {e}")
+            finally:
+                async with self._cond:
+                    self._busy_accounts.discard(job.account_id)
+                    self._keys.discard(job.key)
+                    self._running -= 1
+                    self._cond.notify_all()
+
+    async def _upstream(self, name: str) -> _Upstream:
+        up = self._upstreams.get(name)
+        if up is None:
+            setting = _UPSTREAM_SETTINGS.get(name)
+            limit = int(await get_setting(setting) or 1) if setting else 1
+            up = self._upstreams.setdefault(name, _Upstream(max(limit, 1)))
+        return up
+
+    @asynccontextmanager
+    async def upstream_slot(self, name: str):
+        up = await self._upstream(name)
+        up.waiting += 1
+        try:
+            await up.sem.acquire()
+        finally:
+            up.waiting -= 1
+        up.in_use += 1
+        try:
+            yield
+        finally:
+            up.in_use -= 1
+            up.sem.release()
+
+    def active_keys(self) -> set[str]:
+        """排队中与执行中的任务 key"""
+        return set(self._keys)
+
+    def get_metrics(self) -> dict:
+        waits = sorted(self._waits)
+        return {
+            "workers": len(self._workers),
+            "queue_depth": len(self._pending),
+            "running": self._running,
+            "busy_accounts": sorted(self._busy_accounts),
+            "completed": self._completed,
+            "failed": self._failed,
+            "wait_seconds": {
+                "samples": len(waits),
+                "avg": round(sum(waits) / len(waits), 2) if waits else 0,
+                "p95": round(waits[int(len(waits) * 0.95) - 1], 2) if waits else 0,
+                "max": round(waits[-1], 2) if waits else 0,
+            },
+            "upstreams": {
+                name: {"limit": up.limit, "in_use": up.in_use, "waiting": up.waiting}
+                for name, up in self._upstreams.items()
+            },
+        }
+
+
+engine = ExecutionEngine()
+
+
+def upstream_slot(name: str):
+    """上游限流：async with upstream_slot("llm"|"xhs"): ..."""
+    return engine.upstream_slot(name)
+
+
+async def _submit(post_id: int, prepare: bool) -> bool:
+    from .goal_service import (
+        execute_scheduled_post,
+        get_scheduled_post,
+        prepare_scheduled_post,
+    )
+
+    post = await get_scheduled_post(post_id)
+    if not post:
+        logger.warning(f"[Engine] 排期 #{post_id} 不存在，跳过提交")
+        return False
+    try:
+        sort_key = datetime.strptime(post["scheduled_at"], "%Y-%m-%d %H:%M").timestamp()
+    except ValueError:
+        sort_key = None
+    if prepare:
+        # 预渲染不上传，按账号单独串行，不阻塞同账号到点的发布任务
+        return await engine.submit(
+            f"prepare_{post_id}",
+            f"prepare:{post['account_id']}",
+            lambda: prepare_scheduled_post(post_id),
+            sort_key=sort_key,
+        )
+    return await engine.submit(
+        f"post_{post_id}",
+        post["account_id"],
+        lambda: execute_scheduled_post(post_id),
+        sort_key=sort_key,
+    )
+
+
+def active_post_ids() -> list[int]:
+    """已提交执行引擎（排队中或执行中）的发布任务对应的排期 ID"""
+    return sorted(
+        int(key.removeprefix("post_"))
+        for key in engine.active_keys()
+        if key.startswith("post_")
+    )
+
+
+async def submit_post(post_id: int) -> bool:
+    """把排期提交到执行引擎，按 scheduled_at 排序、按账号串行执行"""
+    return await _submit(post_id, prepare=False)
+
+
+async def submit_prepare(post_id: int) -> bool:
+    """把排期的预渲染（提前生成文本与图片）提交到执行引擎"""
+    return await _submit(post_id, prepare=True)
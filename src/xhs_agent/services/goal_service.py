@@ -1,15 +1,47 @@
+import base64
 import json
 import logging
 import asyncio
 import os
-from datetime import datetime
-from ..db import get_db
+import shutil
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from ..db import DB_PATH, get_db, is_postgres
+from ..config import get_setting
+from ..api.schemas import GeneratedImage, XHSContent
 from ..services.text_service import generate_xhs_content
-from ..services.image_service import generate_images
+from ..services.image_service import (
+    PRIORITY_PRERENDER,
+    PRIORITY_PUBLISH,
+    generate_images,
+    store_b64_image,
+)
 from ..services.upload_service import download_image_to_tmp, upload_image_note
+from ..services.execution_service import submit_post, upstream_slot
 
 logger = logging.getLogger("xhs_agent")
 
+# 执行租约：领取排期的进程每 LEASE_SECONDS/3 续约一次，进程退出后租约过期可被回收
+LEASE_SECONDS = 120
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+# 预渲染/阶段缓存图片目录：生成的图片下载到这里，到点或重跑时直接上传本地文件
+PREPARED_DIR = DB_PATH.parent / "prepared"
+
+# 发布流水线阶段（按顺序）。每个阶段的输出写入 post_stages，重跑时从第一个未完成的阶段继续
+POST_STAGES = ("content", "prompts", "images", "download", "upload")
+
+# 图片已下载（生成阶段全部完成）的排期回到待发布时恢复为 prepared，否则为 pending
+# 重新规划时可被新计划替换的状态：尚未开始发布的排期（含已预渲染与预渲染中的）
+_REPLACEABLE_SQL = "status IN ('pending', 'prepared', 'preparing')"
+
+_PREPARED_STATUS_SQL = (
+    "CASE WHEN EXISTS (SELECT 1 FROM post_stages WHERE post_stages.post_id = scheduled_posts.id "
+    "AND post_stages.stage = 'download') THEN 'prepared' ELSE 'pending' END"
+)
+
 
 def _get_fail_stage(e: Exception) -> str:
     err = str(e).lower()
@@ -125,23 +157,34 @@ async def delete_goal(goal_id: int) -> bool:
 
 
 async def delete_pending_posts(goal_id: int) -> int:
-    """删除目标下所有 pending 状态的排期（重新规划前调用）"""
+    """删除目标下所有尚未开始发布（pending / prepared / preparing）的排期及其阶段检查点与图片缓存"""
     async with get_db() as db:
+        async with db.execute(
+            f"SELECT id FROM scheduled_posts WHERE goal_id = ? AND {_REPLACEABLE_SQL}",
+            (goal_id,),
+        ) as cur:
+            post_ids = [r["id"] for r in await cur.fetchall()]
         cur = await db.execute(
-            "DELETE FROM scheduled_posts WHERE goal_id = ? AND status = 'pending'",
+            f"DELETE FROM scheduled_posts WHERE goal_id = ? AND {_REPLACEABLE_SQL}",
             (goal_id,),
         )
         await db.commit()
+    await delete_post_stages(post_ids)
     return cur.rowcount
 
 
 async def delete_all_posts(goal_id: int) -> int:
     async with get_db() as db:
+        async with db.execute(
+            "SELECT id FROM scheduled_posts WHERE goal_id = ?", (goal_id,)
+        ) as cur:
+            post_ids = [r["id"] for r in await cur.fetchall()]
         cur = await db.execute(
             "DELETE FROM scheduled_posts WHERE goal_id = ?",
             (goal_id,),
         )
         await db.commit()
+    await delete_post_stages(post_ids)
     return cur.rowcount
 
 
@@ -183,6 +226,75 @@ async def create_scheduled_post(
     }
 
 
+async def replace_pending_plan(
+    goal_id: int, items: list[dict]
+) -> tuple[list[int], list[dict]]:
+    """在同一事务内用新计划替换目标下所有尚未开始发布的排期（pending / prepared / preparing）。
+
+    已预渲染的排期同样会到点发布，不替换会与新计划重复发布；预渲染中的排期删除后，
+    预渲染任务结束时发现排期已不存在，自行清理其写入的阶段与图片缓存。
+    items 每项包含 account_id/topic/style/aspect_ratio/image_count/scheduled_at/ref_image_ids。
+    返回 (被删除的旧排期ID列表, 新建排期列表)，调用方据此批量注销/注册调度 job。
+    """
+    created_at = datetime.now().strftime("%Y-%m-%d %H:%M")
+    rows = [
+        (
+            goal_id,
+            item["account_id"],
+            item["topic"],
+            item["style"],
+            item.get("aspect_ratio", "3:4"),
+            item.get("image_count", 1),
+            item["scheduled_at"],
+            item.get("ref_image_ids", "[]"),
+            created_at,
+        )
+        for item in items
+    ]
+    async with get_db() as db:
+        # IMMEDIATE 事务：读旧 ID、删除、插入在同一写锁内完成，不存在无排期的窗口
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            async with db.execute(
+                f"SELECT id FROM scheduled_posts WHERE goal_id = ? AND {_REPLACEABLE_SQL}",
+                (goal_id,),
+            ) as cur:
+                removed_ids = [r["id"] for r in await cur.fetchall()]
+            await db.execute(
+                f"DELETE FROM scheduled_posts WHERE goal_id = ? AND {_REPLACEABLE_SQL}",
+                (goal_id,),
+            )
+            # 预渲染（或预渲染失败）遗留的阶段检查点随旧排期一起删除
+            await db.executemany(
+                "DELETE FROM post_stages WHERE post_id = ?", [(i,) for i in removed_ids]
+            )
+            new_ids = []
+            for row in rows:
+                cur = await db.execute(
+                    """INSERT INTO scheduled_posts
+                       (goal_id, account_id, topic, style, aspect_ratio, image_count, scheduled_at, ref_image_ids, status, created_at)
+                       VALUES (?,?,?,?,?,?,?,?,'pending',?)""",
+                    row,
+                )
+                new_ids.append(cur.lastrowid)
+            created = []
+            if new_ids:
+                placeholders = ",".join("?" for _ in new_ids)
+                async with db.execute(
+                    "SELECT id, topic, scheduled_at, status FROM scheduled_posts "
+                    f"WHERE id IN ({placeholders}) ORDER BY id",
+                    new_ids,
+                ) as cur:
+                    created = [dict(r) for r in await cur.fetchall()]
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+    for post_id in removed_ids:
+        discard_prepared_images(post_id)
+    return removed_ids, created
+
+
 async def list_scheduled_posts(goal_id: int | None = None) -> list[dict]:
     async with get_db() as db:
         if goal_id:
@@ -199,68 +311,562 @@ async def list_scheduled_posts(goal_id: int | None = None) -> list[dict]:
     return [dict(r) for r in rows]
 
 
-async def execute_scheduled_post(post_id: int) -> None:
-    from ..services.notification_service import get_notification_service
-    from ..agent.prompt_agent import build_image_prompts
+async def get_scheduled_post(post_id: int) -> dict | None:
+    """读取单条排期（列表投影，不含大字段）"""
+    async with get_db() as db:
+        async with db.execute(
+            f"SELECT {_POST_LIST_COLUMNS} FROM scheduled_posts WHERE id = ?", (post_id,)
+        ) as cur:
+            row = await cur.fetchone()
+    return dict(row) if row else None
 
-    notification = get_notification_service()
 
+async def list_pending_posts(since: str | None = None) -> list[dict]:
+    """只取待发布（pending/prepared）排期的 id 与 scheduled_at（走 idx_posts_status 索引），用于调度恢复"""
+    sql = "SELECT id, scheduled_at FROM scheduled_posts WHERE status IN ('pending', 'prepared')"
+    params: list = []
+    if since:
+        sql += " AND scheduled_at >= ?"
+        params.append(since)
+    sql += " ORDER BY scheduled_at ASC, id ASC"
+    async with get_db() as db:
+        async with db.execute(sql, params) as cur:
+            rows = await cur.fetchall()
+    return [dict(r) for r in rows]
+
+
+async def list_due_posts(now: str, since: str, limit: int = 100) -> list[int]:
+    """到点待执行的 pending/prepared 排期：scheduled_at 落在 [since, now] 内，或被手动请求立即执行。
+
+    worker 进程定时轮询此函数派发任务，API 进程只需写库即可。
+    """
     async with get_db() as db:
         async with db.execute(
-            "SELECT * FROM scheduled_posts WHERE id = ?", (post_id,)
+            "SELECT id FROM scheduled_posts WHERE status IN ('pending', 'prepared') "
+            "AND ((scheduled_at >= ? AND scheduled_at <= ?) OR run_requested = 1) "
+            "ORDER BY scheduled_at ASC, id ASC LIMIT ?",
+            (since, now, limit),
         ) as cur:
-            post = await cur.fetchone()
-        if not post or post["status"] != "pending":
-            logger.debug(
-                f"定时任务 #{post_id} 跳过: post={dict(post) if post else None}"
-            )
-            return
+            rows = await cur.fetchall()
+    return [r["id"] for r in rows]
+
+
+async def list_prerender_posts(after: str, until: str, limit: int = 100) -> list[int]:
+    """scheduled_at 落在 (after, until] 内、尚未预渲染的 pending 排期。
+
+    预渲染失败会写入 error 并放回 pending，这里以 error IS NULL 过滤，不反复重试，
+    到点后按完整流程执行。
+    """
+    async with get_db() as db:
+        async with db.execute(
+            "SELECT id FROM scheduled_posts WHERE status = 'pending' "
+            "AND scheduled_at > ? AND scheduled_at <= ? AND error IS NULL "
+            "ORDER BY scheduled_at ASC, id ASC LIMIT ?",
+            (after, until, limit),
+        ) as cur:
+            rows = await cur.fetchall()
+    return [r["id"] for r in rows]
+
+
+async def request_post_run(post_id: int, force: list[str] | None = None) -> list[str] | None:
+    """把 pending/prepared/failed 排期标记为立即执行，由执行引擎或 worker 轮询领取。
+
+    已完成的阶段保留在 post_stages 中，重新执行时从第一个未完成的阶段继续；force 指定的
+    阶段及其下游阶段清除后重新生成。状态检查、阶段清除与状态更新在同一事务中完成，
+    状态不允许执行时不清除任何阶段。返回被清除的阶段，排期状态不允许执行时返回 None。
+    """
+    async with get_db() as db:
+        cur = await db.execute(
+            "UPDATE scheduled_posts SET error = NULL, run_requested = 1 "
+            "WHERE id = ? AND status IN ('pending', 'prepared', 'failed')",
+            (post_id,),
+        )
+        if cur.rowcount == 0:
+            await db.commit()
+            return None
+        dropped = await _reset_stages(db, post_id, force or [])
+        # 清除阶段后按是否仍有 download 阶段重新确定 prepared / pending
         await db.execute(
-            "UPDATE scheduled_posts SET status = 'running' WHERE id = ?", (post_id,)
+            f"UPDATE scheduled_posts SET status = {_PREPARED_STATUS_SQL} WHERE id = ?",
+            (post_id,),
         )
         await db.commit()
+    if "download" in dropped:
+        discard_prepared_images(post_id)
+    if dropped:
+        logger.info(f"排期 #{post_id} 强制重新执行阶段: {dropped}")
+    return dropped
 
-    logger.info(
-        f"定时任务 #{post_id} 开始执行: topic={post['topic']!r}, style={post['style']!r}, image_count={post['image_count']}"
+
+async def expire_pending_posts(
+    before: str, error: str, exclude_ids: list[int] | None = None
+) -> int:
+    """单条 UPDATE 把 scheduled_at 早于 before 的 pending/prepared 排期标记为失败，返回影响行数
+
+    手动请求立即执行（run_requested=1）的排期不受补偿窗口限制；exclude_ids 为已提交
+    执行引擎、正在排队等待 worker 的排期，到点时已在补偿窗口内入队，不因排队过久而过期。
+    """
+    sql = (
+        "UPDATE scheduled_posts SET status = 'failed', error = ? "
+        "WHERE status IN ('pending', 'prepared') AND scheduled_at < ? AND run_requested = 0"
     )
+    params: list = [error, before]
+    if exclude_ids:
+        sql += f" AND id NOT IN ({','.join('?' for _ in exclude_ids)})"
+        params.extend(exclude_ids)
+    async with get_db() as db:
+        cur = await db.execute(sql, params)
+        await db.commit()
+    return cur.rowcount
+
+
+# 列表默认投影：不含 result_body / result_images 等大字段
+_POST_LIST_COLUMNS = (
+    "id, goal_id, account_id, topic, style, aspect_ratio, image_count, "
+    "scheduled_at, ref_image_ids, status, result_title, note_id, error, created_at"
+)
+_POST_HEAVY_COLUMNS = "result_body, result_hashtags, result_images"
 
-    tmp_paths: list[str] = []
+
+def _encode_cursor(scheduled_at: str, post_id: int) -> str:
+    raw = f"{scheduled_at}|{post_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> tuple[str, int]:
     try:
-        # 1. 加载参考图片组
-        ref_images: list[dict] = []
-        ref_image_urls: list[str] = []
-        raw_ref_ids = post["ref_image_ids"] if "ref_image_ids" in post.keys() else "[]"
+        padded = cursor + "=" * (-len(cursor) % 4)
+        scheduled_at, post_id = base64.urlsafe_b64decode(padded).decode().rsplit("|", 1)
+        return scheduled_at, int(post_id)
+    except Exception:
+        raise ValueError(f"无效的分页游标: {cursor!r}")
+
+
+# until 支持的精度：(格式, 下一时段起点)
+_UNTIL_FORMATS = (
+    ("%Y-%m-%d %H:%M", lambda t: t + timedelta(minutes=1)),
+    ("%Y-%m-%d %H", lambda t: t + timedelta(hours=1)),
+    ("%Y-%m-%d", lambda t: t + timedelta(days=1)),
+    ("%Y-%m", lambda t: (t.replace(day=28) + timedelta(days=4)).replace(day=1)),
+)
+
+
+def _until_bound(until: str) -> str:
+    """把 until 换算为 scheduled_at 的开区间上界（下一分钟 / 小时 / 天 / 月的起点）"""
+    for fmt, step in _UNTIL_FORMATS:
         try:
-            ref_ids = json.loads(raw_ref_ids) if raw_ref_ids else []
-        except (json.JSONDecodeError, TypeError):
-            ref_ids = []
-        if ref_ids:
-            from ..services.account_image_service import get_groups_by_ids
-
-            ref_groups = await get_groups_by_ids(ref_ids, account_id=post["account_id"])
-            for g in ref_groups:
-                ref_images.append(
-                    {
-                        "category": g.get("category", "style"),
-                        "original_name": f"图片组({len(g.get('images', []))}张)",
-                        "annotation": g.get("annotation", ""),
-                    }
-                )
-                for img in g.get("images", []):
-                    url = img.get("file_path", "")
-                    if url:
-                        ref_image_urls.append(url)
-            logger.info(
-                f"定时任务 #{post_id} 加载 {len(ref_groups)} 组参考图片, {len(ref_image_urls)} 张参考图URL"
+            t = datetime.strptime(until.strip(), fmt)
+        except ValueError:
+            continue
+        return step(t).strftime("%Y-%m-%d %H:%M")
+    raise ValueError(f"无效的 until: {until!r}")
+
+
+async def query_scheduled_posts(
+    goal_id: int | None = None,
+    account_id: str | None = None,
+    statuses: list[str] | None = None,
+    since: str | None = None,
+    until: str | None = None,
+    cursor: str | None = None,
+    limit: int | None = 50,
+    full: bool = False,
+) -> dict:
+    """按 (scheduled_at, id) 键集分页查询排期。
+
+    since/until 为 scheduled_at 闭区间边界（"%Y-%m-%d %H:%M"，或精确到小时 / 天 / 月的前缀，
+    until 包含该时段内所有时刻），格式无效时抛出 ValueError。
+    total 为过滤条件下的总数（走 scheduled_posts 索引计数），不受游标影响。
+    limit=None 时不分页，返回游标之后的全部记录。
+    返回 {"items": [...], "next_cursor": str | None, "total": int}
+    """
+    where: list[str] = []
+    params: list = []
+    if goal_id is not None:
+        where.append("goal_id = ?")
+        params.append(goal_id)
+    if account_id:
+        where.append("account_id = ?")
+        params.append(account_id)
+    if statuses:
+        where.append(f"status IN ({','.join('?' for _ in statuses)})")
+        params.extend(statuses)
+    if since:
+        where.append("scheduled_at >= ?")
+        params.append(since)
+    if until:
+        # until="2026-02-21" 包含当天所有时刻：换算为下一时段起点的开区间
+        where.append("scheduled_at < ?")
+        params.append(_until_bound(until))
+
+    count_sql = "SELECT COUNT(*) FROM scheduled_posts"
+    if where:
+        count_sql += " WHERE " + " AND ".join(where)
+    count_params = list(params)
+
+    if cursor:
+        after_at, after_id = _decode_cursor(cursor)
+        where.append("(scheduled_at, id) > (?, ?)")
+        params.extend([after_at, after_id])
+
+    columns = _POST_LIST_COLUMNS + (f", {_POST_HEAVY_COLUMNS}" if full else "")
+    sql = f"SELECT {columns} FROM scheduled_posts"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY scheduled_at ASC, id ASC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit + 1)
+
+    async with get_db() as db:
+        async with db.execute(sql, params) as cur:
+            rows = [dict(r) for r in await cur.fetchall()]
+        async with db.execute(count_sql, count_params) as cur:
+            total = (await cur.fetchone())[0]
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = _encode_cursor(last["scheduled_at"], last["id"])
+    return {"items": rows, "next_cursor": next_cursor, "total": total}
+
+
+def _lease_deadline() -> str:
+    return (datetime.now() + timedelta(seconds=LEASE_SECONDS)).strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
+
+
+async def claim_scheduled_post(post_id: int, prepare: bool = False) -> dict | None:
+    """原子地领取排期并写入租约，返回该行；已被其他进程领取时返回 None。
+
+    发布：pending/prepared → running；预渲染（prepare=True）：pending → preparing。
+    PostgreSQL 下使用 FOR UPDATE SKIP LOCKED，并发领取同一行时不阻塞等待。
+    """
+    if prepare:
+        target, source = "preparing", "status = 'pending'"
+    else:
+        target, source = "running", "status IN ('pending', 'prepared')"
+    if is_postgres():
+        sql = (
+            f"UPDATE scheduled_posts SET status = '{target}', lease_owner = ?, lease_until = ?, "
+            "run_requested = 0 "
+            f"WHERE id = (SELECT id FROM scheduled_posts WHERE id = ? AND {source} "
+            "FOR UPDATE SKIP LOCKED) RETURNING *"
+        )
+    else:
+        sql = (
+            f"UPDATE scheduled_posts SET status = '{target}', lease_owner = ?, lease_until = ?, "
+            "run_requested = 0 "
+            f"WHERE id = ? AND {source} RETURNING *"
+        )
+    async with get_db() as db:
+        async with db.execute(sql, (WORKER_ID, _lease_deadline(), post_id)) as cur:
+            row = await cur.fetchone()
+        await db.commit()
+    return dict(row) if row else None
+
+
+async def renew_lease(post_id: int) -> bool:
+    """续约：仅当租约仍属于本进程时延长 lease_until"""
+    async with get_db() as db:
+        cur = await db.execute(
+            "UPDATE scheduled_posts SET lease_until = ? "
+            "WHERE id = ? AND status IN ('running', 'preparing') AND lease_owner = ?",
+            (_lease_deadline(), post_id, WORKER_ID),
+        )
+        await db.commit()
+    return cur.rowcount > 0
+
+
+async def _keep_lease(post_id: int) -> None:
+    while True:
+        await asyncio.sleep(LEASE_SECONDS / 3)
+        try:
+            if not await renew_lease(post_id):
+                logger.warning(f"定时任务 #{post_id} 租约已失效（可能被其他进程回收）")
+                return
+        except Exception as e:
+            logger.warning(f"定时任务 #{post_id} 续约失败: {e}")
+
+
+async def recover_expired_leases() -> list[int]:
+    """把租约过期的 running/preparing 排期（执行进程已退出或失联）放回待执行，返回这些排期 ID
+
+    图片已下载的排期恢复为 prepared。
+    """
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    async with get_db() as db:
+        async with db.execute(
+            "UPDATE scheduled_posts SET lease_owner = NULL, lease_until = NULL, status = "
+            f"{_PREPARED_STATUS_SQL} "
+            "WHERE status IN ('running', 'preparing') AND lease_until < ? RETURNING id",
+            (now,),
+        ) as cur:
+            ids = [r["id"] for r in await cur.fetchall()]
+        await db.commit()
+    if ids:
+        logger.warning(f"回收 {len(ids)} 个租约过期的运行中任务: {ids}")
+    return ids
+
+
+async def get_post_stages(post_id: int) -> dict[str, dict | list]:
+    """读取排期已完成阶段的输出 {stage: output}"""
+    async with get_db() as db:
+        async with db.execute(
+            "SELECT stage, output FROM post_stages WHERE post_id = ?", (post_id,)
+        ) as cur:
+            rows = await cur.fetchall()
+    return {r["stage"]: json.loads(r["output"]) for r in rows}
+
+
+async def list_post_stages(post_id: int) -> list[dict]:
+    """按流水线顺序列出排期各阶段的完成情况，图片 b64 数据只返回是否存在"""
+    async with get_db() as db:
+        async with db.execute(
+            "SELECT stage, output, updated_at FROM post_stages WHERE post_id = ?",
+            (post_id,),
+        ) as cur:
+            rows = {r["stage"]: dict(r) for r in await cur.fetchall()}
+    result = []
+    for stage in POST_STAGES:
+        row = rows.get(stage)
+        output = json.loads(row["output"]) if row else None
+        if stage == "images" and output:
+            output = [
+                {"url": img.get("url"), "has_b64": bool(img.get("b64_json"))}
+                for img in output
+            ]
+        done = row is not None
+        if stage == "images" and row:
+            done = _images_complete(json.loads(row["output"]))
+        result.append(
+            {
+                "stage": stage,
+                "done": done,
+                "updated_at": row["updated_at"] if row else None,
+                "output": output,
+            }
+        )
+    return result
+
+
+# 被用户要求重新生成的图片占位：fresh 标记使重新生成跳过图片结果缓存
+_FRESH_IMAGE = {"url": None, "b64_json": None, "fresh": True}
+
+# 强制重新生成内容 / 提示词时写入的标记行（不属于 POST_STAGES）：重新生成时跳过 LLM 响应缓存，
+# 两个阶段都完成后删除
+_LLM_FRESH_STAGE = "llm_fresh"
+
+
+def _images_complete(images: list[dict] | None) -> bool:
+    return bool(images) and all(img.get("url") or img.get("b64_json") for img in images)
+
+
+_SAVE_STAGE_SQL = """INSERT INTO post_stages (post_id, stage, output, updated_at) VALUES (?, ?, ?, ?)
+               ON CONFLICT (post_id, stage) DO UPDATE SET output = excluded.output,
+               updated_at = excluded.updated_at"""
+
+
+def _stage_row(post_id: int, stage: str, output) -> tuple:
+    return (
+        post_id,
+        stage,
+        json.dumps(output, ensure_ascii=False),
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    )
+
+
+async def _save_stage(post_id: int, stage: str, output) -> None:
+    async with get_db() as db:
+        await db.execute(_SAVE_STAGE_SQL, _stage_row(post_id, stage, output))
+        await db.commit()
+
+
+async def _reset_stages(db, post_id: int, stages: list[str]) -> list[str]:
+    """强制重新生成：在调用方的事务中删除指定阶段及其下游阶段（下游依赖上游输出），返回被清除的阶段"""
+    if not stages:
+        return []
+    start = min(POST_STAGES.index(s) for s in stages)
+    dropped = list(POST_STAGES[start:])
+    deleted = dropped
+    if dropped[0] == "images":
+        # 提示词不变时重新生成的请求与上次相同：图片清空并标记 fresh，跳过图片结果缓存
+        async with db.execute(
+            "SELECT output FROM post_stages WHERE post_id = ? AND stage = 'images'", (post_id,)
+        ) as cur:
+            row = await cur.fetchone()
+        images = json.loads(row["output"]) if row else None
+        if images:
+            await db.execute(
+                _SAVE_STAGE_SQL, _stage_row(post_id, "images", [_FRESH_IMAGE] * len(images))
             )
+            deleted = dropped[1:]
+    elif dropped[0] in ("content", "prompts"):
+        await db.execute(_SAVE_STAGE_SQL, _stage_row(post_id, _LLM_FRESH_STAGE, True))
+    placeholders = ",".join("?" for _ in deleted)
+    await db.execute(
+        f"DELETE FROM post_stages WHERE post_id = ? AND stage IN ({placeholders})",
+        (post_id, *deleted),
+    )
+    return dropped
+
+
+async def reset_post_image(post_id: int, index: int) -> list[dict] | None:
+    """清空 images 阶段中第 index 张（从 0 开始）图片并使下游阶段失效，下次执行只重新生成这一张。
+
+    poster 风格的其余图片保留，重新生成时仍以首图作为风格锚定（清空的是首图时其余图片随之
+    重新生成）；清空的图片标记 fresh，重新生成时跳过图片结果缓存。
+    状态检查（pending/prepared/failed）与阶段清除在同一事务中完成，排期已被领取执行时
+    不清除任何阶段并返回 None；尚未生成图片或序号越界时抛出 ValueError。
+    """
+    async with get_db() as db:
+        # 已预渲染的排期回到 pending，重新预渲染或到点发布时补生成
+        cur = await db.execute(
+            "UPDATE scheduled_posts SET status = CASE WHEN status = 'prepared' THEN 'pending' "
+            "ELSE status END WHERE id = ? AND status IN ('pending', 'prepared', 'failed')",
+            (post_id,),
+        )
+        if cur.rowcount == 0:
+            await db.commit()
+            return None
+        try:
+            async with db.execute(
+                "SELECT output FROM post_stages WHERE post_id = ? AND stage = 'images'",
+                (post_id,),
+            ) as c:
+                row = await c.fetchone()
+            images = json.loads(row["output"]) if row else None
+            if not images:
+                raise ValueError("该排期尚未生成图片")
+            if not 0 <= index < len(images):
+                raise ValueError(f"图片序号超出范围（共 {len(images)} 张）")
+        except ValueError:
+            await db.rollback()
+            raise
+        images[index] = _FRESH_IMAGE
+        await db.execute(_SAVE_STAGE_SQL, _stage_row(post_id, "images", images))
+        await db.execute(
+            "DELETE FROM post_stages WHERE post_id = ? AND stage IN ('download', 'upload')",
+            (post_id,),
+        )
+        await db.commit()
+    discard_prepared_images(post_id)
+    logger.info(f"排期 #{post_id} 第 {index + 1} 张图片已重置，等待重新生成")
+    return images
+
+
+async def delete_post_stages(post_ids: list[int]) -> None:
+    if not post_ids:
+        return
+    async with get_db() as db:
+        await db.executemany(
+            "DELETE FROM post_stages WHERE post_id = ?", [(pid,) for pid in post_ids]
+        )
+        await db.commit()
+    for pid in post_ids:
+        discard_prepared_images(pid)
+
+
+async def _load_refs(post_id: int, post: dict) -> tuple[list[dict], list[str]]:
+    """加载排期的参考图片组，返回 (标注列表, 参考图URL列表)"""
+    ref_images: list[dict] = []
+    ref_image_urls: list[str] = []
+    raw_ref_ids = post["ref_image_ids"] if "ref_image_ids" in post.keys() else "[]"
+    try:
+        ref_ids = json.loads(raw_ref_ids) if raw_ref_ids else []
+    except (json.JSONDecodeError, TypeError):
+        ref_ids = []
+    if ref_ids:
+        from ..services.account_image_service import get_groups_by_ids
+
+        ref_groups = await get_groups_by_ids(ref_ids, account_id=post["account_id"])
+        for g in ref_groups:
+            ref_images.append(
+                {
+                    "category": g.get("category", "style"),
+                    "original_name": f"图片组({len(g.get('images', []))}张)",
+                    "annotation": g.get("annotation", ""),
+                }
+            )
+            for img in g.get("images", []):
+                url = img.get("file_path", "")
+                if url:
+                    ref_image_urls.append(url)
+        logger.info(
+            f"定时任务 #{post_id} 加载 {len(ref_groups)} 组参考图片, {len(ref_image_urls)} 张参考图URL"
+        )
+    return ref_images, ref_image_urls
+
+
+async def _image_deadline(post: dict, priority: int) -> float | None:
+    """图片阶段的截止时间（epoch 秒），由排期的发布时间推算。
+
+    预渲染须在发布时间前完成（来不及则交给到点发布继续）；到点发布须在补偿窗口内完成，
+    手动补跑早已过期的排期时至少保留一次完整请求的时间。
+    """
+    try:
+        slot = datetime.strptime(post["scheduled_at"], "%Y-%m-%d %H:%M").timestamp()
+    except (TypeError, ValueError):
+        return None
+    if priority == PRIORITY_PRERENDER:
+        return slot
+    window = int(await get_setting("catchup_window_minutes") or 0)
+    timeout = float(await get_setting("image_request_timeout") or 360)
+    return max(slot + window * 60, time.time() + timeout)
+
+
+async def _run_generation_stages(
+    post_id: int, post: dict, priority: int = PRIORITY_PUBLISH
+) -> tuple[XHSContent, list[dict], list[str]]:
+    """执行生成阶段 content → prompts → images → download，已完成的阶段直接复用。
+
+    priority 为图片请求的调度优先级（到点发布 / 预渲染）。返回 (content, images, 本地图片路径)。
+    """
+    from ..agent.prompt_agent import build_content_and_prompts, build_image_prompts
+
+    stages = await get_post_stages(post_id)
+    fresh_llm = bool(stages.pop(_LLM_FRESH_STAGE, None))
+    reused = [s for s in POST_STAGES if s in stages]
+    if reused:
+        logger.info(f"定时任务 #{post_id} 复用已完成阶段: {reused}")
+
+    refs: tuple[list[dict], list[str]] | None = None
+    if "prompts" not in stages or "images" not in stages:
+        # 1. 加载参考图片组
+        refs = await _load_refs(post_id, post)
 
-        # 2. 生成文本内容（传入参考图标注影响风格判断）
-        ref_annotations = ref_images if ref_images else None
+    # 2-3. 内容与提示词都未生成时走 build_content_and_prompts（融合模式下一次 LLM 调用完成）
+    if "content" not in stages and "prompts" not in stages:
+        ref_images = refs[0] if refs else []
+        content, prompts, styles = await build_content_and_prompts(
+            post["topic"],
+            post["style"],
+            post["image_count"],
+            ref_images=ref_images if ref_images else None,
+            fresh=fresh_llm,
+        )
+        logger.info(
+            f"定时任务 #{post_id} 文本与提示词生成完成: title={content.title!r}, styles={styles}"
+        )
+        await _save_stage(post_id, "content", content.model_dump())
+        await _save_stage(post_id, "prompts", {"prompts": prompts, "styles": styles})
+        stages["content"] = content.model_dump()
+        stages["prompts"] = {"prompts": prompts, "styles": styles}
+        stages.pop("images", None)
+
+    # 2. 生成文本内容（传入参考图标注影响风格判断）
+    if "content" in stages:
+        content = XHSContent(**stages["content"])
+    else:
+        ref_images = refs[0] if refs else []
         content = await generate_xhs_content(
             post["topic"],
             post["style"],
             post["image_count"],
-            ref_annotations=ref_annotations,
+            ref_annotations=ref_images if ref_images else None,
+            fresh=fresh_llm,
         )
         logger.info(
             f"定时任务 #{post_id} 文本生成完成: title={content.title!r}, image_styles={content.image_styles}"
@@ -268,34 +874,182 @@ async def execute_scheduled_post(post_id: int) -> None:
         logger.debug(
             f"定时任务 #{post_id} 文本详情: body长度={len(content.body)}字, hashtags={content.hashtags}, image_prompts={content.image_prompts}"
         )
+        await _save_stage(post_id, "content", content.model_dump())
+        stages.pop("prompts", None)
 
+    # 3. 提示词优化
+    if "prompts" in stages:
+        prompts, styles = stages["prompts"]["prompts"], stages["prompts"]["styles"]
+    else:
+        ref_images = refs[0] if refs else []
         prompts, styles = await build_image_prompts(
             topic=post["topic"],
             style=post["style"],
             content=content,
             image_count=post["image_count"],
             ref_images=ref_images if ref_images else None,
+            fresh=fresh_llm,
         )
         logger.info(f"定时任务 #{post_id} 提示词生成完成: styles={styles}")
         logger.debug(f"定时任务 #{post_id} 完整提示词: {prompts}")
+        await _save_stage(post_id, "prompts", {"prompts": prompts, "styles": styles})
+        stages.pop("images", None)
 
-        # 3. 生成图片
-        images = await generate_images(
+    if fresh_llm:
+        async with get_db() as db:
+            await db.execute(
+                "DELETE FROM post_stages WHERE post_id = ? AND stage = ?",
+                (post_id, _LLM_FRESH_STAGE),
+            )
+            await db.commit()
+
+    # 4. 生成图片（只生成缺失的序号，已成功的图片保留）
+    if _images_complete(stages.get("images")):
+        images = stages["images"]
+    else:
+        ref_image_urls = refs[1] if refs else []
+        fresh = any(img.get("fresh") for img in stages.get("images") or [])
+        results = await generate_images(
             prompts,
             aspect_ratio=post["aspect_ratio"],
             styles=styles,
             ref_image_urls=ref_image_urls if ref_image_urls else None,
+            existing=[GeneratedImage(**img) for img in stages.get("images") or []],
+            priority=priority,
+            account_id=post["account_id"],
+            deadline=await _image_deadline(post, priority),
+            fresh=fresh,
         )
-        failed = [
-            i + 1 for i, img in enumerate(images) if not img.url and not img.b64_json
+        images = [
+            {"url": img.url, "b64_json": img.b64_json}
+            if img.url or img.b64_json or not fresh
+            else _FRESH_IMAGE
+            for img in results
         ]
+        # 部分失败也保存，重跑时只补生成失败的序号
+        await _save_stage(post_id, "images", images)
+        stages.pop("download", None)
+        failed = [i + 1 for i, img in enumerate(images) if not img["url"] and not img["b64_json"]]
         if failed:
             raise ValueError(f"第 {failed} 张图片生成失败，取消上传")
-        image_urls = [img.url or "" for img in images if img.url]
-        images_json = json.dumps(
-            [{"url": img.url, "b64_json": img.b64_json} for img in images]
+        logger.debug(
+            f"定时任务 #{post_id} 图片生成完成: urls={[img['url'] for img in images if img['url']]}"
         )
-        logger.debug(f"定时任务 #{post_id} 图片生成完成: urls={image_urls}")
+
+    # 5. 下载图片到本地缓存（文件缺失时重新下载）
+    paths = stages.get("download") or []
+    if not paths or not all(os.path.exists(p) for p in paths):
+        # 旧检查点中只有 b64 的图片先解码到本地图片存储，避免上传时被漏掉
+        urls = [img["url"] or await store_b64_image(img["b64_json"]) for img in images]
+        tmp_paths = await asyncio.gather(*[download_image_to_tmp(u) for u in urls])
+        PREPARED_DIR.mkdir(parents=True, exist_ok=True)
+        paths = []
+        for i, tmp in enumerate(tmp_paths):
+            dest = PREPARED_DIR / f"post_{post_id}_{i}{os.path.splitext(tmp)[1]}"
+            await asyncio.to_thread(shutil.move, tmp, dest)
+            paths.append(str(dest))
+        logger.debug(f"定时任务 #{post_id} 图片下载完成: paths={paths}")
+        await _save_stage(post_id, "download", paths)
+
+    return content, images, paths
+
+
+def discard_prepared_images(post_id: int) -> None:
+    """删除排期的本地图片缓存"""
+    for p in PREPARED_DIR.glob(f"post_{post_id}_*"):
+        try:
+            p.unlink()
+        except OSError:
+            pass
+
+
+async def prepare_scheduled_post(post_id: int) -> None:
+    """预渲染：在发布时间前提前执行生成阶段（文本、提示词、图片、下载），状态置为 prepared。
+
+    到点发布时直接上传缓存内容；预渲染失败则放回 pending（已完成的阶段保留），
+    到点从失败的阶段继续执行。预渲染期间到点（或被请求立即执行）的发布任务领取失败，
+    预渲染结束后立即重新提交发布。
+    """
+    post = await claim_scheduled_post(post_id, prepare=True)
+    if not post:
+        logger.debug(f"预渲染 #{post_id} 跳过: 不存在或已被领取")
+        return
+    lease_task = asyncio.create_task(_keep_lease(post_id))
+    logger.info(f"预渲染 #{post_id} 开始: topic={post['topic']!r}, 发布时间 {post['scheduled_at']}")
+
+    try:
+        content, _, paths = await _run_generation_stages(
+            post_id, post, priority=PRIORITY_PRERENDER
+        )
+        async with get_db() as db:
+            cur = await db.execute(
+                "UPDATE scheduled_posts SET status='prepared', error=NULL, "
+                "lease_owner=NULL, lease_until=NULL WHERE id=?",
+                (post_id,),
+            )
+            await db.commit()
+        if cur.rowcount:
+            logger.info(f"预渲染 #{post_id} 完成: {content.title}，缓存 {len(paths)} 张图片")
+    except Exception as e:
+        logger.warning(f"预渲染 #{post_id} 失败，到点将从失败阶段继续执行: {e}")
+        async with get_db() as db:
+            cur = await db.execute(
+                "UPDATE scheduled_posts SET status='pending', error=?, lease_owner=NULL, lease_until=NULL WHERE id=?",
+                (f"预渲染失败: {e}", post_id),
+            )
+            await db.commit()
+    finally:
+        lease_task.cancel()
+    if cur.rowcount == 0:
+        # 预渲染期间排期被重新规划替换（或删除）：清理本次写入的阶段检查点与图片缓存
+        logger.info(f"预渲染 #{post_id} 结束时排期已被替换或删除，丢弃预渲染结果")
+        await delete_post_stages([post_id])
+        return
+    if await _due_for_publish(post_id):
+        logger.info(f"预渲染 #{post_id} 结束时已到发布时间，立即提交发布")
+        await submit_post(post_id)
+
+
+async def _due_for_publish(post_id: int) -> bool:
+    """排期处于可发布状态且已到点（或被请求立即执行）"""
+    async with get_db() as db:
+        async with db.execute(
+            "SELECT scheduled_at, run_requested FROM scheduled_posts "
+            "WHERE id = ? AND status IN ('pending', 'prepared')",
+            (post_id,),
+        ) as cur:
+            row = await cur.fetchone()
+    if not row:
+        return False
+    return bool(row["run_requested"]) or row["scheduled_at"] <= datetime.now().strftime(
+        "%Y-%m-%d %H:%M"
+    )
+
+
+async def execute_scheduled_post(post_id: int) -> None:
+    from ..services.notification_service import get_notification_service
+
+    notification = get_notification_service()
+
+    post = await claim_scheduled_post(post_id)
+    if not post:
+        current = await get_scheduled_post(post_id)
+        if current and current["status"] == "preparing":
+            logger.warning(f"定时任务 #{post_id} 预渲染尚未完成，预渲染结束后立即发布")
+        else:
+            logger.debug(f"定时任务 #{post_id} 跳过: 不存在或已被领取")
+        return
+    lease_task = asyncio.create_task(_keep_lease(post_id))
+
+    logger.info(
+        f"定时任务 #{post_id} 开始执行: topic={post['topic']!r}, style={post['style']!r}, image_count={post['image_count']}"
+    )
+
+    try:
+        # 1-5. 生成阶段（已预渲染或上次执行已完成的阶段直接复用）
+        content, images, upload_paths = await _run_generation_stages(post_id, post)
+        title, body, hashtags = content.title, content.body, content.hashtags
+        images_json = json.dumps(images)
 
         from ..services.account_service import get_cookie
 
@@ -307,37 +1061,46 @@ async def execute_scheduled_post(post_id: int) -> None:
         if not cookie:
             raise ValueError(f"账号 Cookie 不存在 (account_id={account_id!r})")
 
-        # 4. 下载图片到临时文件
-        tmp_paths = await asyncio.gather(
-            *[download_image_to_tmp(u) for u in image_urls if u]
-        )
-        logger.debug(f"定时任务 #{post_id} 图片下载完成: tmp_paths={tmp_paths}")
-
-        # 5. 上传笔记
-        desc = content.body
-        result = await asyncio.to_thread(
-            upload_image_note,
-            cookie,
-            content.title,
-            desc,
-            list(tmp_paths),
-            content.hashtags,
-        )
-        note_id = result.get("note_id") if isinstance(result, dict) else None
-        logger.debug(f"定时任务 #{post_id} 上传结果: {result}")
+        # 6. 上传笔记（上传阶段已完成时不再重复发布，只补写结果）
+        uploaded = (await get_post_stages(post_id)).get("upload")
+        if uploaded is not None:
+            note_id = uploaded.get("note_id")
+            logger.info(f"定时任务 #{post_id} 笔记已上传过 (note_id={note_id})，跳过上传")
+        else:
+            async with upstream_slot("xhs"):
+                result = await asyncio.to_thread(
+                    upload_image_note,
+                    cookie,
+                    title,
+                    body,
+                    upload_paths,
+                    hashtags,
+                )
+            note_id = result.get("note_id") if isinstance(result, dict) else None
+            logger.debug(f"定时任务 #{post_id} 上传结果: {result}")
+            await _save_stage(post_id, "upload", {"note_id": note_id})
 
         async with get_db() as db:
             await db.execute(
                 """UPDATE scheduled_posts SET status='done', result_title=?, result_body=?,
-                   result_images=?, note_id=? WHERE id=?""",
-                (content.title, content.body, images_json, note_id, post_id),
+                   result_hashtags=?, result_images=?, note_id=?, error=NULL,
+                   lease_owner=NULL, lease_until=NULL WHERE id=?""",
+                (
+                    title,
+                    body,
+                    json.dumps(hashtags, ensure_ascii=False),
+                    images_json,
+                    note_id,
+                    post_id,
+                ),
             )
             await db.commit()
-        logger.info(f"定时任务 #{post_id} 发布成功: {content.title}")
+        discard_prepared_images(post_id)
+        logger.info(f"定时任务 #{post_id} 发布成功: {title}")
 
         await notification.send_success_notification(
             "笔记发布成功",
-            f"任务 ID: {post_id}\n标题: {content.title}\n话题: {post['topic']}\n账号: {account_id}",
+            f"任务 ID: {post_id}\n标题: {title}\n话题: {post['topic']}\n账号: {account_id}",
         )
 
     except Exception as e:
@@ -346,7 +1109,7 @@ async def execute_scheduled_post(post_id: int) -> None:
         logger.error(f"定时任务 #{post_id} 失败: {e}\n{traceback.format_exc()}")
         async with get_db() as db:
             await db.execute(
-                "UPDATE scheduled_posts SET status='failed', error=? WHERE id=?",
+                "UPDATE scheduled_posts SET status='failed', error=?, lease_owner=NULL, lease_until=NULL WHERE id=?",
                 (str(e), post_id),
             )
             await db.commit()
@@ -356,8 +1119,4 @@ async def execute_scheduled_post(post_id: int) -> None:
             f"任务 ID: {post_id}\n话题: {post['topic']}\n账号: {post['account_id']}\n失败阶段: {_get_fail_stage(e)}\n错误类型: {type(e).__name__}\n错误详情: {str(e)[:500]}",
         )
     finally:
-        for p in tmp_paths:
-            try:
-                os.unlink(p)
-            except Exception:
-                pass
+        lease_task.cancel()
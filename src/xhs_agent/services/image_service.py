@@ -1,8 +1,23 @@
 import asyncio
+import bisect
+import base64
+import hashlib
+import itertools
+import pathlib
+import json
 import logging
+import os
+import re
+import tempfile
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
 import httpx
-from typing import Literal
+from typing import Awaitable, Callable, Literal
 from ..config import get_setting
+from ..db import DB_PATH
 from ..api.schemas import GeneratedImage
 
 logger = logging.getLogger("xhs_agent")
@@ -34,6 +49,261 @@ _PHOTO_STYLE_PREFIX = (
 _POSTER_STYLE_PREFIX = "海报设计风格，无水印，"
 
 
+# b64 图片解码后的本地存储：文件名为内容 sha256，经 GET /api/images/{name} 访问
+IMAGE_STORE_DIR = DB_PATH.parent / "images"
+IMAGE_STORE_URL_PREFIX = "/api/images/"
+_STORED_NAME_RE = re.compile(r"^[0-9a-f]{64}\.(png|jpg|webp|gif)$")
+_STORED_MIME = {".png": "image/png", ".jpg": "image/jpeg", ".webp": "image/webp", ".gif": "image/gif"}
+# 流式解码块大小（base64 字符数，须为 4 的倍数）
+_B64_CHUNK = 64 * 1024
+
+
+# 图片任务优先级（数值越小越优先）：即将发布 > 预渲染 > 手动预览
+PRIORITY_PUBLISH = 0
+PRIORITY_PRERENDER = 1
+PRIORITY_PREVIEW = 2
+
+_WAIT_SAMPLES = 200
+
+# 请求耗时直方图的桶上界（秒），以及用于估算分位数的最近样本数
+_LATENCY_BUCKETS = (5, 10, 20, 30, 45, 60, 90, 120, 180, 240, 360)
+_LATENCY_SAMPLES = 200
+# 样本数不足时分位数不可靠，不发起对冲请求
+_HEDGE_MIN_SAMPLES = 20
+
+
+@dataclass
+class _Waiter:
+    priority: int
+    seq: int
+    account_id: str
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class _Lane:
+    """单个模型的调度通道：并发上限 + 每分钟请求数上限"""
+
+    def __init__(self, name: str, concurrency: int, rpm: int):
+        self.name = name
+        self.concurrency = max(concurrency, 1)
+        self.rpm = max(rpm, 0)
+        self.waiters: list[_Waiter] = []
+        self.running = 0
+        self.inflight: dict[str, int] = defaultdict(int)
+        self.starts: deque[float] = deque()
+        self.timer: asyncio.TimerHandle | None = None
+        self.granted = 0
+        self.last_granted: dict[str, int] = {}
+        self.waits: deque[float] = deque(maxlen=_WAIT_SAMPLES)
+
+
+class _LatencyStats:
+    """单个 (模型, 尺寸) 的成功请求耗时：累计直方图 + 最近样本（估算 p50/p95）"""
+
+    def __init__(self):
+        self.buckets = [0] * (len(_LATENCY_BUCKETS) + 1)
+        self.samples: deque[float] = deque(maxlen=_LATENCY_SAMPLES)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.buckets[bisect.bisect_left(_LATENCY_BUCKETS, seconds)] += 1
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q: float) -> float | None:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+    def snapshot(self) -> dict:
+        p50, p95 = self.quantile(0.5), self.quantile(0.95)
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 2) if self.count else 0,
+            "p50": round(p50, 2) if p50 is not None else None,
+            "p95": round(p95, 2) if p95 is not None else None,
+            "buckets": {
+                **{f"le_{b}": n for b, n in zip(_LATENCY_BUCKETS, self.buckets)},
+                "inf": self.buckets[-1],
+            },
+        }
+
+
+class ImageScheduler:
+    """进程级图片任务调度器。
+
+    每个模型一条通道，分别限制并发数与 RPM（image_model_limits，缺省使用
+    image_concurrency / image_rpm）；排队任务按优先级放行，同一优先级内优先放行
+    在途请求最少、最久未被放行的账号，避免单个账号的多图任务占满通道。
+    """
+
+    def __init__(self):
+        self._lanes: dict[str, _Lane] = {}
+        self._seq = itertools.count()
+        self._latency: dict[tuple[str, str], _LatencyStats] = {}
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.deadline_exceeded = 0
+
+    async def _lane(self, name: str, overrides: dict | None = None) -> _Lane:
+        lane = self._lanes.get(name)
+        if lane is None:
+            try:
+                limits = json.loads(await get_setting("image_model_limits") or "{}")
+            except json.JSONDecodeError:
+                logger.warning("[ImageScheduler] image_model_limits 不是合法 JSON，使用默认限制")
+                limits = {}
+            conf = {**limits.get(name, {}), **(overrides or {})}
+            concurrency = int(conf.get("concurrency") or await get_setting("image_concurrency") or 1)
+            rpm = int(conf.get("rpm") or await get_setting("image_rpm") or 0)
+            lane = self._lanes.setdefault(name, _Lane(name, concurrency, rpm))
+            logger.info(
+                f"[ImageScheduler] 通道 {name} 并发上限={lane.concurrency}, RPM={lane.rpm or '不限'}"
+            )
+        return lane
+
+    def _pick(self, lane: _Lane) -> _Waiter:
+        top = min(w.priority for w in lane.waiters)
+        return min(
+            (w for w in lane.waiters if w.priority == top),
+            key=lambda w: (
+                lane.inflight.get(w.account_id, 0),
+                lane.last_granted.get(w.account_id, -1),
+                w.seq,
+            ),
+        )
+
+    def _dispatch(self, lane: _Lane) -> None:
+        lane.timer = None
+        now = time.monotonic()
+        while lane.waiters and lane.running < lane.concurrency:
+            if lane.rpm:
+                while lane.starts and now - lane.starts[0] >= 60:
+                    lane.starts.popleft()
+                if len(lane.starts) >= lane.rpm:
+                    delay = 60 - (now - lane.starts[0])
+                    lane.timer = asyncio.get_running_loop().call_later(
+                        delay, self._dispatch, lane
+                    )
+                    return
+            waiter = self._pick(lane)
+            lane.waiters.remove(waiter)
+            if waiter.future.done():
+                continue
+            lane.running += 1
+            lane.inflight[waiter.account_id] += 1
+            lane.starts.append(now)
+            lane.granted += 1
+            lane.last_granted[waiter.account_id] = lane.granted
+            lane.waits.append(now - waiter.enqueued_at)
+            waiter.future.set_result(None)
+
+    def _release(self, lane: _Lane, account_id: str) -> None:
+        lane.running -= 1
+        lane.inflight[account_id] -= 1
+        if lane.inflight[account_id] <= 0:
+            del lane.inflight[account_id]
+        if lane.timer is None:
+            self._dispatch(lane)
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        name: str,
+        priority: int = PRIORITY_PREVIEW,
+        account_id: str = "",
+        limits: dict | None = None,
+    ):
+        """获取通道 name 的请求名额；limits 可覆盖该通道首次创建时的 concurrency / rpm"""
+        lane = await self._lane(name, limits)
+        waiter = _Waiter(
+            priority=priority,
+            seq=next(self._seq),
+            account_id=account_id,
+            future=asyncio.get_running_loop().create_future(),
+        )
+        lane.waiters.append(waiter)
+        if lane.timer is None:
+            self._dispatch(lane)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter in lane.waiters:
+                lane.waiters.remove(waiter)
+            elif waiter.future.done() and not waiter.future.cancelled():
+                # 已获得名额但在恢复执行前被取消，归还名额
+                self._release(lane, account_id)
+            raise
+        try:
+            yield
+        finally:
+            self._release(lane, account_id)
+
+    def concurrency(self, name: str) -> int | None:
+        """通道并发上限，通道尚未创建时返回 None"""
+        lane = self._lanes.get(name)
+        return lane.concurrency if lane else None
+
+    def observe(self, model: str, size: str, seconds: float) -> None:
+        """记录一次成功请求的耗时（不含排队）"""
+        self._latency.setdefault((model, size), _LatencyStats()).observe(seconds)
+
+    def hedge_delay(self, model: str, size: str) -> float | None:
+        """对冲等待时间：该模型与尺寸观测到的 p95，样本不足时返回 None（不对冲）"""
+        stats = self._latency.get((model, size))
+        if stats is None or len(stats.samples) < _HEDGE_MIN_SAMPLES:
+            return None
+        return stats.quantile(0.95)
+
+    def get_metrics(self) -> dict:
+        now = time.monotonic()
+        lanes = {}
+        for name, lane in self._lanes.items():
+            waits = sorted(lane.waits)
+            queued: dict[int, int] = defaultdict(int)
+            for w in lane.waiters:
+                queued[w.priority] += 1
+            lanes[name] = {
+                "concurrency": lane.concurrency,
+                "rpm_limit": lane.rpm,
+                "rpm_used": sum(1 for t in lane.starts if now - t < 60),
+                "running": lane.running,
+                "queued": len(lane.waiters),
+                "queued_by_priority": {
+                    "publish": queued[PRIORITY_PUBLISH],
+                    "prerender": queued[PRIORITY_PRERENDER],
+                    "preview": queued[PRIORITY_PREVIEW],
+                },
+                "inflight_by_account": dict(lane.inflight),
+                "granted": lane.granted,
+                "wait_seconds": {
+                    "samples": len(waits),
+                    "avg": round(sum(waits) / len(waits), 2) if waits else 0,
+                    "p95": round(waits[int(len(waits) * 0.95) - 1], 2) if waits else 0,
+                    "max": round(waits[-1], 2) if waits else 0,
+                },
+            }
+        latency: dict[str, dict] = defaultdict(dict)
+        for (model, size), stats in self._latency.items():
+            latency[model][size] = stats.snapshot()
+        return {
+            "lanes": lanes,
+            "latency_seconds": dict(latency),
+            "hedge": {
+                "fired": self.hedges,
+                "won": self.hedge_wins,
+                "deadline_exceeded": self.deadline_exceeded,
+            },
+        }
+
+
+image_scheduler = ImageScheduler()
+
+
 def _build_photo_prompt(prompt: str) -> str:
     # 若提示词已包含风格关键词，不重复添加前缀
     if any(kw in prompt for kw in ["手机随手误拍", "误拍风格", "生活快照", "手持抖动"]):
@@ -48,71 +318,749 @@ def _build_poster_prompt(prompt: str) -> str:
     return _POSTER_STYLE_PREFIX + prompt
 
 
+_EWMA_ALPHA = 0.2
+# 错误率 EWMA 超过该值（或上游返回 429）视为降级，冷却期内排到健康服务商之后
+_DEGRADED_ERROR_RATE = 0.5
+_DEGRADED_COOLDOWN_SECONDS = 60
+# 即梦组图：参考图 + 生成图合计上限
+_SEQUENTIAL_MAX_IMAGES = 15
+
+
+class _Provider:
+    """一个图片生成服务商：连接配置 + 实时健康度（EWMA 耗时、EWMA 错误率、当日用量）"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.base_url = ""
+        self.api_key = ""
+        self.model = ""
+        self.sizes: dict[str, str] = {}
+        self.daily_quota = 0
+        self.limits: dict = {}
+        self.batch = False
+        self.inflight = 0
+        self.latency: float | None = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.used_today = 0
+        self.quota_day = ""
+        self.cooldown_until = 0.0
+
+    def configure(self, conf: dict) -> None:
+        self.base_url = conf.get("base_url", "")
+        self.api_key = conf.get("api_key", "")
+        self.model = conf.get("model", "")
+        self.sizes = conf.get("sizes") or {}
+        self.daily_quota = int(conf.get("daily_quota") or 0)
+        self.limits = {k: conf[k] for k in ("concurrency", "rpm") if conf.get(k)}
+        # 组图（一次请求生成多张）：即梦 4.x 支持 sequential_image_generation，可用 batch 显式开关
+        batch = conf.get("batch")
+        self.batch = self.model.startswith("doubao-seedream-4") if batch is None else bool(batch)
+
+    def size_for(self, aspect_ratio: str) -> str:
+        return self.sizes.get(aspect_ratio) or _RATIO_TO_SIZE.get(aspect_ratio) or _RATIO_TO_SIZE["3:4"]
+
+    def remaining_quota(self) -> int | None:
+        """当日剩余请求数，未配置 daily_quota 时返回 None（不限）"""
+        if not self.daily_quota:
+            return None
+        today = datetime.now().strftime("%Y-%m-%d")
+        if self.quota_day != today:
+            self.quota_day, self.used_today = today, 0
+        return max(self.daily_quota - self.used_today, 0)
+
+    def available(self, now: float) -> bool:
+        return self.cooldown_until <= now and self.remaining_quota() != 0
+
+    def batch_capacity(self, ref_count: int) -> int:
+        """一次组图请求最多生成的张数（即梦参考图与生成图合计不超过 15 张），不支持组图时为 0"""
+        return max(_SEQUENTIAL_MAX_IMAGES - ref_count, 0) if self.batch else 0
+
+    def build_payload(
+        self,
+        prompt: str,
+        aspect_ratio: str,
+        ref_image_urls: list[str] | None,
+        count: int = 1,
+    ) -> dict:
+        if self.model.startswith("nano-banana"):
+            payload: dict = {
+                "model": self.model,
+                "prompt": prompt,
+                "response_format": "url",
+                "aspect_ratio": aspect_ratio,
+            }
+        else:
+            payload = {
+                "model": self.model,
+                "prompt": prompt,
+                "n": 1,
+                "response_format": "url",
+                "size": self.size_for(aspect_ratio),
+                "watermark": False,
+            }
+            if count > 1:
+                payload["sequential_image_generation"] = "auto"
+                payload["sequential_image_generation_options"] = {"max_images": count}
+        # 两种模型都支持 image 参数传入参考图数组
+        if ref_image_urls:
+            payload["image"] = ref_image_urls
+        return payload
+
+
+class ImageRouter:
+    """多服务商图片路由。
+
+    服务商来自 image_providers（JSON 数组，每项含 name / base_url / api_key / model，
+    可选 sizes、daily_quota、concurrency、rpm）；未配置时退化为 image_api_base_url /
+    image_api_key / image_model 单服务商。每次请求按 EWMA 耗时 × 通道负载 × 错误率 ×
+    剩余额度打分选择服务商，降级（错误率过高或被限流）的服务商冷却期内排到最后。
+    """
+
+    def __init__(self):
+        self._providers: dict[str, _Provider] = {}
+
+    async def providers(self) -> list[_Provider]:
+        try:
+            confs = json.loads(await get_setting("image_providers") or "[]")
+        except json.JSONDecodeError:
+            logger.warning("[ImageRouter] image_providers 不是合法 JSON，使用默认图片服务")
+            confs = []
+        if not confs:
+            model = await get_setting("image_model")
+            confs = [{
+                "name": model,
+                "base_url": await get_setting("image_api_base_url"),
+                "api_key": await get_setting("image_api_key"),
+                "model": model,
+            }]
+        result = []
+        for conf in confs:
+            name = conf.get("name") or conf.get("model", "")
+            provider = self._providers.get(name)
+            if provider is None:
+                provider = self._providers.setdefault(name, _Provider(name))
+            provider.configure(conf)
+            result.append(provider)
+        return result
+
+    def _score(self, provider: _Provider, fallback_latency: float) -> float:
+        latency = provider.latency if provider.latency is not None else fallback_latency
+        capacity = image_scheduler.concurrency(provider.name) or int(
+            provider.limits.get("concurrency") or 1
+        )
+        score = latency * (1 + provider.inflight / capacity) * (1 + 4 * provider.error_rate)
+        remaining = provider.remaining_quota()
+        if remaining is not None:
+            score *= 2 - remaining / provider.daily_quota
+        return score
+
+    async def rank(self) -> list[_Provider]:
+        """按优先顺序返回服务商：健康的按得分升序，降级/额度用尽的按冷却结束时间排在最后"""
+        providers = await self.providers()
+        now = time.monotonic()
+        known = [p.latency for p in providers if p.latency is not None]
+        # 没有耗时样本的服务商按已知最快的估算，保证新服务商能分到流量
+        fallback = min(known, default=1.0)
+        healthy = [p for p in providers if p.available(now)]
+        degraded = [p for p in providers if not p.available(now)]
+        healthy.sort(key=lambda p: self._score(p, fallback))
+        degraded.sort(key=lambda p: p.cooldown_until)
+        return healthy + degraded
+
+    def spawn(self, provider: _Provider, request: Awaitable[GeneratedImage]) -> asyncio.Task:
+        """启动发往 provider 的请求任务，并立即计入在途数（含排队），使并发的路由决策互相可见"""
+        provider.inflight += 1
+        task = asyncio.create_task(request)
+
+        def _done(_: asyncio.Task) -> None:
+            provider.inflight -= 1
+
+        task.add_done_callback(_done)
+        return task
+
+    def record_start(self, provider: _Provider) -> None:
+        provider.requests += 1
+        provider.remaining_quota()
+        provider.used_today += 1
+
+    def record_success(self, provider: _Provider, seconds: float) -> None:
+        if provider.latency is None:
+            provider.latency = seconds
+        else:
+            provider.latency += _EWMA_ALPHA * (seconds - provider.latency)
+        provider.error_rate *= 1 - _EWMA_ALPHA
+
+    def record_failure(self, provider: _Provider, error: Exception) -> None:
+        provider.errors += 1
+        provider.error_rate += _EWMA_ALPHA * (1 - provider.error_rate)
+        throttled = (
+            isinstance(error, httpx.HTTPStatusError)
+            and error.response.status_code == 429
+        )
+        if throttled or provider.error_rate >= _DEGRADED_ERROR_RATE:
+            provider.cooldown_until = time.monotonic() + _DEGRADED_COOLDOWN_SECONDS
+            logger.warning(
+                f"[ImageRouter] 服务商 {provider.name} 降级 {_DEGRADED_COOLDOWN_SECONDS}s"
+                f"（错误率={provider.error_rate:.2f}{', 被限流' if throttled else ''}）"
+            )
+
+    def get_metrics(self) -> list[dict]:
+        now = time.monotonic()
+        return [
+            {
+                "name": p.name,
+                "model": p.model,
+                "ewma_latency": round(p.latency, 2) if p.latency is not None else None,
+                "error_rate": round(p.error_rate, 3),
+                "inflight": p.inflight,
+                "requests": p.requests,
+                "errors": p.errors,
+                "remaining_quota": p.remaining_quota(),
+                "degraded": p.cooldown_until > now,
+            }
+            for p in self._providers.values()
+        ]
+
+
+image_router = ImageRouter()
+
+
+def _sniff_ext(head: bytes) -> str:
+    if head.startswith(b"\xff\xd8"):
+        return ".jpg"
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return ".webp"
+    if head.startswith(b"GIF8"):
+        return ".gif"
+    return ".png"
+
+
+def _store_b64_sync(b64: str) -> str:
+    IMAGE_STORE_DIR.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    head = b""
+    fd, tmp = tempfile.mkstemp(dir=IMAGE_STORE_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            # 分块解码，避免一次性生成与 b64 字符串同样大小的 bytes 副本；
+            # 去掉换行等空白后不足 4 字符对齐的尾部留到下一块，最后一块按需补齐 "="
+            carry = ""
+            for start in range(0, len(b64), _B64_CHUNK):
+                text = carry + "".join(b64[start : start + _B64_CHUNK].split())
+                if start + _B64_CHUNK >= len(b64):
+                    text, carry = text + "=" * (-len(text) % 4), ""
+                else:
+                    cut = len(text) - len(text) % 4
+                    text, carry = text[:cut], text[cut:]
+                if not text:
+                    continue
+                chunk = base64.b64decode(text)
+                if not head:
+                    head = chunk[:16]
+                digest.update(chunk)
+                f.write(chunk)
+        name = digest.hexdigest() + _sniff_ext(head)
+        dest = IMAGE_STORE_DIR / name
+        if dest.exists():
+            # 相同内容已存在：刷新修改时间，避免被按保留期清理
+            os.unlink(tmp)
+            os.utime(dest)
+        else:
+            os.replace(tmp, dest)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return IMAGE_STORE_URL_PREFIX + name
+
+
+async def store_b64_image(b64: str) -> str:
+    """把 b64 图片解码写入本地图片存储（按内容哈希去重），返回 /api/images/{name} 地址"""
+    return await asyncio.to_thread(_store_b64_sync, b64)
+
+
+def stored_image_path(url: str | None) -> pathlib.Path | None:
+    """/api/images/{name} 地址对应的本地文件路径，不是本地存储地址时返回 None"""
+    if not url or not url.startswith(IMAGE_STORE_URL_PREFIX):
+        return None
+    name = url[len(IMAGE_STORE_URL_PREFIX):]
+    if not _STORED_NAME_RE.match(name):
+        return None
+    return IMAGE_STORE_DIR / name
+
+
+def _stored_data_uri_sync(path: pathlib.Path) -> str:
+    data = base64.b64encode(path.read_bytes()).decode("ascii")
+    return f"data:{_STORED_MIME.get(path.suffix, 'image/png')};base64,{data}"
+
+
+async def _anchor_ref(img: GeneratedImage) -> str | None:
+    """poster 首图作为参考图传给服务商的地址。
+
+    服务商只能拉取绝对 http(s) 地址；b64 结果落盘后是相对的 /api/images/ 地址，
+    以本地文件内容内联为 data URI。两者都不可用时返回 None（不做锚定）。
+    """
+    if img.url and img.url.startswith(("http://", "https://")):
+        return img.url
+    path = stored_image_path(img.url)
+    if path is not None and path.exists():
+        return await asyncio.to_thread(_stored_data_uri_sync, path)
+    if img.b64_json:
+        return f"data:image/png;base64,{img.b64_json}"
+    return None
+
+
+def prune_stored_images(max_age_days: int) -> int:
+    """删除超过 max_age_days 天未修改的本地存储图片，返回删除数"""
+    if not IMAGE_STORE_DIR.exists():
+        return 0
+    cutoff = time.time() - max_age_days * 86400
+    removed = 0
+    for p in IMAGE_STORE_DIR.iterdir():
+        try:
+            if p.stat().st_mtime < cutoff:
+                p.unlink()
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+async def _materialize(images: list[GeneratedImage]) -> list[GeneratedImage]:
+    """b64 结果解码落盘，只保留地址：b64 不进入数据库、接口响应与缓存"""
+    result = []
+    for img in images:
+        if img.b64_json:
+            url = img.url or await store_b64_image(img.b64_json)
+            img = GeneratedImage(url=url)
+        result.append(img)
+    return result
+
+
+def _parse_images(data: dict) -> list[GeneratedImage]:
+    """把服务商响应归一化为 GeneratedImage 列表（OpenAI 兼容的 data[].url / b64_json），
+    组图中生成失败的条目保留为空图片，保持与提示词的顺序对应"""
+    return [
+        GeneratedImage(url=item.get("url"), b64_json=item.get("b64_json"))
+        for item in data.get("data") or []
+    ]
+
+
+def _parse_image(data: dict) -> GeneratedImage:
+    images = _parse_images(data)
+    if not images or not _is_ok(images[0]):
+        raise ValueError(f"响应中没有图片: {str(data)[:200]}")
+    return images[0]
+
+
+async def _request(
+    provider: _Provider,
+    payload: dict,
+    stats_key: str,
+    deadline: float | None,
+    priority: int,
+    account_id: str,
+    started: asyncio.Event | None = None,
+) -> tuple[dict, float]:
+    """排队获取服务商通道名额后发起一次生成请求，超时取单次上限与剩余预算的较小值。
+
+    返回 (响应 JSON, 耗时)，耗时计入 stats_key 对应的耗时统计；失败计入服务商健康度。
+    """
+    async with image_scheduler.slot(provider.name, priority, account_id, provider.limits):
+        if started is not None:
+            started.set()
+        timeout = float(await get_setting("image_request_timeout") or 360)
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.time())
+            if timeout <= 0:
+                image_scheduler.deadline_exceeded += 1
+                raise TimeoutError("图片生成已超出截止时间")
+        image_router.record_start(provider)
+        t0 = time.monotonic()
+        try:
+            async with httpx.AsyncClient(timeout=timeout) as client:
+                response = await client.post(
+                    f"{provider.base_url}/images/generations",
+                    headers={
+                        "Authorization": f"Bearer {provider.api_key}",
+                        "Content-Type": "application/json",
+                    },
+                    json=payload,
+                )
+            if not response.is_success:
+                logger.error(
+                    f"[{provider.name}] 图片生成失败 {response.status_code}: {response.text[:500]}"
+                )
+            response.raise_for_status()
+            if not response.text.strip():
+                raise ValueError(f"图片生成 API 返回空响应，prompt 前30字: {payload['prompt'][:30]}")
+            data = response.json()
+            if not any(_is_ok(img) for img in _parse_images(data)):
+                raise ValueError(f"响应中没有图片: {str(data)[:200]}")
+        except Exception as e:
+            if isinstance(e, httpx.TimeoutException) and deadline is not None and time.time() >= deadline:
+                image_scheduler.deadline_exceeded += 1
+            image_router.record_failure(provider, e)
+            raise
+        elapsed = time.monotonic() - t0
+        image_scheduler.observe(provider.name, stats_key, elapsed)
+    return data, elapsed
+
+
+async def _post_image(
+    provider: _Provider,
+    prompt: str,
+    aspect_ratio: str,
+    ref_image_urls: list[str] | None,
+    deadline: float | None,
+    priority: int,
+    account_id: str,
+    started: asyncio.Event | None = None,
+) -> GeneratedImage:
+    """向指定服务商请求生成一张图片"""
+    payload = provider.build_payload(prompt, aspect_ratio, ref_image_urls)
+    data, elapsed = await _request(
+        provider,
+        payload,
+        provider.size_for(aspect_ratio),
+        deadline,
+        priority,
+        account_id,
+        started,
+    )
+    image_router.record_success(provider, elapsed)
+    image = (await _materialize([_parse_image(data)]))[0]
+    logger.debug(f"[ImageAPI] {provider.name} 生成成功，url={image.url}")
+    return image
+
+
+async def _post_batch(
+    provider: _Provider,
+    prompts: list[str],
+    aspect_ratio: str,
+    ref_image_urls: list[str] | None,
+    deadline: float | None,
+    priority: int,
+    account_id: str,
+) -> list[GeneratedImage]:
+    """一次请求生成多张图片（组图），按提示词顺序返回，缺失或失败的位置为空图片"""
+    payload = provider.build_payload(
+        _build_batch_prompt(prompts), aspect_ratio, ref_image_urls, count=len(prompts)
+    )
+    data, elapsed = await _request(
+        provider,
+        payload,
+        f"{provider.size_for(aspect_ratio)}*{len(prompts)}",
+        deadline,
+        priority,
+        account_id,
+    )
+    # 服务商健康度按单张图片的平均耗时计，组图耗时单独统计
+    image_router.record_success(provider, elapsed / len(prompts))
+    images = await _materialize(_parse_images(data)[: len(prompts)])
+    return images + [GeneratedImage() for _ in range(len(prompts) - len(images))]
+
+
+def _build_batch_prompt(prompts: list[str]) -> str:
+    lines = [f"生成一组共{len(prompts)}张图片，每张图片独立成图，依次为："]
+    lines += [f"图{i + 1}：{p}" for i, p in enumerate(prompts)]
+    return "\n".join(lines)
+
+
+async def _hedged_post(
+    primary: _Provider,
+    backup: _Provider,
+    prompt: str,
+    aspect_ratio: str,
+    ref_image_urls: list[str] | None,
+    deadline: float | None,
+    priority: int,
+    account_id: str,
+) -> GeneratedImage:
+    """对冲请求：主请求开始后超过该服务商与尺寸的 p95 仍未返回时，向 backup（次优服务商，
+    只有一个服务商时为其自身）再发一个相同请求，取先成功的结果并取消另一个。
+    历史样本不足或 image_hedge=0 时只发一次。"""
+    started = asyncio.Event()
+    # 选定服务商后立即发起主请求（中间不让出事件循环），在途数才能反映到下一次路由
+    first = image_router.spawn(
+        primary,
+        _post_image(
+            primary, prompt, aspect_ratio, ref_image_urls, deadline, priority, account_id, started
+        ),
+    )
+    tasks = {first}
+    try:
+        size = primary.size_for(aspect_ratio)
+        delay = None
+        if (await get_setting("image_hedge") or "0") != "0":
+            delay = image_scheduler.hedge_delay(primary.name, size)
+        if delay is not None:
+            waiter = asyncio.create_task(started.wait())
+            await asyncio.wait({first, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            if not first.done():
+                await asyncio.wait({first}, timeout=delay)
+            # 剩余预算不足一个 p95 时对冲也来不及，不再加压上游
+            if not first.done() and (deadline is None or deadline - time.time() > delay):
+                image_scheduler.hedges += 1
+                logger.info(
+                    f"[ImageAPI] {primary.name} {size} 请求超过 p95={delay:.1f}s 未返回，"
+                    f"向 {backup.name} 发起对冲请求"
+                )
+                tasks.add(
+                    image_router.spawn(
+                        backup,
+                        _post_image(
+                            backup, prompt, aspect_ratio, ref_image_urls, deadline, priority, account_id
+                        ),
+                    )
+                )
+
+        error: BaseException | None = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not first:
+                        image_scheduler.hedge_wins += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# 结果缓存条目上限（超出后淘汰最久未使用的）
+_CACHE_MAX_ENTRIES = 256
+
+
+class _ImageCache:
+    """相同图片请求的合并与结果缓存。
+
+    进行中的相同请求共享一次上游调用（singleflight），成功结果按请求哈希缓存
+    image_cache_ttl_seconds 秒；失败不缓存。
+    """
+
+    def __init__(self):
+        self._entries: OrderedDict[str, tuple[float, GeneratedImage]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key: str) -> GeneratedImage | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, image = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return image
+
+    def put(self, key: str, image: GeneratedImage, ttl: float) -> None:
+        if not _is_ok(image):
+            return
+        self._entries[key] = (time.monotonic() + ttl, image)
+        self._entries.move_to_end(key)
+        while len(self._entries) > _CACHE_MAX_ENTRIES:
+            self._entries.popitem(last=False)
+
+    async def run(
+        self, key: str, ttl: float, call: Callable[[], Awaitable[GeneratedImage]]
+    ) -> GeneratedImage:
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            # 上游调用不绑定在任何一个调用方上：某个调用方取消时，其余调用方仍能拿到结果
+            task = asyncio.create_task(call())
+            self._inflight[key] = task
+
+            def _done(t: asyncio.Task) -> None:
+                self._inflight.pop(key, None)
+                if not t.cancelled() and t.exception() is None:
+                    self.put(key, t.result(), ttl)
+
+            task.add_done_callback(_done)
+        return await asyncio.shield(task)
+
+    def get_metrics(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": round((self.hits + self.coalesced) / lookups, 3) if lookups else 0,
+        }
+
+
+image_cache = _ImageCache()
+
+
+async def _cache_ttl(fresh: bool) -> float:
+    """结果缓存有效期（秒），fresh（用户要求重新生成）或未开启缓存时为 0"""
+    if fresh:
+        return 0
+    return float(await get_setting("image_cache_ttl_seconds") or 0)
+
+
+async def _request_key(
+    prompt: str, aspect_ratio: str, ref_image_urls: list[str] | None
+) -> str:
+    """请求哈希：服务商配置 + 归一化提示词（合并空白）+ 宽高比 + 参考图（顺序有意义，保持原序）"""
+    providers = await image_router.providers()
+    raw = json.dumps(
+        {
+            "providers": sorted(f"{p.name}:{p.model}" for p in providers),
+            "prompt": " ".join(prompt.split()),
+            "aspect_ratio": aspect_ratio,
+            "refs": ref_image_urls or [],
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
 async def _call_image_api(
     prompt: str,
-    size: str,
     aspect_ratio: str,
     ref_image_urls: list[str] | None = None,
+    priority: int = PRIORITY_PREVIEW,
+    account_id: str = "",
+    deadline: float | None = None,
+    fresh: bool = False,
 ) -> GeneratedImage:
-    base_url = await get_setting("image_api_base_url")
-    api_key = await get_setting("image_api_key")
-    model = await get_setting("image_model")
+    """生成一张图片：相同请求合并为一次调用并复用缓存结果，fresh=True 时跳过缓存"""
+    ttl = await _cache_ttl(fresh)
+    if ttl <= 0:
+        return await _route_image(
+            prompt, aspect_ratio, ref_image_urls, priority, account_id, deadline
+        )
+    key = await _request_key(prompt, aspect_ratio, ref_image_urls)
+    return await image_cache.run(
+        key,
+        ttl,
+        lambda: _route_image(
+            prompt, aspect_ratio, ref_image_urls, priority, account_id, deadline
+        ),
+    )
+
 
+async def _route_image(
+    prompt: str,
+    aspect_ratio: str,
+    ref_image_urls: list[str] | None,
+    priority: int,
+    account_id: str,
+    deadline: float | None,
+) -> GeneratedImage:
+    """经 image_router 选择服务商生成一张图片，失败时按顺序切换到下一个服务商"""
+    ranked = await image_router.rank()
     logger.debug(
-        f"[ImageAPI] 请求参数: model={model!r}, size={size!r}, aspect_ratio={aspect_ratio!r}, prompt长度={len(prompt)}字, 参考图={len(ref_image_urls or [])}张"
+        f"[ImageAPI] 请求参数: 服务商顺序={[p.name for p in ranked]}, aspect_ratio={aspect_ratio!r}, prompt长度={len(prompt)}字, 参考图={len(ref_image_urls or [])}张"
     )
     logger.debug(f"[ImageAPI] 完整提示词: {prompt}")
-
-    is_nano_banana = model.startswith("nano-banana")
-    if is_nano_banana:
-        payload: dict = {
-            "model": model,
-            "prompt": prompt,
-            "response_format": "url",
-            "aspect_ratio": aspect_ratio,
-        }
-    else:
-        payload = {
-            "model": model,
-            "prompt": prompt,
-            "n": 1,
-            "response_format": "url",
-            "size": size,
-            "watermark": False,
-        }
-
-    # 两种模型都支持 image 参数传入参考图数组
     if ref_image_urls:
-        payload["image"] = ref_image_urls
         logger.debug(f"[ImageAPI] 传入参考图: {[u[:60] for u in ref_image_urls]}")
 
-    async with httpx.AsyncClient(timeout=360.0) as client:
-        response = await client.post(
-            f"{base_url}/images/generations",
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-            },
-            json=payload,
+    error: Exception | None = None
+    for i, provider in enumerate(ranked):
+        backup = ranked[i + 1] if i + 1 < len(ranked) else provider
+        try:
+            return await _hedged_post(
+                provider, backup, prompt, aspect_ratio, ref_image_urls, deadline, priority, account_id
+            )
+        except Exception as e:
+            error = e
+            if deadline is not None and time.time() >= deadline:
+                break
+            if i + 1 < len(ranked):
+                logger.warning(f"[ImageRouter] {provider.name} 请求失败，切换到 {backup.name}: {e}")
+    raise error
+
+
+async def _call_image_batch(
+    prompts: list[str],
+    aspect_ratio: str,
+    ref_image_urls: list[str] | None,
+    priority: int,
+    account_id: str,
+    deadline: float | None,
+) -> list[GeneratedImage] | None:
+    """选择支持组图的服务商，一次请求生成多张图片。
+
+    image_batch=0、没有可用的组图服务商或请求失败时返回 None，由调用方逐张生成。
+    """
+    if (await get_setting("image_batch") or "0") == "0":
+        return None
+    ranked = await image_router.rank()
+    now = time.monotonic()
+    ref_count = len(ref_image_urls or [])
+    provider = next(
+        (
+            p for p in ranked
+            if p.available(now) and p.batch_capacity(ref_count) >= len(prompts)
+        ),
+        None,
+    )
+    if provider is None:
+        return None
+    logger.info(f"[ImageAPI] {provider.name} 组图请求一次生成 {len(prompts)} 张")
+    try:
+        return await image_router.spawn(
+            provider,
+            _post_batch(
+                provider, prompts, aspect_ratio, ref_image_urls, deadline, priority, account_id
+            ),
         )
-        if not response.is_success:
-            logger.error(f"图片生成失败 {response.status_code}: {response.text[:500]}")
-        response.raise_for_status()
+    except Exception as e:
+        logger.warning(f"[ImageAPI] {provider.name} 组图请求失败，改为逐张生成: {e}")
+        return None
 
-    raw = response.text
-    if not raw.strip():
-        logger.error(f"图片生成 API 返回空响应，prompt 前30字: {prompt[:30]}")
-        return GeneratedImage()
 
-    data = response.json()
-    items = data.get("data", [])
-    if not items:
-        logger.warning(f"[ImageAPI] 响应 data 为空: {data}")
+def _is_ok(img: GeneratedImage) -> bool:
+    return bool(img.url or img.b64_json)
+
+
+def _vary_prompt(prompt: str, attempt: int) -> str:
+    """重试时给提示词加入变化，避免上游对同一请求重复返回失败"""
+    if attempt == 0:
+        return prompt
+    return f"{prompt}，画面构图与细节做出变化（变体{attempt}）"
+
+
+async def _safe_call(
+    label: str,
+    prompt: str,
+    aspect_ratio: str,
+    ref_image_urls: list[str] | None,
+    priority: int,
+    account_id: str,
+    deadline: float | None,
+    fresh: bool,
+) -> GeneratedImage:
+    try:
+        return await _call_image_api(
+            prompt, aspect_ratio, ref_image_urls, priority, account_id, deadline, fresh
+        )
+    except Exception as e:
+        logger.error(f"{label}图片生成失败: {e}")
         return GeneratedImage()
-    item = items[0]
-    url = item.get("url")
-    logger.debug(f"[ImageAPI] 生成成功，url={url}")
-    return GeneratedImage(url=url, b64_json=item.get("b64_json"))
 
 
 async def generate_images(
@@ -120,15 +1068,30 @@ async def generate_images(
     aspect_ratio: str = "3:4",
     styles: list[ImageStyle] | None = None,
     ref_image_urls: list[str] | None = None,
+    existing: list[GeneratedImage] | None = None,
+    priority: int = PRIORITY_PREVIEW,
+    account_id: str = "",
+    deadline: float | None = None,
+    fresh: bool = False,
+    on_image: Callable[[int, GeneratedImage], None] | None = None,
 ) -> list[GeneratedImage]:
-    """生成多张图片。poster 风格串行生成（第1张结果作为后续参考图保持风格一致），photo 风格并发生成。"""
+    """生成多张图片。photo 风格优先用组图请求一次生成（服务商支持时），其余并发逐张生成；
+    poster 风格先生成第1张作为风格锚定，第2~N张只依赖首图，随后以 poster_concurrency 为上限并发生成。
+
+    只生成失败（或 existing 中为空）的序号，成功的图片原样保留；失败的序号按
+    image_retry_attempts 配置带提示词变化重试。poster 模式下首图已存在时继续作为风格锚定；
+    首图重试后仍失败则不生成后续图片，首图重新生成时已保留的后续图片随之重新生成。
+    所有请求经 image_scheduler 按 priority 排队，并按 account_id 在账号间公平分配。
+    deadline（epoch 秒）为每张图片的总截止时间：单次请求超时不超过剩余预算，过期后不再重试。
+    相同请求复用 image_cache 的结果；fresh=True（用户要求重新生成）时跳过缓存。
+    on_image(index, image) 在每张图片成功生成（或命中缓存）时立即回调，供流式接口逐张推送。
+    """
     if not prompts:
         return []
 
-    size = _RATIO_TO_SIZE.get(aspect_ratio)
-    if not size:
-        logger.warning(f"不支持的宽高比 {aspect_ratio!r}，使用默认 3:4")
-        size = _RATIO_TO_SIZE["3:4"]
+    if aspect_ratio not in _RATIO_TO_SIZE:
+        # 宽高比原样传给服务商：size 由 _Provider.size_for 按服务商 sizes 配置选择，未配置时回退 3:4 尺寸
+        logger.warning(f"宽高比 {aspect_ratio!r} 没有默认尺寸，未配置 sizes 的服务商使用 3:4 尺寸")
 
     if not styles:
         styles = ["photo"] * len(prompts)
@@ -143,47 +1106,126 @@ async def generate_images(
     unified_style = styles[0] if styles else "photo"
     is_poster = unified_style == "poster"
 
-    if is_poster:
-        images: list[GeneratedImage] = []
-        base_ref_urls = list(ref_image_urls) if ref_image_urls else []
-        first_result_url: str | None = None
-        for i, prompt in enumerate(built_prompts):
-            current_refs = list(base_ref_urls)
-            if first_result_url:
-                current_refs.append(first_result_url)
+    images = list(existing or [])[: len(built_prompts)]
+    images += [GeneratedImage() for _ in range(len(built_prompts) - len(images))]
+    todo = [i for i, img in enumerate(images) if not _is_ok(img)]
+    if existing and todo:
+        logger.info(f"[ImageAPI] 保留已成功的图片，仅生成第 {[i + 1 for i in todo]} 张")
+
+    def _notify(i: int) -> None:
+        if on_image and _is_ok(images[i]):
+            on_image(i, images[i])
+
+    retries = int(await get_setting("image_retry_attempts") or 0)
+    base_ref_urls = list(ref_image_urls) if ref_image_urls else []
+    # poster 首图锚定的参考图地址，首图生成完成后设置
+    anchor_ref: str | None = None
+
+    async def _generate(i: int, attempt: int) -> GeneratedImage:
+        current_refs = list(base_ref_urls)
+        anchor_url = anchor_ref if is_poster and i > 0 else None
+        if anchor_url:
+            current_refs.append(anchor_url)
+        if is_poster:
             logger.info(
-                f"[ImageAPI] poster 串行生成第 {i + 1}/{len(built_prompts)} 张, "
+                f"[ImageAPI] poster 生成第 {i + 1}/{len(built_prompts)} 张, "
                 f"参考图: 总管AI={len(base_ref_urls)}张"
-                + (f" + 首图风格锚定=1张" if first_result_url else "")
+                + (f" + 首图风格锚定=1张" if anchor_url else "")
             )
-            result = await _call_image_api(
-                prompt,
-                size,
-                aspect_ratio,
-                ref_image_urls=current_refs if current_refs else None,
-            )
-            images.append(result)
-            if i == 0 and result.url:
-                first_result_url = result.url
-                logger.debug(
-                    f"[ImageAPI] 首图生成完成，后续将以此为风格锚定: {result.url}"
+        return await _safe_call(
+            f"第{i + 1}张",
+            _vary_prompt(built_prompts[i], attempt),
+            aspect_ratio,
+            current_refs if current_refs else None,
+            priority,
+            account_id,
+            deadline,
+            fresh,
+        )
+
+    async def _fill(indices: list[int], limit: int) -> None:
+        """以 limit 为并发上限生成指定序号的图片，失败的序号带提示词变化重试，最多 image_retry_attempts 次"""
+        sem = asyncio.Semaphore(max(limit, 1))
+
+        async def _bounded(i: int, attempt: int) -> GeneratedImage:
+            async with sem:
+                images[i] = await _generate(i, attempt)
+            _notify(i)
+            return images[i]
+
+        pending = [i for i in indices if not _is_ok(images[i])]
+        for attempt in range(retries + 1):
+            if not pending:
+                return
+            if attempt and deadline is not None and time.time() >= deadline:
+                logger.warning(
+                    f"[ImageAPI] 第 {[i + 1 for i in pending]} 张图片已超出截止时间，不再重试"
+                )
+                return
+            if attempt:
+                logger.warning(
+                    f"[ImageAPI] 第 {[i + 1 for i in pending]} 张图片生成失败，第 {attempt}/{retries} 次重试"
                 )
-        return images
+            results = await asyncio.gather(*[_bounded(i, attempt) for i in pending])
+            for i, result in zip(pending, results):
+                images[i] = result
+            pending = [i for i in pending if not _is_ok(images[i])]
+
+    if is_poster:
+        # 首图是后续图片的风格锚定，先单独生成（含重试）
+        if 0 in todo:
+            await _fill([0], limit=1)
+            if not _is_ok(images[0]):
+                logger.warning("[ImageAPI] poster 首图生成失败，不再生成依赖其风格锚定的后续图片")
+                return images
+            logger.debug(f"[ImageAPI] 首图生成完成，后续将以此为风格锚定: {images[0].url}")
+            # 首图换了：保留下来的后续图片锚定的是旧首图，一并重新生成
+            kept = [i for i in range(1, len(images)) if i not in todo]
+            if kept:
+                logger.info(f"[ImageAPI] 首图已重新生成，第 {[i + 1 for i in kept]} 张随之重新生成")
+                for i in kept:
+                    images[i] = GeneratedImage()
+                todo = sorted(set(todo) | set(kept))
+        anchor_ref = await _anchor_ref(images[0])
+        # 第2~N张互不依赖，只依赖首图：一轮并发生成
+        rest = [i for i in todo if i > 0]
+        if rest:
+            limit = int(await get_setting("poster_concurrency") or 1)
+            logger.info(f"[ImageAPI] poster 并发生成第 {[i + 1 for i in rest]} 张，并发上限 {limit}")
+            await _fill(rest, limit=limit)
     else:
-        tasks = [
-            _call_image_api(p, size, aspect_ratio, ref_image_urls)
-            for p in built_prompts
-        ]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-
-        images = []
-        for i, result in enumerate(results):
-            if isinstance(result, Exception):
-                logger.error(f"第{i + 1}张图片生成失败: {result}")
-                images.append(GeneratedImage())
-            else:
-                images.append(result)
-        return images
+        # 照片互不依赖：支持组图的服务商一次请求生成全部缺失的图片，未成功的序号再逐张生成
+        ttl = await _cache_ttl(fresh)
+        keys: dict[int, str] = {}
+        if ttl > 0 and len(todo) > 1:
+            # 组图前先取缓存命中的序号，只为未命中的序号发组图请求
+            for i in todo:
+                keys[i] = await _request_key(built_prompts[i], aspect_ratio, base_ref_urls or None)
+                cached = image_cache.get(keys[i])
+                if cached is not None:
+                    image_cache.hits += 1
+                    images[i] = cached
+                    _notify(i)
+        batch_todo = [i for i in todo if not _is_ok(images[i])]
+        if len(batch_todo) > 1:
+            batch = await _call_image_batch(
+                [built_prompts[i] for i in batch_todo],
+                aspect_ratio,
+                base_ref_urls or None,
+                priority,
+                account_id,
+                deadline,
+            )
+            if batch:
+                for i, img in zip(batch_todo, batch):
+                    images[i] = img
+                    if i in keys:
+                        image_cache.put(keys[i], img, ttl)
+                    _notify(i)
+                ok = sum(1 for img in batch if _is_ok(img))
+                logger.info(f"[ImageAPI] 组图请求成功生成 {ok}/{len(batch_todo)} 张")
+        await _fill(todo, limit=len(todo))
+    return images
 
 
 async def generate_image(
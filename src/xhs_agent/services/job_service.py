@@ -0,0 +1,327 @@
+"""
+异步任务（手动生成 / 上传）
+
+/api/generate、/api/upload 会在整条链路执行期间占住 HTTP 请求（图片超时可达数分钟），
+代理或浏览器超时后客户端重试又会再跑一遍。任务接口改为：
+
+  - POST /api/jobs 立即返回任务 ID，任务写入 jobs 表后提交执行引擎（与排期共享并发上限）
+  - 执行进度与结果写回 jobs 表，任意 API 进程都能通过轮询或 SSE 读取
+  - 相同 Idempotency-Key 的重复提交返回已有任务，不会重复占用生成 / 上传资源
+
+API-only 进程只写入 queued 任务，由 worker 轮询领取；执行进程失联导致租约过期时，
+生成任务重新排队，上传任务标记失败（结果未知，避免重复发布）。
+上传任务只按 account_id 在执行时读取 cookie，cookie 不写入 jobs 表。
+"""
+
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+from ..db import get_db, is_postgres
+from ..api.schemas import GenerateRequest
+from ..agent.xhs_agent import run_stream
+from .account_service import get_cookie
+from .execution_service import engine, upstream_slot
+from .goal_service import LEASE_SECONDS, WORKER_ID
+from .upload_service import download_image_to_tmp, upload_image_note
+
+logger = logging.getLogger("xhs_agent")
+
+_FINISHED = ("done", "failed")
+
+# 不写入 jobs 表、不对外返回的任务参数
+_SECRET_PARAMS = ("cookie",)
+
+
+class IdempotencyConflict(Exception):
+    """同一 Idempotency-Key 已用于参数不同的任务"""
+
+
+def _now() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _lease_deadline() -> str:
+    return (datetime.now() + timedelta(seconds=LEASE_SECONDS)).strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
+
+
+def _to_job(row) -> dict:
+    job = dict(row)
+    params = json.loads(job.pop("params") or "{}")
+    job["params"] = {k: v for k, v in params.items() if k not in _SECRET_PARAMS}
+    job["progress"] = json.loads(job["progress"] or "{}")
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    job.pop("lease_owner", None)
+    job.pop("lease_until", None)
+    return job
+
+
+async def create_job(
+    kind: str, params: dict, idempotency_key: str | None = None
+) -> tuple[dict, bool]:
+    """写入 queued 任务，返回 (job, created)。
+
+    idempotency_key 已存在时返回原任务（created=False）；参数不同则抛出 IdempotencyConflict。
+    上传任务必须带 account_id（cookie 不落库），否则抛出 ValueError。
+    """
+    if kind == "upload" and not params.get("account_id"):
+        raise ValueError("异步上传任务需要提供 account_id")
+    params = {k: v for k, v in params.items() if k not in _SECRET_PARAMS}
+    raw = json.dumps(params, ensure_ascii=False, sort_keys=True)
+    now = _now()
+    async with get_db() as db:
+        cur = await db.execute(
+            "INSERT INTO jobs (kind, idempotency_key, params, status, progress, created_at, updated_at) "
+            "VALUES (?, ?, ?, 'queued', '{}', ?, ?) ON CONFLICT (idempotency_key) DO NOTHING",
+            (kind, idempotency_key, raw, now, now),
+        )
+        created = cur.rowcount > 0
+        await db.commit()
+        if created and not idempotency_key:
+            job_id = cur.lastrowid
+            async with db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)) as c:
+                row = await c.fetchone()
+        else:
+            async with db.execute(
+                "SELECT * FROM jobs WHERE idempotency_key = ?", (idempotency_key,)
+            ) as c:
+                row = await c.fetchone()
+    if not created and (row["kind"] != kind or row["params"] != raw):
+        raise IdempotencyConflict(
+            f"Idempotency-Key {idempotency_key!r} 已用于参数不同的任务 #{row['id']}"
+        )
+    if created:
+        logger.info(f"[Job] 新建 {kind} 任务 #{row['id']}")
+    else:
+        logger.info(f"[Job] Idempotency-Key {idempotency_key!r} 命中已有任务 #{row['id']}")
+    return _to_job(row), created
+
+
+async def get_job(job_id: int) -> dict | None:
+    async with get_db() as db:
+        async with db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)) as cur:
+            row = await cur.fetchone()
+    return _to_job(row) if row else None
+
+
+async def _list_queued_jobs() -> list[tuple[int, str, dict]]:
+    async with get_db() as db:
+        async with db.execute(
+            "SELECT id, kind, params FROM jobs WHERE status = 'queued' ORDER BY id"
+        ) as cur:
+            rows = await cur.fetchall()
+    return [(r["id"], r["kind"], json.loads(r["params"])) for r in rows]
+
+
+async def _claim_job(job_id: int) -> dict | None:
+    """原子地把 queued 任务置为 running 并写入租约；已被其他进程领取时返回 None"""
+    if is_postgres():
+        sql = (
+            "UPDATE jobs SET status = 'running', lease_owner = ?, lease_until = ?, updated_at = ? "
+            "WHERE id = (SELECT id FROM jobs WHERE id = ? AND status = 'queued' "
+            "FOR UPDATE SKIP LOCKED) RETURNING *"
+        )
+    else:
+        sql = (
+            "UPDATE jobs SET status = 'running', lease_owner = ?, lease_until = ?, updated_at = ? "
+            "WHERE id = ? AND status = 'queued' RETURNING *"
+        )
+    async with get_db() as db:
+        async with db.execute(sql, (WORKER_ID, _lease_deadline(), _now(), job_id)) as cur:
+            row = await cur.fetchone()
+        await db.commit()
+    return dict(row) if row else None
+
+
+async def _save_progress(job_id: int, progress: dict) -> None:
+    """写入进度并顺带续约"""
+    async with get_db() as db:
+        await db.execute(
+            "UPDATE jobs SET progress = ?, updated_at = ?, lease_until = ? "
+            "WHERE id = ? AND lease_owner = ?",
+            (
+                json.dumps(progress, ensure_ascii=False),
+                _now(),
+                _lease_deadline(),
+                job_id,
+                WORKER_ID,
+            ),
+        )
+        await db.commit()
+
+
+async def _finish_job(
+    job_id: int, status: str, result: dict | None = None, error: str | None = None
+) -> None:
+    async with get_db() as db:
+        await db.execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ?, "
+            "lease_owner = NULL, lease_until = NULL WHERE id = ?",
+            (
+                status,
+                json.dumps(result, ensure_ascii=False) if result is not None else None,
+                error,
+                _now(),
+                job_id,
+            ),
+        )
+        await db.commit()
+
+
+async def _keep_lease(job_id: int) -> None:
+    while True:
+        await asyncio.sleep(LEASE_SECONDS / 3)
+        try:
+            async with get_db() as db:
+                await db.execute(
+                    "UPDATE jobs SET lease_until = ? "
+                    "WHERE id = ? AND status = 'running' AND lease_owner = ?",
+                    (_lease_deadline(), job_id, WORKER_ID),
+                )
+                await db.commit()
+        except Exception as e:
+            logger.warning(f"[Job] 任务 #{job_id} 续约失败: {e}")
+
+
+async def _run_generate(job_id: int, params: dict) -> dict:
+    request = GenerateRequest(**params)
+    progress: dict = {
+        "stage": "content",
+        "content": {},
+        "images": [None] * request.image_count,
+    }
+    result = None
+    async for item in run_stream(request):
+        event, data = item["event"], item["data"]
+        if event in ("title", "body", "hashtags"):
+            progress["content"][event] = data
+        elif event == "content":
+            progress["content"] = data
+            progress["stage"] = "prompts"
+        elif event == "prompts":
+            progress["stage"] = "images"
+        elif event == "image":
+            progress["images"][data.pop("index")] = data
+        elif event == "done":
+            result = data
+            continue
+        elif event == "error":
+            raise RuntimeError(data["detail"])
+        await _save_progress(job_id, progress)
+    if result is None:
+        raise RuntimeError("生成流程未返回结果")
+    return result
+
+
+async def _run_upload(job_id: int, params: dict) -> dict:
+    cookie = await get_cookie(params.get("account_id") or "")
+    if not cookie:
+        raise ValueError("账号不存在")
+
+    image_urls = params.get("image_urls") or []
+    await _save_progress(job_id, {"stage": "download", "images": len(image_urls)})
+    tmp_paths: list[str] = []
+    try:
+        tmp_paths = await asyncio.gather(*[download_image_to_tmp(u) for u in image_urls])
+        await _save_progress(job_id, {"stage": "upload", "images": len(image_urls)})
+        async with upstream_slot("xhs"):
+            result = await asyncio.to_thread(
+                upload_image_note,
+                cookie,
+                params["title"],
+                params["desc"],
+                list(tmp_paths),
+                params.get("hashtags") or [],
+            )
+    finally:
+        for p in tmp_paths:
+            try:
+                os.unlink(p)
+            except Exception:
+                pass
+    note_id = result.get("note_id") if isinstance(result, dict) else None
+    return {"success": True, "note_id": note_id, "detail": ""}
+
+
+async def run_job(job_id: int) -> None:
+    """领取并执行任务，结果 / 错误写回 jobs 表"""
+    row = await _claim_job(job_id)
+    if row is None:
+        logger.info(f"[Job] 任务 #{job_id} 已被领取或已结束，跳过")
+        return
+    params = json.loads(row["params"])
+    logger.info(f"[Job] 开始执行 {row['kind']} 任务 #{job_id}")
+    lease_task = asyncio.create_task(_keep_lease(job_id))
+    try:
+        if row["kind"] == "generate":
+            result = await _run_generate(job_id, params)
+        else:
+            result = await _run_upload(job_id, params)
+        await _finish_job(job_id, "done", result=result)
+        logger.info(f"[Job] 任务 #{job_id} 完成")
+    except Exception as e:
+        logger.error(f"[Job] 任务 #{job_id} 失败: {e}")
+        await _finish_job(job_id, "failed", error=str(e))
+    finally:
+        lease_task.cancel()
+
+
+async def submit_job(job_id: int, kind: str, params: dict) -> bool:
+    """提交执行引擎：上传与该账号的排期串行，生成任务各自独立排队"""
+    account_id = params.get("account_id") if kind == "upload" else None
+    return await engine.submit(
+        f"job_{job_id}",
+        account_id or f"job:{job_id}",
+        lambda: run_job(job_id),
+    )
+
+
+async def dispatch_queued_jobs() -> int:
+    """worker 轮询：把 queued 任务提交执行引擎（API-only 进程创建的任务由此被执行）"""
+    count = 0
+    for job_id, kind, params in await _list_queued_jobs():
+        if await submit_job(job_id, kind, params):
+            count += 1
+    return count
+
+
+async def recover_expired_jobs() -> list[int]:
+    """租约过期的 running 任务：生成任务放回 queued（随后由 dispatch_queued_jobs 重新提交），
+    上传任务无法确认是否已发布，标记失败由用户确认后重新提交。返回重新排队的任务 ID。"""
+    now = _now()
+    async with get_db() as db:
+        async with db.execute(
+            "UPDATE jobs SET status = 'queued', lease_owner = NULL, lease_until = NULL, updated_at = ? "
+            "WHERE kind = 'generate' AND status = 'running' AND lease_until < ? RETURNING id",
+            (now, now),
+        ) as cur:
+            requeued = [r["id"] for r in await cur.fetchall()]
+        async with db.execute(
+            "UPDATE jobs SET status = 'failed', error = ?, lease_owner = NULL, lease_until = NULL, "
+            "updated_at = ? WHERE kind = 'upload' AND status = 'running' AND lease_until < ? RETURNING id",
+            ("执行进程中断，上传结果未知，请确认笔记是否已发布后重新提交", now, now),
+        ) as cur:
+            failed = [r["id"] for r in await cur.fetchall()]
+        await db.commit()
+    if requeued or failed:
+        logger.warning(f"[Job] 回收租约过期任务：重新排队 {requeued}，标记失败 {failed}")
+    return requeued
+
+
+async def delete_finished_jobs(retention_days: int) -> int:
+    """删除超过保留期的已结束任务"""
+    cutoff = (datetime.now() - timedelta(days=retention_days)).strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
+    placeholders = ",".join("?" for _ in _FINISHED)
+    async with get_db() as db:
+        cur = await db.execute(
+            f"DELETE FROM jobs WHERE status IN ({placeholders}) AND updated_at < ?",
+            (*_FINISHED, cutoff),
+        )
+        await db.commit()
+    return cur.rowcount
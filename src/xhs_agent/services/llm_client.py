@@ -0,0 +1,488 @@
+"""
+共享 LLM 客户端（OpenAI 兼容 /chat/completions）
+
+text_service / prompt_agent / manager_service / vision_service 统一经由这里调用：
+  - 进程内复用一个 httpx.AsyncClient 连接池（keep-alive），不再每次调用新建连接
+  - 429 / 5xx / 网络错误按指数退避 + 随机抖动重试（llm_retry_attempts），优先遵守 Retry-After；
+    等待期间释放 upstream_slot("llm") 名额
+  - chat_json 解析结构化输出：去掉 ```json 包裹、截取 JSON 主体、修复尾随逗号，
+    仍无法解析或校验失败时带错误信息追问一次
+  - 按调用点（site）记录次数、重试、修复、token 用量与耗时（get_metrics）
+  - 可选的持久化响应缓存（llm_cache_ttl 按调用点配置 TTL，默认关闭）：相同模型、消息与参数的
+    请求直接返回上次的输出；fresh=True 时跳过读取缓存（仍写入新结果）
+"""
+
+import asyncio
+import email.utils
+import hashlib
+import json
+import logging
+import random
+import re
+import time
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+from typing import Any, Callable, TypeVar
+
+import httpx
+
+from ..config import get_setting
+from ..db import get_db
+from .execution_service import upstream_slot
+
+logger = logging.getLogger("xhs_agent")
+
+T = TypeVar("T")
+
+_RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+_BACKOFF_BASE = 1.0
+_BACKOFF_MAX = 30.0
+_RETRY_AFTER_MAX = 60.0
+_LATENCY_SAMPLES = 200
+
+_FENCE_RE = re.compile(r"```(?:json)?\s*([\s\S]+?)\s*```")
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+_CACHE_EVICT_EVERY = 20
+
+_REPAIR_PROMPT = (
+    "上一次的输出无法使用：{error}\n"
+    "请只输出修正后的完整 JSON 对象，不要包含任何解释或 Markdown 代码块。"
+)
+
+
+class _SiteStats:
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.repairs = 0
+        self.cache_hits = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latencies: deque[float] = deque(maxlen=_LATENCY_SAMPLES)
+
+
+_stats: dict[str, _SiteStats] = defaultdict(_SiteStats)
+
+
+class _Rejected(Exception):
+    """输出未通过 accept 校验，携带原始输出供追问修正"""
+
+    def __init__(self, content: str, error: Exception):
+        super().__init__(str(error))
+        self.content = content
+        self.error = error
+
+
+class LLMCache:
+    """LLM 响应缓存，存于 llm_cache 表（SQLite / PostgreSQL 与业务数据同库）。
+
+    键为模型、消息（去掉首尾空白与行尾空格）与生成参数的 sha256；只缓存通过校验的输出。
+    每 _CACHE_EVICT_EVERY 次写入清理一次过期条目，并按写入时间从旧到新淘汰超出
+    llm_cache_max_mb 的部分。
+    """
+
+    def __init__(self):
+        self._ttl_raw: str | None = None
+        self._ttls: dict[str, int] = {}
+        self._puts = 0
+
+    async def ttl(self, site: str) -> int:
+        raw = await get_setting("llm_cache_ttl") or "{}"
+        if raw != self._ttl_raw:
+            try:
+                self._ttls = {k: int(v) for k, v in json.loads(raw).items()}
+            except (ValueError, TypeError, AttributeError):
+                logger.warning(f"[LLM] llm_cache_ttl 配置无效，缓存关闭: {raw!r}")
+                self._ttls = {}
+            self._ttl_raw = raw
+        return self._ttls.get(site, 0)
+
+    @staticmethod
+    def key(payload: dict) -> str:
+        def norm(content):
+            if isinstance(content, str):
+                return "\n".join(line.rstrip() for line in content.strip().splitlines())
+            return content
+
+        messages = [{**m, "content": norm(m.get("content"))} for m in payload["messages"]]
+        raw = json.dumps({**payload, "messages": messages}, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> tuple[str, str] | None:
+        """返回未过期条目的 (response, created_at)"""
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        async with get_db() as db:
+            async with db.execute(
+                "SELECT response, created_at FROM llm_cache WHERE key = ? AND expires_at > ?",
+                (key, now),
+            ) as cur:
+                row = await cur.fetchone()
+        return (row["response"], row["created_at"]) if row else None
+
+    async def put(self, key: str, site: str, response: str, ttl: int) -> None:
+        now = datetime.now()
+        async with get_db() as db:
+            await db.execute(
+                "INSERT INTO llm_cache (key, site, response, size, created_at, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+                "response = excluded.response, size = excluded.size, "
+                "created_at = excluded.created_at, expires_at = excluded.expires_at",
+                (
+                    key,
+                    site,
+                    response,
+                    len(response.encode("utf-8")),
+                    now.strftime("%Y-%m-%d %H:%M:%S"),
+                    (now + timedelta(seconds=ttl)).strftime("%Y-%m-%d %H:%M:%S"),
+                ),
+            )
+            await db.commit()
+        self._puts += 1
+        if self._puts % _CACHE_EVICT_EVERY == 1:
+            await self.evict()
+
+    async def evict(self) -> int:
+        """删除过期条目，并从最旧的开始淘汰超出容量上限的条目，返回删除条数"""
+        max_bytes = int(float(await get_setting("llm_cache_max_mb") or 0) * 1024 * 1024)
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        async with get_db() as db:
+            cur = await db.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (now,))
+            removed = max(cur.rowcount, 0)
+            async with db.execute(
+                "SELECT key, size FROM llm_cache ORDER BY created_at DESC"
+            ) as c:
+                rows = await c.fetchall()
+            total, stale = 0, []
+            for row in rows:
+                total += row["size"]
+                if max_bytes > 0 and total > max_bytes:
+                    stale.append((row["key"],))
+            if stale:
+                await db.executemany("DELETE FROM llm_cache WHERE key = ?", stale)
+            await db.commit()
+        removed += len(stale)
+        if removed:
+            logger.info(f"[LLM] 响应缓存清理 {removed} 条（过期或超出 {max_bytes // 1048576}MB 上限）")
+        return removed
+
+
+llm_cache = LLMCache()
+
+_client: httpx.AsyncClient | None = None
+_client_loop: asyncio.AbstractEventLoop | None = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    """进程内共享的连接池；事件循环变化（如测试中多次 asyncio.run）时重建"""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=60.0,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        )
+        _client_loop = loop
+    return _client
+
+
+async def close_llm_client() -> None:
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+
+def _retry_after(response: httpx.Response | None) -> float | None:
+    """解析 Retry-After（秒数或 HTTP 日期）"""
+    value = response.headers.get("retry-after") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff(attempt: int, response: httpx.Response | None) -> float:
+    retry_after = _retry_after(response)
+    if retry_after is not None:
+        return min(retry_after, _RETRY_AFTER_MAX)
+    # full jitter：在 [0, base*2^n] 内随机，避免多个任务同时重试
+    return random.uniform(0, min(_BACKOFF_MAX, _BACKOFF_BASE * 2**attempt))
+
+
+def _retryable(e: Exception) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in _RETRY_STATUS
+    return isinstance(e, httpx.TransportError)
+
+
+async def _endpoint(model: str | None) -> tuple[str, dict, str]:
+    base_url = await get_setting("siliconflow_base_url")
+    api_key = await get_setting("siliconflow_api_key")
+    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+    return f"{base_url}/chat/completions", headers, model or await get_setting("text_model")
+
+
+def _record(site: str, elapsed: float, usage: dict | None) -> None:
+    st = _stats[site]
+    st.latencies.append(elapsed)
+    if usage:
+        st.prompt_tokens += int(usage.get("prompt_tokens") or 0)
+        st.completion_tokens += int(usage.get("completion_tokens") or 0)
+    logger.debug(
+        f"[LLM] {site} 完成 {elapsed:.2f}s, tokens="
+        f"{(usage or {}).get('prompt_tokens')}/{(usage or {}).get('completion_tokens')}"
+    )
+
+
+async def _with_retries(site: str, send: Callable[[], Any]):
+    """执行一次请求，可重试的错误按退避策略重试；每次尝试单独占用 LLM 上游名额"""
+    attempts = int(await get_setting("llm_retry_attempts") or 0)
+    st = _stats[site]
+    st.calls += 1
+    for attempt in range(attempts + 1):
+        try:
+            async with upstream_slot("llm"):
+                return await send()
+        except Exception as e:
+            if attempt >= attempts or not _retryable(e):
+                st.failures += 1
+                raise
+            response = e.response if isinstance(e, httpx.HTTPStatusError) else None
+            delay = _backoff(attempt, response)
+            st.retries += 1
+            reason = f"HTTP {response.status_code}" if response is not None else e.__class__.__name__
+            logger.warning(
+                f"[LLM] {site} 请求失败（{reason}），{delay:.1f}s 后第 {attempt + 1}/{attempts} 次重试"
+            )
+            await asyncio.sleep(delay)
+
+
+async def _complete(
+    messages: list[dict],
+    site: str,
+    accept: Callable[[str], T],
+    *,
+    model: str | None = None,
+    temperature: float = 0.7,
+    max_tokens: int = 2048,
+    json_mode: bool = False,
+    timeout: float = 60.0,
+    fresh: bool = False,
+    cache_as: list[dict] | None = None,
+    cache_info: dict | None = None,
+) -> T:
+    """一次非流式对话：accept 校验 / 转换输出（不合格时抛出 _Rejected），合格的输出写入缓存。
+
+    cache_as 指定缓存键使用的消息（默认为 messages）：追问修正时仍按原始请求缓存修正后的输出，
+    提示词含易变内容（如当前时间）时由调用方传入归一化后的消息。
+    cache_info 不为 None 时，命中缓存会写入 {"created_at": 原响应的缓存时间}，
+    供输出与时间相关的调用方校正重放结果。
+    """
+    url, headers, model = await _endpoint(model)
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+    }
+    if json_mode:
+        payload["response_format"] = {"type": "json_object"}
+
+    ttl = await llm_cache.ttl(site)
+    key = llm_cache.key({**payload, "messages": cache_as or messages}) if ttl > 0 else None
+    if key and not fresh:
+        hit = await llm_cache.get(key)
+        if hit is not None:
+            cached, created_at = hit
+            try:
+                result = accept(cached)
+            except Exception as e:
+                logger.debug(f"[LLM] {site} 缓存内容校验失败，重新请求: {e}")
+            else:
+                _stats[site].cache_hits += 1
+                if cache_info is not None:
+                    cache_info["created_at"] = created_at
+                logger.debug(f"[LLM] {site} 命中响应缓存 {key[:12]}")
+                return result
+
+    async def send() -> str:
+        t0 = time.monotonic()
+        response = await _get_client().post(url, headers=headers, json=payload, timeout=timeout)
+        response.raise_for_status()
+        data = response.json()
+        _record(site, time.monotonic() - t0, data.get("usage"))
+        return data["choices"][0]["message"]["content"]
+
+    content = await _with_retries(site, send)
+    logger.debug(f"[LLM] {site} 原始响应: {content}")
+    try:
+        result = accept(content)
+    except Exception as e:
+        raise _Rejected(content, e) from e
+    if key:
+        await llm_cache.put(key, site, content, ttl)
+    return result
+
+
+async def chat(messages: list[dict], *, site: str, **kwargs) -> str:
+    """一次非流式对话，返回 choices[0].message.content。
+
+    kwargs：model / temperature / max_tokens / json_mode / timeout / fresh（跳过读取响应缓存）
+    """
+    return await _complete(messages, site, lambda content: content, **kwargs)
+
+
+async def chat_stream(
+    messages: list[dict],
+    *,
+    site: str,
+    on_delta: Callable[[str], None],
+    model: str | None = None,
+    temperature: float = 0.7,
+    max_tokens: int = 2048,
+    json_mode: bool = False,
+    timeout: float = 60.0,
+) -> str:
+    """流式对话：每收到一段增量内容回调 on_delta，返回完整内容。
+
+    只有在尚未收到任何内容时才重试，已回调过的增量不会重复推送。
+    """
+    url, headers, model = await _endpoint(model)
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": True,
+    }
+    if json_mode:
+        payload["response_format"] = {"type": "json_object"}
+    parts: list[str] = []
+
+    async def send() -> str:
+        t0 = time.monotonic()
+        usage = None
+        async with _get_client().stream(
+            "POST", url, headers=headers, json=payload, timeout=timeout
+        ) as response:
+            if not response.is_success:
+                await response.aread()
+            response.raise_for_status()
+            try:
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    chunk = line[5:].strip()
+                    if chunk == "[DONE]":
+                        break
+                    data = json.loads(chunk)
+                    usage = data.get("usage") or usage
+                    choices = data.get("choices") or []
+                    delta = (choices[0].get("delta") or {}).get("content") if choices else None
+                    if delta:
+                        parts.append(delta)
+                        on_delta(delta)
+            except httpx.TransportError as e:
+                if parts:
+                    # 已推送部分内容，重试会导致内容重复，直接失败
+                    raise RuntimeError(f"LLM 流式输出中断: {e}") from e
+                raise
+        _record(site, time.monotonic() - t0, usage)
+        return "".join(parts)
+
+    content = await _with_retries(site, send)
+    logger.debug(f"[LLM] {site} 流式原始响应: {content}")
+    return content
+
+
+def parse_json(text: str) -> Any:
+    """宽松解析模型输出中的 JSON：去掉 Markdown 代码块、截取首个 JSON 主体、修复尾随逗号"""
+    text = text.strip()
+    match = _FENCE_RE.search(text)
+    if match:
+        text = match.group(1)
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        raise ValueError("输出中没有 JSON 对象")
+    start = min(starts)
+    end = text.rfind("}" if text[start] == "{" else "]")
+    if end <= start:
+        raise ValueError("JSON 对象不完整")
+    body = _TRAILING_COMMA_RE.sub(r"\1", text[start : end + 1])
+    return json.loads(body)
+
+
+async def chat_json(
+    messages: list[dict],
+    *,
+    site: str,
+    validate: Callable[[Any], T] | None = None,
+    json_mode: bool = True,
+    cache_as: list[dict] | None = None,
+    **kwargs,
+) -> T:
+    """对话并解析 JSON 输出；validate 对解析结果做结构校验 / 转换（抛异常表示不合格）。
+
+    输出无法解析或校验失败时，把原输出与错误信息附在对话后追问一次；仍失败则抛出。
+    只有通过校验的输出才会写入响应缓存；cache_as 为计算缓存键使用的消息（默认为 messages）。
+    """
+
+    def accept(content: str):
+        parsed = parse_json(content)
+        return validate(parsed) if validate else parsed
+
+    try:
+        return await _complete(
+            messages, site, accept, json_mode=json_mode, cache_as=cache_as, **kwargs
+        )
+    except _Rejected as r:
+        content, error = r.content, f"{r.error.__class__.__name__}: {str(r.error)[:300]}"
+    _stats[site].repairs += 1
+    logger.warning(f"[LLM] {site} 输出不合格（{error}），追问修正")
+
+    retry_messages = messages + [
+        {"role": "assistant", "content": content},
+        {"role": "user", "content": _REPAIR_PROMPT.format(error=error)},
+    ]
+    # 追问不读缓存，修正后的输出按原始请求写入缓存
+    kwargs["fresh"] = True
+    try:
+        return await _complete(
+            retry_messages, site, accept, json_mode=json_mode, cache_as=cache_as or messages, **kwargs
+        )
+    except _Rejected as r:
+        raise r.error
+
+
+def get_metrics() -> dict:
+    sites = {}
+    for site, st in _stats.items():
+        lat = sorted(st.latencies)
+        sites[site] = {
+            "calls": st.calls,
+            "failures": st.failures,
+            "retries": st.retries,
+            "repairs": st.repairs,
+            "cache_hits": st.cache_hits,
+            "prompt_tokens": st.prompt_tokens,
+            "completion_tokens": st.completion_tokens,
+            "latency_seconds": {
+                "samples": len(lat),
+                "avg": round(sum(lat) / len(lat), 2) if lat else 0,
+                "p95": round(lat[int(len(lat) * 0.95) - 1], 2) if lat else 0,
+                "max": round(lat[-1], 2) if lat else 0,
+            },
+        }
+    return {"sites": sites}
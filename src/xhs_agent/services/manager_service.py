@@ -1,9 +1,8 @@
 import json
 import logging
 import asyncio
-import httpx
 from datetime import datetime, timedelta
-from ..config import get_setting
+from .llm_client import chat_json
 
 logger = logging.getLogger("xhs_agent")
 
@@ -136,8 +135,9 @@ async def plan_operation(
     cookie: str,
     user_id: str = "",
     account_id: str = "",
+    fresh: bool = False,
 ) -> dict:
-    """调用总管 AI 分析运营目标 + 账号历史数据，生成发布计划"""
+    """调用总管 AI 分析运营目标 + 账号历史数据，生成发布计划；fresh=True 时跳过 LLM 响应缓存"""
     account_data = await fetch_account_stats(cookie, user_id=user_id)
     stats_summary = _summarize_stats(account_data)
 
@@ -163,53 +163,86 @@ async def plan_operation(
             )
             image_section = "\n".join(lines)
 
+    now = datetime.now()
     user_prompt = (
         f"运营目标：{goal_title}\n"
         f"详细描述：{goal_desc}\n"
         f"主要风格：{style}\n"
         f"每日发布频率：{post_freq} 篇\n"
-        f"当前时间：{datetime.now().strftime('%Y-%m-%d %H:%M')}（星期{['一', '二', '三', '四', '五', '六', '日'][datetime.now().weekday()]}）\n\n"
+        f"当前时间：{now.strftime('%Y-%m-%d %H:%M')}（星期{['一', '二', '三', '四', '五', '六', '日'][now.weekday()]}）\n\n"
         f"账号近期数据：\n{stats_summary}"
         f"{image_section}\n\n"
         "请结合以上数据，制定未来7天的内容发布计划。"
     )
 
-    base_url = await get_setting("siliconflow_base_url")
-    api_key = await get_setting("siliconflow_api_key")
-    model = await get_setting("text_model")
-
-    logger.debug(f"[ManagerAI] 请求参数: model={model!r}, goal={goal_title!r}")
+    logger.debug(f"[ManagerAI] 请求参数: goal={goal_title!r}")
     logger.debug(f"[ManagerAI] system_prompt:\n{MANAGER_SYSTEM_PROMPT}")
     logger.debug(f"[ManagerAI] user_prompt:\n{user_prompt}")
 
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.post(
-            f"{base_url}/chat/completions",
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "model": model,
-                "messages": [
-                    {"role": "system", "content": MANAGER_SYSTEM_PROMPT},
-                    {"role": "user", "content": user_prompt},
-                ],
-                "temperature": 0.7,
-                "max_tokens": 3000,
-            },
-        )
-        response.raise_for_status()
-
-    data = response.json()
-    raw = data["choices"][0]["message"]["content"]
-    logger.info(f"[Manager AI 输出]\n{raw}")
-    # 提取 JSON 块（模型可能在 ```json ... ``` 中返回）
-    import re
+    # 模型可能在 ```json ... ``` 中返回，由 chat_json 统一提取与修复。
+    # LLM 响应缓存只按目标及其输入（标题、描述、风格、频率、素材库）计键，不含实时账号数据与当前时间；
+    # 命中时计划的 day_offset 相对于原规划日期，由 _rebase_replayed_plan 换算并丢弃已过去的时段
+    key_prompt = (
+        f"运营目标：{goal_title}\n"
+        f"详细描述：{goal_desc}\n"
+        f"主要风格：{style}\n"
+        f"每日发布频率：{post_freq} 篇"
+        f"{image_section}"
+    )
 
-    match = re.search(r"```(?:json)?\s*([\s\S]+?)\s*```", raw)
-    json_str = match.group(1) if match else raw.strip()
-    return json.loads(json_str)
+    async def request(fresh: bool) -> tuple[dict, dict]:
+        cache_info: dict = {}
+        plan = await chat_json(
+            [
+                {"role": "system", "content": MANAGER_SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt},
+            ],
+            site="manager",
+            cache_as=[
+                {"role": "system", "content": MANAGER_SYSTEM_PROMPT},
+                {"role": "user", "content": key_prompt},
+            ],
+            cache_info=cache_info,
+            json_mode=False,
+            temperature=0.7,
+            max_tokens=3000,
+            fresh=fresh,
+        )
+        return plan, cache_info
+
+    plan, cache_info = await request(fresh)
+    if cache_info:
+        plan = _rebase_replayed_plan(plan, cache_info["created_at"])
+        if not plan["weekly_plan"]:
+            # 缓存计划的时段已全部过去：重新规划，避免用空计划替换现有排期
+            plan, _ = await request(True)
+    logger.info(f"[Manager AI 输出]\n{json.dumps(plan, ensure_ascii=False)}")
+    return plan
+
+
+def _rebase_replayed_plan(plan: dict, planned_at: str) -> dict:
+    """缓存重放的计划：day_offset 从原规划日期换算到今天，已过去的时段丢弃（不顺延，避免挤占后续日期）"""
+    now = datetime.now()
+    base = datetime.strptime(planned_at, "%Y-%m-%d %H:%M:%S").replace(
+        hour=0, minute=0, second=0
+    )
+    shift = (now.replace(hour=0, minute=0, second=0, microsecond=0) - base).days
+    kept = []
+    for item in plan.get("weekly_plan", []):
+        try:
+            slot = (base + timedelta(days=item["day_offset"])).replace(
+                hour=item["hour"], minute=item["minute"]
+            )
+        except (KeyError, TypeError, ValueError):
+            continue
+        if slot <= now:
+            continue
+        kept.append({**item, "day_offset": item["day_offset"] - shift})
+    dropped = len(plan.get("weekly_plan", [])) - len(kept)
+    logger.info(
+        f"[ManagerAI] 复用 {planned_at} 的缓存计划，换算到今天（偏移 {shift} 天），丢弃已过去的时段 {dropped} 条"
+    )
+    return {**plan, "weekly_plan": kept}
 
 
 def calc_scheduled_time(day_offset: int, hour: int, minute: int) -> str:
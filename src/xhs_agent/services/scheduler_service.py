@@ -1,44 +1,135 @@
 import asyncio
 import logging
-from datetime import datetime
+import os
+from datetime import datetime, timedelta
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.date import DateTrigger
-from .goal_service import execute_scheduled_post, list_scheduled_posts
+from apscheduler.triggers.interval import IntervalTrigger
+from ..config import get_setting
+from .execution_service import active_post_ids, submit_post, submit_prepare
+from .job_service import dispatch_queued_jobs, recover_expired_jobs
+from .goal_service import (
+    recover_expired_leases,
+    expire_pending_posts,
+    list_due_posts,
+    list_pending_posts,
+    list_prerender_posts,
+)
 
 logger = logging.getLogger("xhs_agent")
 scheduler = AsyncIOScheduler(timezone="Asia/Shanghai")
 
+# job 错过触发时间后仍允许执行的秒数，reload_pending_jobs 时按 catchup_window_minutes 更新
+_misfire_grace_seconds = 300
+
+# worker 轮询数据库派发到点排期的间隔（秒）；API 进程写入的新排期靠此被 worker 发现
+DISPATCH_INTERVAL_SECONDS = 15
+
+
+# 持有调度器文件锁的句柄，进程存活期间不释放
+_scheduler_lock = None
+
+
+def acquire_scheduler_lock() -> bool:
+    """同一主机上只允许一个 API 进程启动调度器。
+
+    uvicorn 多 worker 时每个进程都会执行 lifespan，由抢到文件锁（默认
+    data/scheduler.lock，可用 XHS_SCHEDULER_LOCK 指定）的进程负责调度；进程退出后
+    锁自动释放。跨主机的重复调度由排期领取租约兜底，不会重复执行。
+    """
+    global _scheduler_lock
+    if _scheduler_lock is not None:
+        return True
+    try:
+        import fcntl
+    except ImportError:
+        # Windows 本地开发：单进程运行，无需加锁
+        return True
+    from ..db import DB_PATH
+
+    path = os.getenv("XHS_SCHEDULER_LOCK") or str(DB_PATH.parent / "scheduler.lock")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    f = open(path, "a+")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        logger.info(f"调度器已由其他进程持有（{path}），本进程 pid={os.getpid()} 仅提供 HTTP 服务")
+        return False
+    f.truncate(0)
+    f.write(str(os.getpid()))
+    f.flush()
+    _scheduler_lock = f
+    return True
+
 
 def start_scheduler() -> None:
     scheduler.start()
+    scheduler.add_job(
+        _run_archive,
+        trigger=CronTrigger(hour=4, minute=0),
+        id="archive_posts",
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        _recover_leases,
+        trigger=IntervalTrigger(seconds=60),
+        id="recover_leases",
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        _dispatch_due_posts,
+        trigger=IntervalTrigger(seconds=DISPATCH_INTERVAL_SECONDS),
+        id="dispatch_due_posts",
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True,
+    )
+    scheduler.add_job(
+        _prerender_upcoming_posts,
+        trigger=IntervalTrigger(seconds=60),
+        id="prerender_posts",
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True,
+    )
     logger.info("定时调度器已启动")
 
 
 async def reload_pending_jobs() -> None:
-    """从数据库加载所有 pending 任务到调度器（服务重启恢复用）"""
-    posts = await list_scheduled_posts()
+    """服务重启恢复：只从 pending 排期重建调度 job。
+
+    晚于补偿窗口（catchup_window_minutes）的排期用一条 UPDATE 标记失败；
+    窗口内已错过的排期立即补跑，未到时间的按原时间调度。
+    """
+    global _misfire_grace_seconds
+    window = int(await get_setting("catchup_window_minutes") or 0)
+    _misfire_grace_seconds = max(window, 5) * 60
+
     now = datetime.now()
-    count = 0
-    for post in posts:
-        if post["status"] != "pending":
-            continue
+    cutoff = (now - timedelta(minutes=window)).strftime("%Y-%m-%d %H:%M")
+    expired = await expire_pending_posts(
+        cutoff,
+        f"服务重启时任务已过期（超过补偿窗口 {window} 分钟）",
+        exclude_ids=active_post_ids(),
+    )
+    if expired:
+        logger.warning(f"{expired} 个 pending 任务超过补偿窗口，已标记失败")
+
+    count = caught_up = 0
+    for post in await list_pending_posts(since=cutoff):
         try:
             run_time = datetime.strptime(post["scheduled_at"], "%Y-%m-%d %H:%M")
         except ValueError:
             continue
         if run_time <= now:
-            # 已过期，直接标记失败
-            from ..db import get_db
-            async with get_db() as db:
-                await db.execute(
-                    "UPDATE scheduled_posts SET status='failed', error='服务重启时任务已过期' WHERE id=?",
-                    (post["id"],),
-                )
-                await db.commit()
-            continue
+            # 补偿窗口内的迟到任务：错开几秒立即执行，避免同时启动
+            run_time = now + timedelta(seconds=5 + caught_up * 10)
+            caught_up += 1
         _add_job(post["id"], run_time)
         count += 1
-    logger.info(f"恢复 {count} 个待执行定时任务")
+    logger.info(f"恢复 {count} 个待执行定时任务（其中 {caught_up} 个在补偿窗口内立即补跑）")
 
 
 def schedule_post(post_id: int, run_time: datetime) -> None:
@@ -46,7 +137,28 @@ def schedule_post(post_id: int, run_time: datetime) -> None:
     logger.info(f"已调度任务 #{post_id} 于 {run_time.strftime('%Y-%m-%d %H:%M')}")
 
 
+def schedule_posts(jobs: list[tuple[int, datetime]]) -> None:
+    """批量注册调度任务（规划生成整周排期时使用）"""
+    for post_id, run_time in jobs:
+        _add_job(post_id, run_time)
+    logger.info(f"已批量调度 {len(jobs)} 个任务")
+
+
+def unschedule_posts(post_ids: list[int]) -> int:
+    """批量取消调度任务，返回实际移除的 job 数"""
+    removed = 0
+    for post_id in post_ids:
+        job_id = f"post_{post_id}"
+        if scheduler.get_job(job_id):
+            scheduler.remove_job(job_id)
+            removed += 1
+    return removed
+
+
 def _add_job(post_id: int, run_time: datetime) -> None:
+    if not scheduler.running:
+        # API-only 进程不运行调度器，排期已写库，由 worker 轮询派发
+        return
     job_id = f"post_{post_id}"
     if scheduler.get_job(job_id):
         scheduler.remove_job(job_id)
@@ -55,10 +167,76 @@ def _add_job(post_id: int, run_time: datetime) -> None:
         trigger=DateTrigger(run_date=run_time),
         args=[post_id],
         id=job_id,
-        misfire_grace_time=300,
+        misfire_grace_time=_misfire_grace_seconds,
     )
 
 
 async def _run_post(post_id: int) -> None:
-    logger.info(f"开始执行定时任务 #{post_id}")
-    await execute_scheduled_post(post_id)
+    logger.info(f"定时任务 #{post_id} 到点，提交执行引擎")
+    await submit_post(post_id)
+
+
+async def _run_archive() -> None:
+    from .archive_service import archive_finished_posts
+
+    try:
+        await archive_finished_posts()
+    except Exception as e:
+        logger.error(f"排期归档任务失败: {e}")
+
+
+async def _dispatch_due_posts() -> None:
+    """轮询数据库中到点（或被请求立即执行）的 pending 排期与 queued 异步任务并提交执行引擎。
+
+    内存中的 DateTrigger job 只存在于启动调度器的进程，API 进程新建/修改的排期
+    通过这里被 worker 发现；重复提交由执行引擎按 key 去重、由领取租约保证只执行一次。
+    """
+    try:
+        window = int(await get_setting("catchup_window_minutes") or 0)
+        now = datetime.now()
+        cutoff = (now - timedelta(minutes=window)).strftime("%Y-%m-%d %H:%M")
+        # 已在执行引擎中排队的排期由领取时执行，不在此过期
+        expired = await expire_pending_posts(
+            cutoff,
+            f"任务未在补偿窗口（{window} 分钟）内执行，已过期",
+            exclude_ids=active_post_ids(),
+        )
+        if expired:
+            logger.warning(f"{expired} 个 pending 任务超过补偿窗口，已标记失败")
+        for post_id in await list_due_posts(now.strftime("%Y-%m-%d %H:%M"), cutoff):
+            await submit_post(post_id)
+    except Exception as e:
+        logger.error(f"到点排期派发失败: {e}")
+    try:
+        # API-only 进程创建的异步任务（/api/jobs）同样由这里领取
+        await dispatch_queued_jobs()
+    except Exception as e:
+        logger.error(f"异步任务派发失败: {e}")
+
+
+async def _prerender_upcoming_posts() -> None:
+    """把 prerender_lead_minutes 内即将发布的排期提交预渲染，到点只需上传"""
+    try:
+        lead = int(await get_setting("prerender_lead_minutes") or 0)
+        if lead <= 0:
+            return
+        now = datetime.now()
+        ids = await list_prerender_posts(
+            now.strftime("%Y-%m-%d %H:%M"),
+            (now + timedelta(minutes=lead)).strftime("%Y-%m-%d %H:%M"),
+        )
+        for post_id in ids:
+            await submit_prepare(post_id)
+    except Exception as e:
+        logger.error(f"排期预渲染派发失败: {e}")
+
+
+async def _recover_leases() -> None:
+    """租约过期的任务（执行进程崩溃/被杀）重新入队"""
+    try:
+        for post_id in await recover_expired_leases():
+            await submit_post(post_id)
+        if await recover_expired_jobs():
+            await dispatch_queued_jobs()
+    except Exception as e:
+        logger.error(f"租约回收任务失败: {e}")
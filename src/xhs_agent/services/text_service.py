@@ -1,8 +1,8 @@
 import json
 import logging
-import httpx
-from ..config import get_setting
+from typing import Callable
 from ..api.schemas import XHSContent
+from .llm_client import chat_json, chat_stream, parse_json
 
 logger = logging.getLogger("xhs_agent")
 
@@ -73,12 +73,12 @@ poster 提示词示例：
 """
 
 
-async def generate_xhs_content(
+def build_user_prompt(
     topic: str,
     style: str,
     image_count: int,
     ref_annotations: list[dict] | None = None,
-) -> XHSContent:
+) -> str:
     user_prompt = f"主题：{topic}\n风格：{style}\n需要生成 {image_count} 张配图的提示词"
 
     if ref_annotations:
@@ -88,43 +88,11 @@ async def generate_xhs_content(
             text = ann.get("annotation", "")
             if text:
                 user_prompt += f"\n  - [{cat}] {text}"
+    return user_prompt
 
-    base_url = await get_setting("siliconflow_base_url")
-    api_key = await get_setting("siliconflow_api_key")
-    model = await get_setting("text_model")
-
-    logger.debug(
-        f"[TextService] 请求参数: model={model!r}, topic={topic!r}, style={style!r}, image_count={image_count}"
-    )
-    logger.debug(f"[TextService] system_prompt:\n{SYSTEM_PROMPT}")
-    logger.debug(f"[TextService] user_prompt:\n{user_prompt}")
-
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.post(
-            f"{base_url}/chat/completions",
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "model": model,
-                "messages": [
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": user_prompt},
-                ],
-                "temperature": 0.8,
-                "max_tokens": 2048,
-                "response_format": {"type": "json_object"},
-            },
-        )
-        response.raise_for_status()
-
-    data = response.json()
-    raw_content = data["choices"][0]["message"]["content"]
-    logger.debug(f"[TextService] LLM 原始响应: {raw_content}")
-
-    parsed = json.loads(raw_content)
 
+def parse_content(parsed: dict) -> XHSContent:
+    """把 LLM 输出的 JSON 转为 XHSContent，缺少 title/body 时抛出 KeyError"""
     # image_style 为整篇笔记统一风格（单值），兼容旧格式 image_styles 列表
     raw_style = parsed.get("image_style") or (
         parsed.get("image_styles", ["photo"])[0]
@@ -140,3 +108,142 @@ async def generate_xhs_content(
         image_prompts=parsed.get("image_prompts", []),
         image_styles=[unified_style],  # 只存一个统一风格
     )
+
+
+async def generate_xhs_content(
+    topic: str,
+    style: str,
+    image_count: int,
+    ref_annotations: list[dict] | None = None,
+    fresh: bool = False,
+) -> XHSContent:
+    """生成笔记内容；fresh=True（用户要求重新生成）时跳过 LLM 响应缓存"""
+    user_prompt = build_user_prompt(topic, style, image_count, ref_annotations)
+
+    logger.debug(
+        f"[TextService] 请求参数: topic={topic!r}, style={style!r}, image_count={image_count}"
+    )
+    logger.debug(f"[TextService] system_prompt:\n{SYSTEM_PROMPT}")
+    logger.debug(f"[TextService] user_prompt:\n{user_prompt}")
+
+    return await chat_json(
+        [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt},
+        ],
+        site="text",
+        validate=parse_content,
+        temperature=0.8,
+        max_tokens=2048,
+        fresh=fresh,
+    )
+
+
+class JSONFieldStream:
+    """增量解析流式输出的 JSON 对象：每喂入一段文本，返回其中新完成的顶层字段 [(key, value)]。
+
+    只跟踪顶层对象的字段边界（字符串转义、嵌套数组/对象），值完整后才整体 json.loads，
+    因此 title 在 body 仍在生成时就能取到。对象之前的 ```json 等前缀会被忽略。
+    """
+
+    def __init__(self):
+        self._buf = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+        self._key: str | None = None
+        self._key_start: int | None = None
+        self._value_start: int | None = None
+
+    def feed(self, chunk: str) -> list[tuple[str, object]]:
+        self._buf += chunk
+        buf, out = self._buf, []
+        while self._pos < len(buf):
+            i, c = self._pos, buf[self._pos]
+            self._pos += 1
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif c == "\\":
+                    self._esc = True
+                elif c == '"':
+                    self._in_str = False
+                    if self._depth == 1 and self._key_start is not None:
+                        self._key = json.loads(buf[self._key_start : i + 1])
+                        self._key_start = None
+                    elif self._depth == 1 and self._value_start is not None:
+                        self._emit(buf, i + 1, out)
+                continue
+            if c == '"':
+                self._in_str = True
+                if self._depth == 1:
+                    if self._key is None:
+                        self._key_start = i
+                    elif self._value_start is None:
+                        self._value_start = i
+            elif c in "{[":
+                if self._depth == 1 and self._key is not None and self._value_start is None:
+                    self._value_start = i
+                self._depth += 1
+            elif c in "}]":
+                if self._depth == 1 and self._value_start is not None:
+                    # 数字/布尔等原始值以对象结束符收尾
+                    self._emit(buf, i, out)
+                self._depth -= 1
+                if self._depth == 1 and self._value_start is not None:
+                    self._emit(buf, i + 1, out)
+            elif self._depth == 1 and self._value_start is not None and c == ",":
+                self._emit(buf, i, out)
+            elif (
+                self._depth == 1
+                and self._key is not None
+                and self._value_start is None
+                and c not in " \t\r\n:,"
+            ):
+                self._value_start = i
+        return out
+
+    def _emit(self, buf: str, end: int, out: list) -> None:
+        key, raw = self._key, buf[self._value_start : end].strip()
+        self._key = self._value_start = None
+        try:
+            out.append((key, json.loads(raw)))
+        except ValueError:
+            logger.debug(f"[TextService] 流式字段 {key!r} 解析失败: {raw[:80]}")
+
+
+async def stream_xhs_content(
+    topic: str,
+    style: str,
+    image_count: int,
+    ref_annotations: list[dict] | None = None,
+    on_field: Callable[[str, object], None] | None = None,
+) -> XHSContent:
+    """流式生成笔记内容：边接收 LLM 输出边增量解析，每个顶层字段（title / body / hashtags …）
+    完成时回调 on_field(key, value)，最终返回与 generate_xhs_content 相同结构的 XHSContent。"""
+    user_prompt = build_user_prompt(topic, style, image_count, ref_annotations)
+
+    logger.debug(
+        f"[TextService] 流式请求: topic={topic!r}, style={style!r}, image_count={image_count}"
+    )
+
+    parser = JSONFieldStream()
+
+    def on_delta(delta: str) -> None:
+        for key, value in parser.feed(delta):
+            if on_field:
+                on_field(key, value)
+
+    raw_content = await chat_stream(
+        [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt},
+        ],
+        site="text_stream",
+        on_delta=on_delta,
+        temperature=0.8,
+        max_tokens=2048,
+        json_mode=True,
+    )
+    return parse_content(parse_json(raw_content))
@@ -1,7 +1,9 @@
+import asyncio
 import hashlib
 import json
 import logging
 import pathlib
+import shutil
 import tempfile
 import httpx
 import execjs
@@ -85,7 +87,15 @@ def _make_client(cookie: str) -> XhsClient:
 
 
 async def download_image_to_tmp(url: str, max_retries: int = 3) -> str:
-    """将图片 URL 下载到临时文件，返回本地路径"""
+    """将图片 URL 下载到临时文件，返回本地路径（本地图片存储 /api/images/ 的地址直接复制）"""
+    from .image_service import stored_image_path
+
+    local = stored_image_path(url)
+    if local is not None:
+        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=local.suffix)
+        tmp.close()
+        await asyncio.to_thread(shutil.copyfile, local, tmp.name)
+        return tmp.name
     for attempt in range(1, max_retries + 1):
         try:
             async with httpx.AsyncClient(timeout=600) as client:
@@ -1,8 +1,7 @@
 import logging
 
-import httpx
-
 from ..config import get_setting
+from .llm_client import chat
 
 logger = logging.getLogger("xhs_agent")
 
@@ -57,8 +56,6 @@ async def analyze_image_group(
     category: str = "style",
     user_prompt: str = "",
 ) -> str:
-    base_url = await get_setting("siliconflow_base_url")
-    api_key = await get_setting("siliconflow_api_key")
     model = await get_setting("vision_model")
 
     prompt = CATEGORY_PROMPTS.get(category, _DEFAULT_PROMPT)
@@ -71,30 +68,18 @@ async def analyze_image_group(
     for url in image_urls:
         content_parts.append({"type": "image_url", "image_url": {"url": url}})
 
-    payload = {
-        "model": model,
-        "messages": [{"role": "user", "content": content_parts}],
-        "max_tokens": 1500,
-        "temperature": 0.7,
-    }
-
     logger.debug(
         f"[VisionService] model={model!r}, category={category!r}, images={len(image_urls)}"
     )
 
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        response = await client.post(
-            f"{base_url}/chat/completions",
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-            },
-            json=payload,
-        )
-        response.raise_for_status()
-
-    data = response.json()
-    result = data["choices"][0]["message"]["content"]
+    result = await chat(
+        [{"role": "user", "content": content_parts}],
+        site="vision",
+        model=model,
+        temperature=0.7,
+        max_tokens=1500,
+        timeout=120.0,
+    )
     logger.info(
         f"[VisionService] 组识别完成 [{category}] {len(image_urls)}张: {result[:80]}..."
     )
@@ -0,0 +1,45 @@
+"""
+独立 worker 进程：只运行调度器与执行引擎，不提供 HTTP 服务
+
+与 API 进程通过数据库协作：API 写入/修改排期，worker 轮询到点的 pending 排期
+并经执行引擎领取执行（见 scheduler_service._dispatch_due_posts）。
+启动方式：xhs-agent worker
+"""
+
+import asyncio
+import logging
+import signal
+
+from .db import init_db, close_db
+from .services.goal_service import WORKER_ID
+from .services.llm_client import close_llm_client
+from .services.scheduler_service import (
+    scheduler,
+    start_scheduler,
+    reload_pending_jobs,
+)
+
+logger = logging.getLogger("xhs_agent")
+
+
+async def run_worker() -> None:
+    await init_db()
+    start_scheduler()
+    await reload_pending_jobs()
+    logger.info(f"[Worker] {WORKER_ID} 已启动，等待排期任务")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    try:
+        await stop.wait()
+    finally:
+        logger.info(f"[Worker] {WORKER_ID} 正在退出")
+        # 执行中的排期不等待完成：租约过期后由其他 worker 回收重跑
+        scheduler.shutdown(wait=False)
+        await close_llm_client()
+        await close_db()